@@ -42,6 +42,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'documents.middleware.RequestProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -128,11 +129,101 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Uploaded files are hashed, counted and checked against their extension
+# while they are received, so saving them never reads them again
+FILE_UPLOAD_HANDLERS = [
+    'documents.upload_handlers.InspectingMemoryFileUploadHandler',
+    'documents.upload_handlers.InspectingTemporaryFileUploadHandler',
+]
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# Dashboard analytics work with the local-memory, file-based and database
+# backends, e.g. 'django.core.cache.backends.filebased.FileBasedCache' or
+# 'django.core.cache.backends.db.DatabaseCache' (run createcachetable).
+# Local memory is per process, so use a shared backend when running several
+# workers for writes in one worker to invalidate the others; without one,
+# title suggestions in a worker miss documents changed in the others until
+# it restarts (check --deploy warns about it).
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+# Seconds dashboard analytics stay cached; writes invalidate them sooner
+DASHBOARD_CACHE_TIMEOUT = 60
+
+# Request profiling: adds a Server-Timing header with SQL, template and Python
+# time, and logs statements repeated more than the threshold within a request
+REQUEST_PROFILING = False
+REQUEST_PROFILING_DUPLICATE_THRESHOLD = 10
+
+# Number of documents per page in the dashboard, archive and export listings
+DOCUMENTS_PAGE_SIZE = 24
+
+# Text extraction from uploaded DOCX, XLSX and PDF files for search. Runs on a
+# background thread pool after upload, keeping at most MAX_CHARS per version.
+TEXT_EXTRACTION_BACKGROUND = True
+TEXT_EXTRACTION_WORKERS = 1
+TEXT_EXTRACTION_MAX_CHARS = 1_000_000
+
+# Chunked uploads: sessions expire this many seconds after their last chunk,
+# files may be at most UPLOAD_SESSION_MAX_SIZE bytes and a single PUT may
+# carry at most UPLOAD_CHUNK_MAX_SIZE bytes
+UPLOAD_SESSION_EXPIRY = 24 * 60 * 60
+UPLOAD_SESSION_MAX_SIZE = 4 * 1024 * 1024 * 1024
+UPLOAD_CHUNK_MAX_SIZE = 64 * 1024 * 1024
+
+# Delta storage: once a newer version exists, older versions are split into
+# content-defined chunks in the background and only new chunks are stored.
+# Experimental and off by default, the pack_versions command packs on demand
+VERSION_DELTA_STORAGE = False
+VERSION_DELTA_BACKGROUND = True
+
+# Cold storage: files of documents archived for longer than the grace period
+# are moved, lzma-compressed, to COLD_STORAGE_ROOT by move_to_cold_storage.
+# Restored documents are read from there until a background thread moves
+# their files back
+COLD_STORAGE_ROOT = os.path.join(BASE_DIR, 'cold_storage')
+COLD_STORAGE_GRACE_DAYS = 30
+COLD_STORAGE_THAW_BACKGROUND = True
+
+# How files are sent once access has been checked: 'python' streams them from
+# Django, 'x-accel-redirect' (nginx) and 'x-sendfile' (Apache mod_xsendfile,
+# lighttpd) hand the transfer to the web server. For nginx, map
+# MEDIA_ACCEL_REDIRECT_PREFIX to MEDIA_ROOT in an internal location.
+MEDIA_SERVING_BACKEND = 'python'
+MEDIA_ACCEL_REDIRECT_PREFIX = '/protected-media/'
+
+# Thumbnails of image documents are rendered after upload on a pool of
+# worker processes, off the request path
+THUMBNAIL_BACKGROUND = True
+THUMBNAIL_WORKERS = 2
+
+# Bulk imports hash files on IMPORT_WORKERS threads and insert them
+# IMPORT_BATCH_SIZE at a time, one transaction per batch
+IMPORT_BATCH_SIZE = 500
+IMPORT_WORKERS = 4
+
+# collect_media_garbage leaves files younger than this alone, since the rows
+# referring to a new file are written just after it
+MEDIA_GC_GRACE_HOURS = 24
+
+# Database-backed job queue. When enabled, text extraction, delta packing and
+# thumbnails are queued as jobs for `manage.py run_worker` instead of running
+# on the web process's own pools. Jobs whose worker died are taken over once
+# their lease runs out.
+JOB_QUEUE_ENABLED = False
+JOB_WORKER_CONCURRENCY = 4
+JOB_LEASE_SECONDS = 5 * 60
+
 LOGIN_URL = 'login'
 LOGIN_REDIRECT_URL = 'dashboard'
 LOGOUT_REDIRECT_URL = 'login'
@@ -1,7 +1,6 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib.auth import views as auth_views
 from documents import views as document_views
 from django.views.generic import RedirectView
@@ -13,4 +12,6 @@ urlpatterns = [
     path('accounts/login/', auth_views.LoginView.as_view(template_name='registration/login.html'), name='login'),
     path('accounts/logout/', auth_views.LogoutView.as_view(template_name='registration/logged_out.html', next_page='login'), name='logout'),
     path('accounts/register/', document_views.register, name='register'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    # Uploaded files, served after an access check, see MEDIA_SERVING_BACKEND
+    path(settings.MEDIA_URL.lstrip('/') + '<path:path>', document_views.serve_media, name='serve_media'),
+]
\ No newline at end of file
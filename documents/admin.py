@@ -1,7 +1,9 @@
 from django.contrib import admin
-from .models import Category, Document
+from .models import Category, Document, Job
+from . import typeahead
 from django.utils.html import format_html
 from django.urls import reverse
+from django.utils import timezone
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -44,8 +46,24 @@ class DocumentAdmin(admin.ModelAdmin):
     
     def make_private(self, request, queryset):
         queryset.update(is_private=True)
+        # update() sends no signals, the typeahead index must not show these to others
+        typeahead.invalidate()
     make_private.short_description = "Mark selected documents as private"
     
     def make_public(self, request, queryset):
         queryset.update(is_private=False)
-    make_public.short_description = "Mark selected documents as public"
\ No newline at end of file
+        typeahead.invalidate()
+    make_public.short_description = "Mark selected documents as public"
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('name', 'status', 'priority', 'attempts', 'max_attempts', 'run_after', 'locked_by')
+    list_filter = ('status', 'name')
+    readonly_fields = ('created_at', 'finished_at', 'last_error')
+    actions = ('retry',)
+
+    def retry(self, request, queryset):
+        queryset.exclude(status='running').update(
+            status='queued', attempts=0, run_after=timezone.now(), last_error=''
+        )
+    retry.short_description = "Retry selected jobs"
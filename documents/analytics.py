@@ -0,0 +1,353 @@
+"""
+Materialized dashboard analytics.
+
+Per-category, per-extension and per-owner document counts and byte totals are
+kept in AnalyticsCounter rows. The signal handlers in documents.signals apply
+deltas on every Document save and delete, so the dashboard only has to read a
+handful of rows instead of scanning the documents table. The assembled results
+are cached per generation in Django's cache framework.
+"""
+import time
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Count, F, Q, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .models import AnalyticsCounter, Category, DailyActivity, Document, DocumentVersion
+
+BYTES_PER_MB = 1024 * 1024
+
+
+def document_contribution(document):
+    """
+    Return (keys, size) describing what a document adds to the counters, or
+    None if it is not counted (archived documents are excluded).
+    """
+    if document is None or document.is_archived:
+        return None
+
+    keys = [
+        ('total', ''),
+        ('category', str(document.category_id or '')),
+        ('owner', str(document.owner_id)),
+    ]
+    if document.extension:
+        keys.append(('extension', document.extension))
+    return keys, document.size_bytes
+
+
+def apply_delta(keys, count, size):
+    """Add count and size to every counter in keys, creating missing rows."""
+    for dimension, key in keys:
+        values = {
+            'document_count': F('document_count') + count,
+            'total_bytes': F('total_bytes') + size,
+        }
+        counters = AnalyticsCounter.objects.filter(dimension=dimension, key=key)
+        if not counters.update(**values):
+            AnalyticsCounter.objects.get_or_create(dimension=dimension, key=key)
+            counters.update(**values)
+
+
+def record_change(old, new):
+    """Move a document's contribution from its old state to its new one."""
+    if old == new:
+        return
+    with transaction.atomic():
+        if old:
+            apply_delta(old[0], -1, -old[1])
+        if new:
+            apply_delta(new[0], 1, new[1])
+
+
+def move_category(from_id, to_id):
+    """
+    Transfer category counters when documents are reassigned in bulk, e.g. by
+    a queryset update or on_delete=SET_NULL, which bypass model signals.
+    """
+    from_key = str(from_id or '')
+    to_key = str(to_id or '')
+    if from_key == to_key:
+        return
+    with transaction.atomic():
+        counter = AnalyticsCounter.objects.select_for_update().filter(
+            dimension='category', key=from_key
+        ).first()
+        if counter is None:
+            return
+        apply_delta([('category', to_key)], counter.document_count, counter.total_bytes)
+        counter.delete()
+
+
+def rebuild():
+    """
+    Recompute every counter from the documents table with one grouped query
+    per dimension. Returns the number of counter rows written.
+    """
+    active = Document.objects.filter(is_archived=False)
+    aggregates = {'document_count': Count('id'), 'total_bytes': Sum('size_bytes')}
+
+    rows = [('total', '', active.aggregate(**aggregates))]
+    for dimension in ('category', 'owner', 'extension'):
+        grouped = active.order_by().values(dimension).annotate(**aggregates)
+        rows.extend((dimension, row[dimension], row) for row in grouped)
+
+    counters = [
+        AnalyticsCounter(
+            dimension=dimension, key=str(key or ''),
+            document_count=row['document_count'],
+            total_bytes=row['total_bytes'] or 0,
+        )
+        for dimension, key, row in rows
+        if row['document_count'] and (key or dimension != 'extension')
+    ]
+
+    with transaction.atomic():
+        AnalyticsCounter.objects.all().delete()
+        AnalyticsCounter.objects.bulk_create(counters, batch_size=1000)
+    invalidate()
+    return len(counters)
+
+
+def _to_mb(size):
+    return round(size / BYTES_PER_MB, 2)
+
+
+# Daily activity rollup
+
+ACTIVITY_WINDOWS = (7, 30, 90, 365)
+
+
+def record_activity(day, **deltas):
+    """Add deltas (uploads, archives, bytes_added, versions_created) to a day's row."""
+    values = {field: F(field) + delta for field, delta in deltas.items()}
+    days = DailyActivity.objects.filter(day=day)
+    if not days.update(**values):
+        DailyActivity.objects.get_or_create(day=day)
+        days.update(**values)
+
+
+def record_upload_change(day, count):
+    """
+    Add count, which is negative when documents are archived or deleted,
+    to the active uploads of the day they were uploaded on.
+    """
+    if count >= 0:
+        record_activity(day, uploads=count)
+    else:
+        DailyActivity.objects.filter(day=day, uploads__gte=-count).update(uploads=F('uploads') + count)
+
+
+def record_new_documents(documents, versions):
+    """
+    Add documents and versions created without signals, such as by
+    bulk_create, to the counters and the daily rollup, as the post_save
+    handlers would have, with one update per counter and day.
+    """
+    counters = defaultdict(lambda: [0, 0])
+    days = defaultdict(lambda: defaultdict(int))
+    for document in documents:
+        contribution = document_contribution(document)
+        if contribution:
+            keys, size = contribution
+            for key in keys:
+                counters[key][0] += 1
+                counters[key][1] += size
+        day = days[timezone.localdate(document.uploaded_at)]
+        day['uploads'] += 0 if document.is_archived else 1
+        day['bytes_added'] += document.size_bytes
+        if document.is_archived:
+            days[timezone.localdate(document.archived_at or timezone.now())]['archives'] += 1
+    for version in versions:
+        day = days[timezone.localdate(version.created_at)]
+        day['versions_created'] += 1
+        # The first version shares the document's upload, later ones add bytes
+        if version.version_number > 1:
+            day['bytes_added'] += version.size_bytes
+
+    with transaction.atomic():
+        for key, (count, size) in counters.items():
+            apply_delta([key], count, size)
+        for day, deltas in days.items():
+            record_activity(day, **deltas)
+    invalidate()
+
+
+def activity(days=7):
+    """
+    Daily upload counts for the last `days` days including today, formatted
+    for the chart. Reads at most one rollup row per day.
+    """
+    end_date = timezone.localdate()
+    start_date = end_date - timedelta(days=days - 1)
+    counts = dict(DailyActivity.objects.filter(
+        day__gte=start_date, day__lte=end_date
+    ).values_list('day', 'uploads'))
+
+    # Create a complete date range, filling days without uploads with zero
+    labels = []
+    data = []
+    for offset in range(days):
+        current_date = start_date + timedelta(days=offset)
+        labels.append(current_date.strftime('%d %b'))
+        data.append(counts.get(current_date, 0))
+    return labels, data
+
+
+def rebuild_daily_activity():
+    """
+    Recompute the daily rollup from documents and versions. Activity of
+    deleted documents cannot be recovered. Returns the number of days written.
+    """
+    rows = defaultdict(dict)
+
+    # The chart counts the uploads of documents that are still active
+    uploads = Document.objects.annotate(day=TruncDate('uploaded_at')).order_by().values('day').annotate(
+        uploads=Count('id', filter=Q(is_archived=False)), bytes_added=Sum('size_bytes')
+    )
+    archives = Document.objects.filter(archived_at__isnull=False).annotate(
+        day=TruncDate('archived_at')
+    ).order_by().values('day').annotate(archives=Count('id'))
+    versions = DocumentVersion.objects.annotate(day=TruncDate('created_at')).order_by().values('day').annotate(
+        versions_created=Count('id'),
+        # The first version shares the document's upload, later ones add bytes
+        bytes_added=Sum('size_bytes', filter=Q(version_number__gt=1)),
+    )
+    for grouped in (uploads, archives, versions):
+        for row in grouped:
+            day = rows[row.pop('day')]
+            for field, value in row.items():
+                day[field] = day.get(field, 0) + (value or 0)
+
+    with transaction.atomic():
+        DailyActivity.objects.all().delete()
+        DailyActivity.objects.bulk_create(
+            [DailyActivity(day=day, **values) for day, values in rows.items()],
+            batch_size=1000,
+        )
+    invalidate()
+    return len(rows)
+
+
+def global_stats():
+    """Dashboard analytics shared by every user."""
+    counters = AnalyticsCounter.objects.filter(
+        dimension__in=['total', 'category', 'extension'],
+        document_count__gt=0,
+    ).order_by('-document_count', 'key')
+
+    stats = {
+        'total_documents': 0,
+        'active_categories_count': 0,
+        'category_stats': [],
+        'file_types': {},
+        'storage_total': 0,
+        'storage_by_category': {},
+    }
+    by_category = []
+    for counter in counters:
+        if counter.dimension == 'total':
+            stats['total_documents'] = counter.document_count
+            stats['storage_total'] = _to_mb(counter.total_bytes)
+        elif counter.dimension == 'extension':
+            stats['file_types'][counter.key] = counter.document_count
+        else:
+            by_category.append(counter)
+
+    names = dict(Category.objects.filter(
+        pk__in=[counter.key for counter in by_category if counter.key]
+    ).values_list('pk', 'name'))
+
+    storage_by_category = {}
+    for counter in by_category:
+        label = names.get(int(counter.key), 'Uncategorized') if counter.key else 'Uncategorized'
+        if counter.key:
+            stats['active_categories_count'] += 1
+        stats['category_stats'].append({'label': label, 'count': counter.document_count})
+        storage_by_category[label] = storage_by_category.get(label, 0) + counter.total_bytes
+    stats['storage_by_category'] = {
+        label: _to_mb(size) for label, size in storage_by_category.items()
+    }
+
+    stats['recent_uploads'] = list(
+        Document.objects.filter(is_archived=False)
+        .select_related('category', 'owner')
+        .order_by('-uploaded_at')[:5]
+    )
+    return stats
+
+
+def user_stats(user):
+    """Dashboard analytics specific to one user."""
+    counter = AnalyticsCounter.objects.filter(dimension='owner', key=str(user.pk)).first()
+    return {
+        'user_documents': counter.document_count if counter else 0,
+        'storage_user': _to_mb(counter.total_bytes) if counter else 0,
+    }
+
+
+# Cache layer. Every cache key embeds a generation number that is bumped on
+# each write, so entries cached before a write are never read again and simply
+# expire. Only get/add/incr and get_many/set_many are used, which every cache
+# backend supports.
+
+GENERATION_KEY = 'documents:analytics:generation'
+
+
+def _cache_timeout():
+    return getattr(settings, 'DASHBOARD_CACHE_TIMEOUT', 60)
+
+
+def get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start from the clock so a lost counter never revisits old generations
+        cache.add(GENERATION_KEY, time.time_ns(), timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def _bump_generation():
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.add(GENERATION_KEY, time.time_ns(), timeout=None)
+
+
+def invalidate():
+    """
+    Invalidate all cached analytics. The generation is bumped immediately and
+    again once the surrounding transaction commits, so results cached by
+    other requests while it was still open are discarded as well.
+    """
+    _bump_generation()
+    transaction.on_commit(_bump_generation)
+
+
+def dashboard_stats(user, window=7):
+    """
+    Return the dashboard analytics for a user, combining the cached global
+    tier, the cached activity chart for the window and the cached per-user tier.
+    """
+    generation = get_generation()
+    prefix = f'documents:analytics:{generation}'
+    tiers = {
+        f'{prefix}:global': global_stats,
+        f'{prefix}:activity:{window}': lambda: activity(window),
+        f'{prefix}:user:{user.pk}': lambda: user_stats(user),
+    }
+
+    # Read every tier in one round trip and rebuild only the missing ones
+    results = cache.get_many(tiers)
+    missing = {key: build() for key, build in tiers.items() if key not in results}
+    if missing:
+        cache.set_many(missing, _cache_timeout())
+        results.update(missing)
+
+    shared, (labels, data), personal = (results[key] for key in tiers)
+    return {**shared, **personal, 'activity_labels': labels, 'activity_data': data}
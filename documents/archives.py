@@ -0,0 +1,488 @@
+"""
+Document archives that round-trip between instances.
+
+An archive is a ZIP file holding a manifest, manifest.jsonl, and every
+distinct file content once, under files/ and named by its SHA-256. The
+manifest's first line is a header naming the format and its version; each
+line after it is one document as a JSON object: its metadata and category,
+its file, every version and every comment, with users given by username.
+
+stream_archive() streams an archive chunk by chunk like exports.stream_zip():
+first the manifest, built from the database a batch of documents at a time,
+then the files.
+
+import_archive() reads the manifest a line at a time and the files straight
+out of the ZIP, without extracting it anywhere, and inserts each batch of
+documents, versions and comments with bulk_create in one transaction.
+Contents are hashed and sniffed as they are read, so a manifest can't point
+a document at content the archive doesn't hold, or at content that
+contradicts its file name's extension. Each batch adds its documents to the
+analytics counters and daily rollup as it is inserted.
+"""
+import hashlib
+import io
+import itertools
+import json
+import logging
+import mimetypes
+import os
+import zipfile
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import analytics, delta, exports, extraction, filetypes, importer, search, thumbnails, tiering, typeahead
+from .models import Blob, Category, Comment, Document, DocumentVersion, blob_name, validate_file_type
+
+logger = logging.getLogger(__name__)
+
+FORMAT = 'documents-archive'
+FORMAT_VERSION = 1
+MANIFEST_NAME = 'manifest.jsonl'
+CHUNK_SIZE = 64 * 1024
+
+
+class ArchiveError(Exception):
+    pass
+
+
+# Export
+
+def content_path(obj, kind):
+    """Path in the archive of a document's or version's file, shared by identical contents."""
+    key = obj.sha256 or f'{kind}-{obj.pk}'
+    extension = obj.extension or os.path.splitext(obj.file.name)[1].lower()
+    return f'files/{key}{extension}'
+
+
+def _timestamp(value):
+    return value.isoformat() if value else None
+
+
+def _content(obj, kind):
+    return {
+        'path': content_path(obj, kind),
+        'sha256': obj.sha256,
+        'size_bytes': obj.size_bytes,
+        'original_filename': obj.get_filename(),
+    }
+
+
+def manifest_record(document, versions, comments):
+    """The manifest line describing document, as a dict."""
+    return {
+        'title': document.title,
+        'description': document.description,
+        'category': document.category.name if document.category else None,
+        'owner': document.owner.username,
+        'is_private': document.is_private,
+        'is_archived': document.is_archived,
+        'archived_at': _timestamp(document.archived_at),
+        'uploaded_at': _timestamp(document.uploaded_at),
+        'current_version': document.current_version,
+        'file': _content(document, 'document'),
+        'versions': [
+            {
+                'version_number': version.version_number,
+                'comment': version.comment,
+                'created_by': version.created_by.username,
+                'created_at': _timestamp(version.created_at),
+                'file': _content(version, 'version'),
+            }
+            for version in versions
+        ],
+        'comments': [
+            {'user': comment.user.username, 'text': comment.text, 'created_at': _timestamp(comment.created_at)}
+            for comment in comments
+        ],
+    }
+
+
+def _batches(documents, size):
+    rows = documents.order_by('pk').select_related('category', 'owner').iterator(chunk_size=size)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            break
+        yield batch
+
+
+def _versions(batch):
+    versions = defaultdict(list)
+    rows = DocumentVersion.objects.filter(
+        document_id__in=[document.pk for document in batch]
+    ).select_related('created_by').defer('extracted_text').order_by('version_number')
+    for version in rows:
+        versions[version.document_id].append(version)
+    return versions
+
+
+def _comments(batch):
+    comments = defaultdict(list)
+    rows = Comment.objects.filter(
+        document_id__in=[document.pk for document in batch]
+    ).select_related('user').order_by('created_at', 'pk')
+    for comment in rows:
+        comments[comment.document_id].append(comment)
+    return comments
+
+
+def stream_archive(documents, batch_size=None):
+    """
+    Yield an archive of documents, a queryset, with their versions and
+    comments. Files missing from storage are left out, and importing
+    the documents that use them fails.
+    """
+    batch_size = batch_size or getattr(settings, 'IMPORT_BATCH_SIZE', importer.DEFAULT_BATCH_SIZE)
+    buffer = exports.ChunkBuffer()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        # Its size isn't known up front
+        with archive.open(MANIFEST_NAME, 'w', force_zip64=True) as manifest:
+            header = {'format': FORMAT, 'version': FORMAT_VERSION, 'exported_at': _timestamp(timezone.now())}
+            manifest.write(json.dumps(header).encode() + b'\n')
+            for batch in _batches(documents, batch_size):
+                versions, comments = _versions(batch), _comments(batch)
+                for document in batch:
+                    record = manifest_record(document, versions[document.pk], comments[document.pk])
+                    manifest.write(json.dumps(record, ensure_ascii=False).encode() + b'\n')
+                data = buffer.pop()
+                if data:
+                    yield data
+
+        written = set()
+        for batch in _batches(documents, batch_size):
+            versions = _versions(batch)
+            for document in batch:
+                files = [(document, 'document')] + [(version, 'version') for version in versions[document.pk]]
+                for obj, kind in files:
+                    path = content_path(obj, kind)
+                    if path in written:
+                        continue
+                    try:
+                        if kind == 'version':
+                            source = delta.open_version(obj)
+                        else:
+                            source = tiering.open_stored(obj.file.storage, obj.file.name)
+                    except FileNotFoundError:
+                        continue
+                    written.add(path)
+                    with source:
+                        modified = obj.uploaded_at if kind == 'document' else obj.created_at
+                        yield from exports.write_entry(archive, buffer, path, source, modified)
+    # The end of the last entry and the central directory, written on close
+    yield buffer.pop()
+
+
+# Import
+
+def is_archive(file):
+    """Whether file, typically an upload, is an archive written by stream_archive()."""
+    try:
+        with zipfile.ZipFile(file) as archive:
+            return MANIFEST_NAME in archive.NameToInfo
+    except zipfile.BadZipFile:
+        return False
+    finally:
+        file.seek(0)
+
+
+def _read_manifest(manifest):
+    """Yield (line number, record or error) for each document in the manifest."""
+    lines = io.TextIOWrapper(manifest, encoding='utf-8')
+    try:
+        header = json.loads(next(lines))
+    except (StopIteration, ValueError):
+        header = None
+    if not isinstance(header, dict) or header.get('format') != FORMAT:
+        raise ArchiveError('Not a documents archive')
+    if header.get('version') != FORMAT_VERSION:
+        raise ArchiveError(f"Unsupported archive version {header.get('version')}")
+    for number, line in enumerate(lines, start=2):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield number, ArchiveError(f'Invalid manifest line {number}: {e}')
+            continue
+        yield number, record
+
+
+def _contents(record):
+    """The file contents record refers to, checking the record's shape."""
+    if not isinstance(record, dict) or not isinstance(record.get('title'), str):
+        raise ArchiveError('Document has no title')
+    contents = [record.get('file')] + [
+        version.get('file') if isinstance(version, dict) else None for version in record.get('versions') or []
+    ]
+    for content in contents:
+        if not isinstance(content, dict) or not isinstance(content.get('path'), str):
+            raise ArchiveError('File entry has no path')
+        validate_file_type(File(None, str(content.get('original_filename') or content['path'])))
+    return contents
+
+
+def _hash_member(archive, path):
+    """Return the SHA-256, size and detected type of the archive file at path."""
+    if not path.startswith('files/') or path not in archive.NameToInfo:
+        raise ArchiveError(f'{path} is missing from the archive')
+    digest = hashlib.sha256()
+    size = 0
+    head = b''
+    with archive.open(path) as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            if len(head) < filetypes.HEAD_SIZE:
+                head += chunk[:filetypes.HEAD_SIZE - len(head)]
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size, filetypes.sniff(head)
+
+
+def _outcome(func, *args):
+    try:
+        return func(*args)
+    except (ArchiveError, ValidationError, OSError, zipfile.BadZipFile) as e:
+        return e
+
+
+def _write_member(archive, path, storage, sha256, extension, size):
+    with archive.open(path) as member:
+        file = File(member, os.path.basename(path))
+        file.size = size
+        return storage.save(blob_name(sha256, extension), file)
+
+
+def _metadata(content, sha256, size, file_type):
+    """The file metadata of content, rejecting it if it contradicts its extension."""
+    filename = os.path.basename(str(content.get('original_filename') or content['path']))[:255]
+    rejection = filetypes.mismatch(filename, file_type)
+    if rejection:
+        raise ValidationError(rejection)
+    return {
+        'size_bytes': size,
+        'extension': os.path.splitext(filename)[1].lower(),
+        'mime_type': (
+            filetypes.mime_type(file_type) or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        ),
+        'sha256': sha256,
+        'original_filename': filename,
+    }
+
+
+def _datetime(value):
+    parsed = parse_datetime(value) if isinstance(value, str) else None
+    if parsed is not None and timezone.is_naive(parsed):
+        parsed = timezone.make_aware(parsed)
+    return parsed
+
+
+def _resolve_users(records, owner, keep_users):
+    if not keep_users:
+        return defaultdict(lambda: owner)
+    usernames = set()
+    for record in records:
+        usernames.add(record.get('owner'))
+        usernames.update(version.get('created_by') for version in record.get('versions') or [])
+        usernames.update(comment.get('user') for comment in record.get('comments') or [] if isinstance(comment, dict))
+    users = defaultdict(lambda: owner)
+    users.update((user.username, user) for user in User.objects.filter(
+        username__in=[name for name in usernames if isinstance(name, str)]
+    ))
+    return users
+
+
+def _resolve_categories(records, categories):
+    """Add the Category of every name used by records to categories, creating missing ones."""
+    names = {record['category'][:100] for record in records if isinstance(record.get('category'), str)}
+    missing = names - set(categories)
+    for category in Category.objects.filter(name__in=missing).order_by('-pk'):
+        categories[category.name] = category
+    for name in sorted(missing - set(categories)):
+        categories[name] = Category.objects.create(name=name)
+
+
+def _insert(records, owner, keep_users, categories, names):
+    """
+    Create the documents of records, with their versions and comments, in
+    one transaction. Returns the documents, in the order of records.
+    """
+    users = _resolve_users([record for record, contents in records], owner, keep_users)
+    _resolve_categories([record for record, contents in records], categories)
+    importer.add_references(Counter(names[metadata['sha256']] for record, contents in records for metadata in contents))
+
+    documents = Document.objects.bulk_create([
+        Document(
+            title=record['title'][:200],
+            description=str(record.get('description') or ''),
+            file=names[contents[0]['sha256']],
+            category=categories.get(str(record.get('category'))[:100]) if record.get('category') else None,
+            owner=users[record.get('owner')],
+            is_private=bool(record.get('is_private')),
+            is_archived=bool(record.get('is_archived')),
+            archived_at=_datetime(record.get('archived_at')),
+            current_version=record.get('current_version') or max(len(contents) - 1, 1),
+            **contents[0],
+        )
+        for record, contents in records
+    ])
+    # bulk_create sets auto_now_add fields to now, put back the original times
+    for document, (record, contents) in zip(documents, records):
+        document.uploaded_at = _datetime(record.get('uploaded_at')) or document.uploaded_at
+    Document.objects.bulk_update(documents, ['uploaded_at'])
+
+    versions = []
+    comments = []
+    for document, (record, contents) in zip(documents, records):
+        for version, metadata in zip(record.get('versions') or [], contents[1:]):
+            versions.append((version, DocumentVersion(
+                document=document,
+                file=names[metadata['sha256']],
+                version_number=version.get('version_number') or 1,
+                created_by=users[version.get('created_by')],
+                comment=str(version.get('comment') or ''),
+                **metadata,
+            )))
+        for comment in record.get('comments') or []:
+            if isinstance(comment, dict) and comment.get('text'):
+                comments.append((comment, Comment(
+                    document=document, user=users[comment.get('user')], text=str(comment['text'])
+                )))
+    DocumentVersion.objects.bulk_create([version for entry, version in versions])
+    for entry, version in versions:
+        version.created_at = _datetime(entry.get('created_at')) or version.created_at
+    DocumentVersion.objects.bulk_update([version for entry, version in versions], ['created_at'])
+    Comment.objects.bulk_create([comment for entry, comment in comments])
+    for entry, comment in comments:
+        comment.created_at = _datetime(entry.get('created_at')) or comment.created_at
+    Comment.objects.bulk_update([comment for entry, comment in comments], ['created_at'])
+
+    # What the post_save handlers would have done for the new rows
+    analytics.record_new_documents(documents, [version for entry, version in versions])
+    search.index_documents(documents)
+    typeahead.invalidate()
+    latest = {}
+    for entry, version in versions:
+        extraction.schedule(version)
+        thumbnails.schedule(version)
+        if version.version_number > latest.get(version.document_id, (0, None))[0]:
+            latest[version.document_id] = (version.version_number, version)
+    for version_number, version in latest.values():
+        if version_number > 1:
+            delta.schedule(version)
+    return documents
+
+
+def _result(record, status, document=None, error=''):
+    name = record.get('title') if isinstance(record, dict) else None
+    return {'name': name or '(untitled)', 'status': status, 'document': document, 'error': error}
+
+
+def _import_batch(archive, batch, owner, keep_users, categories, executor, storage):
+    results = [None] * len(batch)
+    pending = []
+    for index, (number, record) in enumerate(batch):
+        outcome = record if isinstance(record, Exception) else _outcome(_contents, record)
+        if isinstance(outcome, Exception):
+            results[index] = _result(record, 'failed', error=importer.error_message(outcome))
+        else:
+            pending.append((index, record, outcome))
+
+    # Hash every file the batch uses once, reading it out of the archive
+    paths = list({content['path'] for index, record, contents in pending for content in contents})
+    hashes = dict(zip(paths, executor.map(lambda path: _outcome(_hash_member, archive, path), paths)))
+
+    described = []
+    for index, record, contents in pending:
+        metadata = []
+        for content in contents:
+            outcome = hashes[content['path']]
+            if not isinstance(outcome, Exception) and content.get('sha256') not in (None, '', outcome[0]):
+                outcome = ArchiveError(f"{content['path']} does not match its SHA-256")
+            if not isinstance(outcome, Exception):
+                outcome = _outcome(_metadata, content, *outcome)
+            if isinstance(outcome, Exception):
+                results[index] = _result(record, 'failed', error=importer.error_message(outcome))
+                break
+            metadata.append(outcome)
+        else:
+            described.append((index, record, contents, metadata))
+
+    if described:
+        # Write each content the blob store doesn't hold yet, once
+        stored = set(Blob.objects.filter(
+            sha256__in={item['sha256'] for *_, metadata in described for item in metadata}
+        ).values_list('sha256', flat=True))
+        new = {}
+        for index, record, contents, metadata in described:
+            for content, item in zip(contents, metadata):
+                if item['sha256'] not in stored and item['sha256'] not in new:
+                    new[item['sha256']] = (content['path'], item)
+        writes = [
+            (sha256, item, executor.submit(
+                _write_member, archive, path, storage, sha256, item['extension'], item['size_bytes']
+            ))
+            for sha256, (path, item) in new.items()
+        ]
+        try:
+            written = {sha256: (future.result(), item['size_bytes']) for sha256, item, future in writes}
+            with transaction.atomic():
+                # Another import may have stored some of this content meanwhile
+                Blob.objects.bulk_create([
+                    Blob(sha256=sha256, name=name, size_bytes=size) for sha256, (name, size) in written.items()
+                ], ignore_conflicts=True)
+                names = dict(Blob.objects.filter(
+                    sha256__in={item['sha256'] for *_, metadata in described for item in metadata}
+                ).values_list('sha256', 'name'))
+                documents = _insert(
+                    [(record, metadata) for index, record, contents, metadata in described],
+                    owner, keep_users, categories, names,
+                )
+        except Exception as e:
+            logger.exception('Archive import of %s documents failed', len(described))
+            for sha256, item, future in writes:
+                if future.exception() is None:
+                    storage.delete(future.result())
+            for index, record, contents, metadata in described:
+                results[index] = _result(record, 'failed', error=importer.error_message(e))
+        else:
+            for sha256, (name, size) in written.items():
+                if names[sha256] != name:
+                    storage.delete(name)
+            for (index, record, contents, metadata), document in zip(described, documents):
+                results[index] = _result(record, 'imported', document=document.pk)
+    return results
+
+
+def import_archive(file, owner, keep_users=False, batch_size=None, workers=None):
+    """
+    Import the documents in the archive file, a path or file object, yielding
+    a result per document as its batch finishes. Documents are owned by
+    owner, and versions and comments attributed to them; with keep_users,
+    users that exist here with the archive's usernames are kept instead.
+    Raises ArchiveError if file isn't an archive.
+    """
+    batch_size = batch_size or getattr(settings, 'IMPORT_BATCH_SIZE', importer.DEFAULT_BATCH_SIZE)
+    workers = workers or getattr(settings, 'IMPORT_WORKERS', importer.DEFAULT_WORKERS)
+    storage = Document._meta.get_field('file').storage
+    categories = {}
+    try:
+        with zipfile.ZipFile(file) as archive:
+            if MANIFEST_NAME not in archive.NameToInfo:
+                raise ArchiveError('Not a documents archive')
+            with archive.open(MANIFEST_NAME) as manifest, \
+                    ThreadPoolExecutor(max_workers=workers, thread_name_prefix='archive-import') as executor:
+                records = _read_manifest(manifest)
+                while True:
+                    batch = list(itertools.islice(records, batch_size))
+                    if not batch:
+                        break
+                    yield from _import_batch(archive, batch, owner, keep_users, categories, executor, storage)
+    except zipfile.BadZipFile as e:
+        raise ArchiveError(f'Not a documents archive: {e}')
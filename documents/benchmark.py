@@ -0,0 +1,216 @@
+"""
+Synthetic data seeding and view benchmarking used by the benchmark_views
+management command.
+
+seed() bulk-creates a dataset of a given size and run_benchmark() requests every
+URL in documents/urls.py through the Django test client, reporting latency
+percentiles and query counts so the scaling of each view can be compared
+across dataset sizes and releases.
+"""
+import hashlib
+import io
+import math
+import time
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+
+from . import analytics, search, thumbnails, typeahead, uploads
+from .models import (
+    Blob, Category, Comment, Document, DocumentShare, DocumentVersion, Notification, UserProfile
+)
+from .urls import urlpatterns
+
+BATCH_SIZE = 1000
+SAMPLE_CONTENT = b'%PDF-1.4\n% benchmark sample document\n'
+
+# Which seeded object each URL parameter refers to, per URL name
+URL_PARAMETERS = {
+    'edit_category': {'pk': 'category'},
+    'delete_category': {'pk': 'category'},
+    'mark_notification_read': {'pk': 'notification'},
+    'upload_session': {'pk': 'upload_session'},
+    'complete_upload_session': {'pk': 'upload_session'},
+}
+DEFAULT_PARAMETERS = {
+    'pk': 'document',
+    'document_pk': 'document',
+    'comment_pk': 'comment',
+    'token': 'share',
+    'version_number': 'version_number',
+    'sha256': 'image_sha256',
+    'size': 'thumbnail_size',
+}
+
+
+def sample_image():
+    """A small PNG for the thumbnail URL."""
+    output = io.BytesIO()
+    Image.new('RGB', (640, 480), (40, 120, 200)).save(output, 'PNG')
+    return output.getvalue()
+
+
+def _batched(objects):
+    for start in range(0, len(objects), BATCH_SIZE):
+        yield objects[start:start + BATCH_SIZE]
+
+
+def seed(documents=1000, users=None, categories=20):
+    """
+    Bulk-create a synthetic dataset. Every document points at the same small
+    sample file. Returns the objects the benchmark requests URLs for.
+    """
+    users = users or max(documents // 100, 2)
+    password = make_password(None)
+
+    user_objects = User.objects.bulk_create(
+        [User(username=f'bench_user_{i}', password=password) for i in range(users)],
+        batch_size=BATCH_SIZE,
+    )
+    UserProfile.objects.bulk_create(
+        [UserProfile(user=user, role='member') for user in user_objects],
+        batch_size=BATCH_SIZE,
+    )
+    category_objects = Category.objects.bulk_create(
+        [Category(name=f'Category {i}', description='Benchmark category') for i in range(categories)]
+    )
+
+    metadata = {
+        'size_bytes': len(SAMPLE_CONTENT),
+        'extension': '.pdf',
+        'mime_type': 'application/pdf',
+        'sha256': hashlib.sha256(SAMPLE_CONTENT).hexdigest(),
+        'original_filename': 'benchmark_sample.pdf',
+    }
+    file_name = Blob.objects.store(
+        ContentFile(SAMPLE_CONTENT), metadata['sha256'], '.pdf', default_storage
+    )
+
+    document_objects = []
+    for batch in _batched(range(documents)):
+        document_objects.extend(Document.objects.bulk_create([
+            Document(
+                title=f'Benchmark Document {i}',
+                description=f'Synthetic document number {i} for benchmarking',
+                file=file_name,
+                category=category_objects[i % categories],
+                owner=user_objects[i % users],
+                is_private=i % 5 == 0,
+                is_archived=i % 10 == 0,
+                **metadata
+            )
+            for i in batch
+        ]))
+
+    for batch in _batched(document_objects):
+        DocumentVersion.objects.bulk_create([
+            DocumentVersion(
+                document=document, file=file_name, version_number=1,
+                created_by=document.owner, comment='Initial version', **metadata
+            )
+            for document in batch
+        ])
+        DocumentShare.objects.bulk_create([
+            DocumentShare(document=document, shared_by=document.owner)
+            for document in batch[::10]
+        ])
+        Comment.objects.bulk_create([
+            Comment(document=document, user=user_objects[(i + 1) % users], text='Benchmark comment')
+            for i, document in enumerate(batch[::2])
+        ])
+        Notification.objects.bulk_create([
+            Notification(
+                user=document.owner, document=document, notification_type='upload',
+                message=f"You uploaded a new document: '{document.title}'"
+            )
+            for document in batch
+        ])
+
+    # Every document and version references the sample blob
+    Blob.objects.filter(name=file_name).update(ref_count=2 * len(document_objects))
+    
+    # bulk_create skips the signals that maintain the analytics and search tables
+    analytics.rebuild()
+    analytics.rebuild_daily_activity()
+    search.rebuild_index()
+    typeahead.invalidate()
+
+    # Benchmark as the owner of an active document, with full permissions
+    document = Document.objects.filter(is_archived=False).select_related('owner').first()
+    user = document.owner
+    UserProfile.objects.filter(user=user).update(role='admin')
+    comment = Comment.objects.create(document=document, user=user, text='Benchmark comment')
+    # One public document is an image, for the thumbnail URL
+    image = Document.objects.filter(is_archived=False, is_private=False).exclude(pk=document.pk).first()
+    image.file = ContentFile(sample_image(), name='benchmark_image.png')
+    image.save()
+    thumbnails.render(image.file.storage, image.file.name, image.sha256)
+    return {
+        'user': user,
+        'document': document.pk,
+        'category': category_objects[0].pk,
+        'comment': comment.pk,
+        'version_number': 1,
+        'notification': Notification.objects.filter(user=user).first().pk,
+        'share': DocumentShare.objects.create(document=document, shared_by=user).token,
+        'upload_session': uploads.create_session(user, 'benchmark.pdf', 1024).pk,
+        'image_sha256': image.sha256,
+        'thumbnail_size': 'small',
+    }
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = max(math.ceil(pct / 100 * len(ordered)) - 1, 0)
+    return ordered[index]
+
+
+def benchmark_urls(fixtures):
+    """Yield (name, url) for every named URL in documents/urls.py."""
+    for pattern in urlpatterns:
+        mapping = URL_PARAMETERS.get(pattern.name, {})
+        kwargs = {
+            parameter: fixtures[mapping.get(parameter, DEFAULT_PARAMETERS[parameter])]
+            for parameter in pattern.pattern.converters
+        }
+        yield pattern.name, reverse(pattern.name, kwargs=kwargs)
+
+
+def run_benchmark(fixtures, iterations=20, clear_cache=False):
+    """
+    Request every URL iterations times as the benchmark user after one
+    warm-up request. Returns a report dict keyed by URL name.
+    """
+    client = Client()
+    client.force_login(fixtures['user'])
+    report = {}
+
+    for name, url in benchmark_urls(fixtures):
+        timings = []
+        queries = []
+        client.get(url)
+        for _ in range(iterations):
+            if clear_cache:
+                cache.clear()
+            with CaptureQueriesContext(connection) as captured:
+                start = time.perf_counter()
+                response = client.get(url)
+                timings.append((time.perf_counter() - start) * 1000)
+            queries.append(len(captured))
+
+        report[name] = {
+            'url': url,
+            'status': response.status_code,
+            'p50_ms': round(percentile(timings, 50), 2),
+            'p95_ms': round(percentile(timings, 95), 2),
+            'queries': max(queries),
+        }
+    return report
@@ -0,0 +1,377 @@
+"""
+Delta storage for older document versions.
+
+Once a newer version of a document exists, pack_version() splits the older
+version's file into content-defined chunks and stores each chunk as a
+content-addressed Blob, so only chunks that aren't stored already (usually
+by the document's other versions) take up space. The version's full file is
+then released. Chunk boundaries are found with a Gear rolling hash over the
+content, so an edit only changes the chunks around it and the rest line up
+with the previous version's.
+
+open_version() reads a version from its file or, once packed, from its
+chunks, as a seekable file object that can be streamed for download.
+storage_report() gives the bytes saved per document.
+
+Packing runs after the new version's transaction commits, on a background
+thread unless VERSION_DELTA_BACKGROUND is off, and only when
+VERSION_DELTA_STORAGE is enabled, which it isn't by default, or as a
+pack_versions job with JOB_QUEUE_ENABLED. Chunks are written to storage
+before the transaction starts, CHUNK_BATCH_SIZE at a time with bulk queries;
+only recording them and releasing the file is transactional, and chunks
+left unrecorded by a failure are deleted. A version that fails is logged
+and skipped. The pack_versions management command packs existing history
+and prints the report.
+"""
+import hashlib
+import itertools
+import logging
+import random
+import threading
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, connection, transaction
+
+from . import jobs, tiering
+from .models import Blob, DocumentVersion, VersionChunk, blob_name
+
+logger = logging.getLogger(__name__)
+
+MIN_CHUNK_SIZE = 2 * 1024
+MAX_CHUNK_SIZE = 64 * 1024
+# Cut where the top 13 bits of the hash are zero, about every 8 KiB
+CUT_MASK = 0x1FFF << 51
+HASH_MASK = (1 << 64) - 1
+READ_SIZE = 1024 * 1024
+# Chunks stored and referenced together by pack_version()
+CHUNK_BATCH_SIZE = 500
+
+
+def _gear_table():
+    rng = random.Random(0x67656172)
+    return tuple(rng.getrandbits(64) for _ in range(256))
+
+
+# A random value per byte, from a fixed seed so boundaries never change
+GEAR = _gear_table()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _cut_point(data, start):
+    """
+    Return the end of the chunk starting at start in data, or None if data
+    ends before a boundary and more input is needed.
+    """
+    end = min(len(data), start + MAX_CHUNK_SIZE)
+    gear = GEAR
+    h = 0
+    # Bytes before the minimum size can't end a chunk, so aren't hashed
+    for i in range(start + MIN_CHUNK_SIZE, end):
+        h = ((h << 1) + gear[data[i]]) & HASH_MASK
+        if not h & CUT_MASK:
+            return i + 1
+    if end - start == MAX_CHUNK_SIZE:
+        return end
+    return None
+
+
+def iter_chunks(file):
+    """Yield the content-defined chunks of file, reading it in blocks."""
+    buffer = b''
+    for block in iter(lambda: file.read(READ_SIZE), b''):
+        buffer += block
+        start = 0
+        while True:
+            cut = _cut_point(buffer, start)
+            if cut is None:
+                break
+            yield buffer[start:cut]
+            start = cut
+        buffer = buffer[start:]
+    if buffer:
+        yield buffer
+
+
+class ChunkedFile:
+    """Read-only, seekable file object over a packed version's chunks."""
+    def __init__(self, storage, chunks):
+        self.storage = storage
+        self.names = [name for name, size in chunks]
+        self.offsets = []
+        self.size = 0
+        for name, size in chunks:
+            self.offsets.append(self.size)
+            self.size += size
+        self.position = 0
+        self._index = None
+        self._data = b''
+
+    def _load(self, index):
+        if index != self._index:
+            with tiering.open_stored(self.storage, self.names[index]) as file:
+                self._data = file.read()
+            self._index = index
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        parts = []
+        while size > 0 and self.position < self.size:
+            index = bisect_right(self.offsets, self.position) - 1
+            self._load(index)
+            offset = self.position - self.offsets[index]
+            data = self._data[offset:offset + size]
+            if not data:
+                raise OSError(f'Chunk {self.names[index]} is shorter than recorded')
+            parts.append(data)
+            self.position += len(data)
+            size -= len(data)
+        return b''.join(parts)
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position')
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+    def close(self):
+        self._data = b''
+        self._index = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_version(version):
+    """Open version's content for reading, whether it is a file or packed."""
+    if version.file:
+        return tiering.open_stored(version.file.storage, version.file.name)
+    chunks = version.chunks.values_list('name', 'size_bytes')
+    return ChunkedFile(version.file.storage, list(chunks))
+
+
+def is_enabled():
+    return getattr(settings, 'VERSION_DELTA_STORAGE', False)
+
+
+def _packable(version):
+    """
+    Whether packing version would free its full file: it has one, is not
+    the latest version, and no other row uses its blob.
+    """
+    if version is None or not version.file:
+        return False
+    is_latest = not DocumentVersion.objects.filter(
+        document_id=version.document_id, version_number__gt=version.version_number
+    ).exists()
+    return not is_latest and Blob.objects.filter(name=version.file.name, ref_count=1).exists()
+
+
+def _write_chunks(version, storage, written):
+    """
+    Split version's file into chunks and write the ones no blob holds yet
+    to storage, adding their (name, size) to written by SHA-256. Runs outside
+    any transaction. Returns the file's SHA-256 and its (sha256, size)
+    chunks in order.
+    """
+    digest = hashlib.sha256()
+    chunks = []
+    with tiering.open_stored(storage, version.file.name) as file:
+        pieces = iter_chunks(file)
+        while True:
+            batch = [(hashlib.sha256(data).hexdigest(), data) for data in itertools.islice(pieces, CHUNK_BATCH_SIZE)]
+            if not batch:
+                break
+            stored = set(Blob.objects.filter(
+                sha256__in={sha256 for sha256, data in batch}
+            ).values_list('sha256', flat=True))
+            for sha256, data in batch:
+                digest.update(data)
+                chunks.append((sha256, len(data)))
+                if sha256 not in stored and sha256 not in written:
+                    written[sha256] = (storage.save(blob_name(sha256, ''), ContentFile(data)), len(data))
+    return digest.hexdigest(), chunks
+
+
+def _reference_chunks(version, chunks, written):
+    """
+    Record version's chunks, CHUNK_BATCH_SIZE at a time: create the blobs of
+    the chunks written for it, add a reference to each chunk's blob and
+    insert the VersionChunk rows. Returns the names of the blobs by SHA-256.
+    """
+    names = {}
+    for start in range(0, len(chunks), CHUNK_BATCH_SIZE):
+        batch = chunks[start:start + CHUNK_BATCH_SIZE]
+        hashes = {sha256 for sha256, size in batch}
+        # Locked like in Blob.objects.store(), until the references are counted
+        list(Blob.objects.select_for_update().filter(sha256__in=hashes).values_list('pk'))
+        Blob.objects.bulk_create([
+            Blob(sha256=sha256, name=written[sha256][0], size_bytes=written[sha256][1])
+            for sha256 in hashes if sha256 in written
+        ], ignore_conflicts=True)
+        names.update(Blob.objects.filter(sha256__in=hashes).values_list('sha256', 'name'))
+        if not hashes <= set(names):
+            # A blob found stored while chunking was deleted since
+            raise ValueError(f'Chunks of version {version.pk} were deleted while it was packed')
+        Blob.objects.add_references(Counter(names[sha256] for sha256, size in batch))
+        VersionChunk.objects.bulk_create([
+            VersionChunk(version=version, position=start + offset, name=names[sha256], size_bytes=size)
+            for offset, (sha256, size) in enumerate(batch)
+        ])
+    return names
+
+
+def pack_version(version_id):
+    """
+    Store an older version as chunks and release its full file. Returns the
+    number of bytes written for new chunks, or None if the version was not
+    packed: it is the latest version, is packed already, or its file is
+    used elsewhere or outside the blob store, so releasing it would free
+    nothing. Raises ValueError if its file doesn't match its recorded hash.
+
+    The file is read and its new chunks written to storage outside any
+    transaction; only recording the chunks and swapping the version's file
+    for them is atomic. Chunk files that end up unused are deleted.
+    """
+    version = DocumentVersion.objects.filter(pk=version_id).first()
+    if not _packable(version):
+        return None
+    storage = version.file.storage
+    file_name = version.file.name
+    written = {}
+    names = None
+    try:
+        sha256, chunks = _write_chunks(version, storage, written)
+        if version.sha256 and sha256 != version.sha256:
+            # Stored file changed under the recorded hash, keep it as it is
+            raise ValueError(f'Version {version_id} does not match its recorded SHA-256')
+        with transaction.atomic():
+            version = DocumentVersion.objects.select_for_update().filter(pk=version_id).first()
+            if not _packable(version) or version.file.name != file_name:
+                # Packed or changed by someone else meanwhile
+                return None
+            recorded = _reference_chunks(version, chunks, written)
+            version.sha256 = sha256
+            version.file.name = ''
+            # Releases the full file
+            version.save(update_fields=['file', 'sha256'])
+        names = recorded
+    finally:
+        # Chunks not recorded, or stored concurrently under another name
+        unused = [name for chunk_sha256, (name, size) in written.items()
+                  if names is None or names.get(chunk_sha256) != name]
+        for name in unused:
+            storage.delete(name)
+    return sum(size for chunk_sha256, (name, size) in written.items() if names.get(chunk_sha256) == name)
+
+
+@jobs.task('pack_versions')
+def pack_document(document_id):
+    """
+    Pack every version of a document but the latest, logging the ones that
+    fail and carrying on. Returns the bytes written.
+    """
+    written = 0
+    versions = DocumentVersion.objects.filter(document_id=document_id).exclude(file='')
+    for version_id in versions.order_by('version_number').values_list('pk', flat=True):
+        try:
+            written += pack_version(version_id) or 0
+        except Exception:
+            logger.exception('Delta packing failed for version %s', version_id)
+    return written
+
+
+def storage_report(documents=None):
+    """
+    Return a dict per document with versioned files: its number of
+    versions, their total size (logical_bytes), the bytes their distinct
+    files and chunks occupy (stored_bytes) and the difference (saved_bytes).
+    """
+    versions = DocumentVersion.objects.all()
+    if documents is not None:
+        versions = versions.filter(document__in=documents)
+
+    logical = defaultdict(int)
+    counts = defaultdict(int)
+    stored = defaultdict(dict)
+    for document_id, name, size in versions.values_list('document_id', 'file', 'size_bytes').iterator():
+        logical[document_id] += size
+        counts[document_id] += 1
+        if name:
+            stored[document_id][name] = size
+    chunks = VersionChunk.objects.filter(version__in=versions).values_list(
+        'version__document_id', 'name', 'size_bytes'
+    )
+    for document_id, name, size in chunks.iterator():
+        stored[document_id][name] = size
+
+    report = []
+    for document_id in sorted(logical):
+        stored_bytes = sum(stored[document_id].values())
+        report.append({
+            'document': document_id,
+            'versions': counts[document_id],
+            'logical_bytes': logical[document_id],
+            'stored_bytes': stored_bytes,
+            'saved_bytes': logical[document_id] - stored_bytes,
+        })
+    return report
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='version-delta')
+    return _executor
+
+
+def _pack_in_background(document_id):
+    close_old_connections()
+    try:
+        pack_document(document_id)
+    except Exception:
+        logger.exception('Delta packing failed for document %s', document_id)
+    finally:
+        connection.close()
+
+
+def _dispatch(document_id):
+    if getattr(settings, 'VERSION_DELTA_BACKGROUND', True):
+        _get_executor().submit(_pack_in_background, document_id)
+    else:
+        pack_document(document_id)
+
+
+def schedule(version):
+    """Pack the older versions of version's document once the transaction commits."""
+    if not is_enabled():
+        return
+    document_id = version.document_id
+    if jobs.is_enabled():
+        # Saves space but nobody waits for it
+        jobs.enqueue('pack_versions', priority=-10, document_id=document_id)
+    else:
+        transaction.on_commit(lambda: _dispatch(document_id))
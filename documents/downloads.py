@@ -0,0 +1,198 @@
+"""
+Streaming file downloads with HTTP range and conditional request support.
+
+serve_file() streams a stored file in fixed-size chunks instead of loading it
+into the response, answers single-range requests with 206 Partial Content so
+downloads can be resumed and PDFs seeked, and sends ETag and Last-Modified so
+clients can revalidate with If-None-Match / If-Modified-Since and get a 304.
+
+With MEDIA_SERVING_BACKEND set to 'x-accel-redirect' (nginx) or 'x-sendfile'
+(Apache, lighttpd), serve_file() only checks the file is in hot storage and
+returns an empty response whose header tells the web server which file to
+send, so the worker is free again as soon as access has been checked.
+"""
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date
+
+from . import tiering
+
+CHUNK_SIZE = 64 * 1024
+
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class FileRange:
+    """Iterates over length bytes of file from start, closing it when done."""
+    def __init__(self, file, start, length, chunk_size=CHUNK_SIZE):
+        self.file = file
+        self.start = start
+        self.remaining = length
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        self.file.seek(self.start)
+        while self.remaining > 0:
+            chunk = self.file.read(min(self.chunk_size, self.remaining))
+            if not chunk:
+                break
+            self.remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+def parse_range(header, size):
+    """
+    Return the (start, end) byte positions, inclusive, of a single-range
+    Range header, or None if the whole file should be sent. Multiple ranges
+    and malformed headers are ignored, as RFC 9110 allows. The returned
+    range may be unsatisfiable, with start >= size.
+    """
+    match = _RANGE.match(header.strip()) if header else None
+    if not match:
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = min(int(last), size - 1) if last else size - 1
+    elif last:
+        # Suffix range: the final N bytes
+        start = max(size - int(last), 0) if int(last) else size
+        end = size - 1
+    else:
+        return None
+    return start, end
+
+
+def file_etag(size, modified, sha256=''):
+    if sha256:
+        return f'"{sha256}"'
+    # Files stored before hashes were recorded
+    return f'"{size:x}-{int(modified.timestamp() * 1000000):x}"'
+
+
+def starts_download(request):
+    """Whether request reads the file from the start, rather than resuming or seeking."""
+    match = _RANGE.match(request.headers.get('Range', '').strip())
+    return not match or match.group(1) == '0'
+
+
+def offload_file(request, storage, name, filename, content_type=None, as_attachment=True):
+    """
+    Return a response handing the transfer of the stored file called name
+    to the web server, or None if it must be streamed from Python: the
+    backend is 'python', the storage has no local paths or the file is not
+    in hot storage. The web server handles Range and conditional requests.
+    """
+    backend = getattr(settings, 'MEDIA_SERVING_BACKEND', 'python')
+    if backend == 'python':
+        return None
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        return None
+    if not os.path.isfile(path):
+        return None
+
+    response = HttpResponse(content_type=content_type or 'application/octet-stream')
+    if backend == 'x-accel-redirect':
+        prefix = getattr(settings, 'MEDIA_ACCEL_REDIRECT_PREFIX', '/protected-media/')
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + quote(name)
+    elif backend == 'x-sendfile':
+        response['X-Sendfile'] = path
+    else:
+        raise ImproperlyConfigured(f'Unknown MEDIA_SERVING_BACKEND {backend!r}')
+    response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+    return response
+
+
+def serve_file(request, field_file, filename=None, content_type=None, as_attachment=True,
+               sha256='', on_download=None):
+    """
+    Return a streaming response for field_file honouring Range, If-Range,
+    If-None-Match and If-Modified-Since. on_download is called once for
+    requests that start a download, that is full or from-zero responses,
+    so resumed and seeking requests are not counted again.
+    """
+    return serve_stored(
+        request, field_file.storage, field_file.name, filename=filename, content_type=content_type,
+        as_attachment=as_attachment, sha256=sha256, on_download=on_download,
+    )
+
+
+def serve_stored(request, storage, name, filename=None, content_type=None, as_attachment=True,
+                 sha256='', on_download=None):
+    """serve_file() for the file called name in storage."""
+    filename = filename or name.split('/')[-1]
+    response = offload_file(request, storage, name, filename, content_type, as_attachment)
+    if response is not None:
+        if on_download and starts_download(request):
+            on_download()
+        return response
+    try:
+        # Archived files may have moved to the compressed cold tier
+        file = tiering.open_stored(storage, name)
+    except FileNotFoundError:
+        raise Http404('File not found')
+    return serve_open_file(
+        request, file, tiering.modified_time(storage, name), filename, content_type=content_type,
+        as_attachment=as_attachment, sha256=sha256, on_download=on_download,
+    )
+
+
+def serve_open_file(request, file, modified, filename, content_type=None, as_attachment=True,
+                    sha256='', on_download=None):
+    """
+    Like serve_file() for a file that is already open, such as a version
+    read back from delta storage. file needs size, seek(), read() and
+    close(), and is closed when the response is done.
+    """
+    size = file.size
+    last_modified = int(modified.timestamp())
+    etag = file_etag(size, modified, sha256)
+
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        file.close()
+        return not_modified
+
+    byte_range = parse_range(request.headers.get('Range'), size)
+    if_range = request.headers.get('If-Range')
+    if byte_range and if_range and if_range not in (etag, http_date(last_modified)):
+        # The client's partial copy is stale, send the whole file
+        byte_range = None
+
+    if byte_range and byte_range[0] >= size:
+        file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    start, end = byte_range or (0, size - 1)
+    length = max(end - start + 1, 0)
+    response = StreamingHttpResponse(
+        FileRange(file, start, length),
+        status=206 if byte_range else 200,
+        content_type=content_type or 'application/octet-stream',
+    )
+    response['Content-Length'] = str(length)
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    if byte_range:
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Disposition'] = content_disposition_header(as_attachment, filename)
+
+    if on_download and start == 0:
+        on_download()
+    return response
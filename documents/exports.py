@@ -0,0 +1,91 @@
+"""
+Streaming ZIP export.
+
+stream_zip() writes the archive through zipfile into a buffer that is emptied
+after every chunk, yielding the bytes as it goes. Sent with a
+StreamingHttpResponse, an export of any size needs memory for one chunk at a
+time. Files that are already compressed are stored instead of being deflated
+again.
+"""
+import os
+import zipfile
+
+from django.utils import timezone
+
+from . import filetypes, tiering
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ChunkBuffer:
+    """Write-only, unseekable file object whose contents are taken with pop()."""
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def unique_name(name, used):
+    """
+    Return name, or name with a " (2)", " (3)"... suffix if it is already in
+    used, and record it. Names are compared case-insensitively, since
+    archives are often extracted onto case-insensitive file systems.
+    """
+    candidate = name
+    root, ext = os.path.splitext(name)
+    counter = 2
+    while candidate.lower() in used:
+        candidate = f'{root} ({counter}){ext}'
+        counter += 1
+    used.add(candidate.lower())
+    return candidate
+
+
+def write_entry(archive, buffer, name, source, modified):
+    """
+    Write the file object source into archive as name, yielding the bytes
+    that reach buffer as it goes.
+    """
+    info = zipfile.ZipInfo(name, timezone.localtime(modified).timetuple()[:6])
+    if os.path.splitext(name)[1].lower() in filetypes.COMPRESSED_EXTENSIONS:
+        info.compress_type = zipfile.ZIP_STORED
+    else:
+        info.compress_type = zipfile.ZIP_DEFLATED
+    # The size decides up front whether the entry needs ZIP64 fields
+    info.file_size = source.size
+    with archive.open(info, 'w') as entry:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            entry.write(chunk)
+            data = buffer.pop()
+            if data:
+                yield data
+
+
+def stream_zip(documents):
+    """
+    Yield a ZIP archive of the documents' files, each under its original
+    file name. Files missing from storage are skipped.
+    """
+    buffer = ChunkBuffer()
+    used = set()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for document in documents:
+            try:
+                source = tiering.open_stored(document.file.storage, document.file.name)
+            except FileNotFoundError:
+                continue
+            with source:
+                name = unique_name(document.get_filename(), used)
+                yield from write_entry(archive, buffer, name, source, document.uploaded_at)
+    # The end of each entry and the central directory, written on close
+    yield buffer.pop()
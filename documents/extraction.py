@@ -0,0 +1,355 @@
+"""
+Text extraction from uploaded files.
+
+The plain text of each DocumentVersion's file is stored in extracted_text and
+the latest version's text is included in the full-text search index. DOCX and
+XLSX files are zip containers whose XML parts are parsed incrementally with
+iterparse, and PDFs are read in chunks, decompressing their content streams
+and decoding the strings shown by text operators. Output is capped at
+TEXT_EXTRACTION_MAX_CHARS, so memory per file stays bounded however large the
+upload is.
+
+Extraction is scheduled when a version is created and runs after the
+transaction commits, on a small background thread pool, so it never holds up
+the upload request. Versions left pending, for example by a restart, are
+picked up by the extract_text management command. With JOB_QUEUE_ENABLED it
+runs as an extract_text job instead.
+"""
+import logging
+import os
+import re
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree import ElementTree
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+from . import delta, jobs, search
+from .models import DocumentVersion
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_CHARS = 1_000_000
+CHUNK_SIZE = 1024 * 1024
+# Decompressed bytes kept from a single PDF content stream
+MAX_STREAM_BYTES = 16 * 1024 * 1024
+# Bytes before a PDF "stream" keyword searched for its dictionary
+DICT_LOOKBACK = 2048
+
+WORD_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+SHEET_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+class TextBuffer:
+    """Collects extracted text up to a character limit."""
+    def __init__(self, limit):
+        self.parts = []
+        self.remaining = limit
+
+    @property
+    def full(self):
+        return self.remaining <= 0
+
+    def write(self, text):
+        if text and not self.full:
+            text = text[:self.remaining]
+            self.parts.append(text)
+            self.remaining -= len(text)
+
+    def getvalue(self):
+        return ''.join(self.parts)
+
+
+def iter_elements(part, tags):
+    """
+    Yield each element of an XML part whose tag is in tags once it is
+    complete, with its children, then detach it from its parent. Other
+    elements are detached as soon as they end unless they are inside one
+    being yielded, so only the open elements stay in the tree however large
+    the part is.
+    """
+    parents = []
+    open_tagged = 0
+    for event, element in ElementTree.iterparse(part, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            if element.tag in tags:
+                open_tagged += 1
+            continue
+        parents.pop()
+        if element.tag in tags:
+            open_tagged -= 1
+            yield element
+        elif open_tagged:
+            # Still needed by the enclosing element
+            continue
+        if parents:
+            parents[-1].remove(element)
+
+
+def extract_docx(file, output):
+    tags = {WORD_NS + 't', WORD_NS + 'tab', WORD_NS + 'p'}
+    with zipfile.ZipFile(file) as archive, archive.open('word/document.xml') as part:
+        for element in iter_elements(part, tags):
+            if element.tag == WORD_NS + 't':
+                output.write(element.text)
+            elif element.tag == WORD_NS + 'tab':
+                output.write('\t')
+            else:
+                output.write('\n')
+            if output.full:
+                return
+
+
+def _sheet_number(name):
+    match = re.search(r'(\d+)\.xml$', name)
+    return int(match.group(1)) if match else 0
+
+
+def _cell_text(cell, shared_strings):
+    cell_type = cell.get('t')
+    if cell_type == 'inlineStr':
+        inline = cell.find(SHEET_NS + 'is')
+        return ''.join(inline.itertext()) if inline is not None else ''
+    value = cell.find(SHEET_NS + 'v')
+    if value is None or value.text is None:
+        return ''
+    if cell_type == 's':
+        try:
+            return shared_strings[int(value.text)]
+        except (IndexError, ValueError):
+            return ''
+    return value.text
+
+
+def extract_xlsx(file, output):
+    with zipfile.ZipFile(file) as archive:
+        names = archive.namelist()
+
+        # Cells refer to strings by index, keep them but no more text than the
+        # cap; strings past it are never read and cells using them are empty
+        shared_strings = []
+        budget = output.remaining
+        if 'xl/sharedStrings.xml' in names and budget > 0:
+            with archive.open('xl/sharedStrings.xml') as part:
+                for element in iter_elements(part, {SHEET_NS + 'si'}):
+                    text = ''.join(element.itertext())[:budget]
+                    budget -= len(text)
+                    shared_strings.append(text)
+                    if budget <= 0:
+                        break
+
+        sheets = sorted(
+            (name for name in names if name.startswith('xl/worksheets/sheet') and name.endswith('.xml')),
+            key=_sheet_number
+        )
+        for name in sheets:
+            with archive.open(name) as part:
+                for element in iter_elements(part, {SHEET_NS + 'c', SHEET_NS + 'row'}):
+                    if element.tag == SHEET_NS + 'c':
+                        text = _cell_text(element, shared_strings)
+                        if text:
+                            output.write(text + ' ')
+                    else:
+                        output.write('\n')
+                    if output.full:
+                        return
+
+
+_STREAM_START = re.compile(rb'stream\r?\n')
+# Streams that never contain page text: images, fonts, cross-reference and
+# object streams, metadata, and encodings other than Flate
+_SKIP_STREAM = re.compile(
+    rb'/Subtype\s*/Image|/Length[123]\b|/Type\s*/(?:XRef|ObjStm|Metadata|EmbeddedFile)'
+    rb'|/(?:DCT|JPX|CCITTFax|JBIG2|LZW|RunLength|ASCII85|ASCIIHex)Decode'
+)
+_STRING = rb'\(((?:\\.|[^\\)])*)\)'
+_TEXT_OPERATOR = re.compile(
+    rb'\[((?:\\.|[^\\\]])*)\]\s*TJ'
+    rb'|' + _STRING + rb'\s*(?:Tj|\'|")'
+    rb'|(?<![\w*])(ET|T\*|Td|TD)(?![\w*])',
+    re.DOTALL
+)
+_ARRAY_ITEM = re.compile(_STRING + rb'|(-?\d+(?:\.\d+)?)', re.DOTALL)
+_ESCAPE = re.compile(rb'\\([nrtbf()\\]|[0-7]{1,3}|\r?\n)')
+_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+
+
+def _unescape(value):
+    def replace(match):
+        code = match.group(1)
+        if code in _ESCAPES:
+            return _ESCAPES[code]
+        if code[:1].isdigit():
+            return bytes([int(code, 8) & 0xFF])
+        if code.endswith(b'\n'):
+            # Escaped line break continues the string
+            return b''
+        return code
+    # Simple fonts use single-byte encodings close to Latin-1
+    return _ESCAPE.sub(replace, value).decode('latin-1')
+
+
+def _write_content_text(content, output):
+    for match in _TEXT_OPERATOR.finditer(content):
+        array, string, operator = match.groups()
+        if array is not None:
+            for item in _ARRAY_ITEM.finditer(array):
+                if item.group(1) is not None:
+                    output.write(_unescape(item.group(1)))
+                elif float(item.group(2)) <= -200:
+                    # A large negative adjustment is a gap between words
+                    output.write(' ')
+        elif string is not None:
+            output.write(_unescape(string) + ' ')
+        else:
+            output.write('\n' if operator == b'ET' else ' ')
+        if output.full:
+            return
+
+
+class _PDFStream:
+    """Decompresses one PDF stream, keeping at most MAX_STREAM_BYTES."""
+    def __init__(self, header):
+        start = header.rfind(b'obj')
+        header = header[start:] if start != -1 else header
+        self.skip = bool(_SKIP_STREAM.search(header))
+        self.decompressor = zlib.decompressobj() if b'/FlateDecode' in header else None
+        self.data = bytearray()
+
+    def feed(self, data):
+        room = MAX_STREAM_BYTES - len(self.data)
+        if self.skip or room <= 0 or not data:
+            return
+        if self.decompressor:
+            try:
+                data = self.decompressor.decompress(data, room)
+            except zlib.error:
+                self.skip = True
+                return
+        self.data += data[:room]
+
+
+def extract_pdf(file, output):
+    buffer = b''
+    stream = None
+    for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+        buffer += chunk
+        while True:
+            if stream is None:
+                match = _STREAM_START.search(buffer)
+                if not match:
+                    # Keep enough for a dictionary and a keyword split across chunks
+                    buffer = buffer[-DICT_LOOKBACK:]
+                    break
+                stream = _PDFStream(buffer[max(match.start() - DICT_LOOKBACK, 0):match.start()])
+                buffer = buffer[match.end():]
+            else:
+                end = buffer.find(b'endstream')
+                if end == -1:
+                    keep = len(b'endstream')
+                    stream.feed(buffer[:-keep])
+                    buffer = buffer[-keep:]
+                    break
+                stream.feed(buffer[:end])
+                buffer = buffer[end + len(b'endstream'):]
+                if not stream.skip and b'BT' in stream.data:
+                    _write_content_text(bytes(stream.data), output)
+                stream = None
+                if output.full:
+                    return
+
+
+EXTRACTORS = {
+    '.docx': extract_docx,
+    '.xlsx': extract_xlsx,
+    '.pdf': extract_pdf,
+}
+
+
+def extract_text(file, extension):
+    """
+    Return the text of an open binary file, or None if its type is not
+    supported. Raises ValueError and OSError subclasses for unreadable files.
+    """
+    extractor = EXTRACTORS.get(extension.lower())
+    if extractor is None:
+        return None
+    output = TextBuffer(getattr(settings, 'TEXT_EXTRACTION_MAX_CHARS', DEFAULT_MAX_CHARS))
+    extractor(file, output)
+    return output.getvalue()
+
+
+@jobs.task('extract_text')
+def extract_version(version_id):
+    """
+    Extract and store the text of one DocumentVersion and reindex its
+    document if it is the latest version. Returns the new text_status.
+    """
+    try:
+        version = DocumentVersion.objects.select_related('document').get(pk=version_id)
+    except DocumentVersion.DoesNotExist:
+        # Deleted before extraction ran
+        return None
+
+    extension = version.extension or os.path.splitext(version.file.name)[1]
+    try:
+        with delta.open_version(version) as file:
+            text = extract_text(file, extension)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile, ElementTree.ParseError) as e:
+        logger.warning('Text extraction failed for document version %s: %s', version_id, e)
+        text, status = '', 'failed'
+    else:
+        status = 'unsupported' if text is None else 'done'
+        text = text or ''
+
+    DocumentVersion.objects.filter(pk=version_id).update(extracted_text=text, text_status=status)
+    is_latest = not version.document.versions.filter(
+        version_number__gt=version.version_number
+    ).exists()
+    if is_latest:
+        search.index_document(version.document, file_text=text)
+    return status
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'TEXT_EXTRACTION_WORKERS', 1),
+                thread_name_prefix='text-extraction',
+            )
+    return _executor
+
+
+def _extract_in_background(version_id):
+    close_old_connections()
+    try:
+        extract_version(version_id)
+    except Exception:
+        logger.exception('Text extraction failed for document version %s', version_id)
+    finally:
+        # Worker threads keep their own connection, don't leave it open
+        connection.close()
+
+
+def _dispatch(version_id):
+    if getattr(settings, 'TEXT_EXTRACTION_BACKGROUND', True):
+        _get_executor().submit(_extract_in_background, version_id)
+    else:
+        extract_version(version_id)
+
+
+def schedule(version):
+    """Extract the text of version once the current transaction commits."""
+    if jobs.is_enabled():
+        jobs.enqueue('extract_text', version_id=version.pk)
+    else:
+        transaction.on_commit(lambda: _dispatch(version.pk))
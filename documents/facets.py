@@ -0,0 +1,132 @@
+"""
+Facet counts for filtered document listings.
+
+facet_counts() groups the filtered queryset once by every facet column
+together and rolls the combinations up into per-facet counts in Python, so
+the breakdown by category, file type, owner, visibility and upload year costs
+one query however many facet values there are. apply_facets() narrows a
+queryset by the facet values selected in the request's GET parameters.
+"""
+from collections import Counter
+
+from django.db.models import Count
+from django.db.models.functions import ExtractYear
+
+# GET parameter, grouped columns and label for each facet
+FACETS = {
+    'category': ('category__name', None),
+    'extension': ('extension', None),
+    'owner': ('owner_id', 'owner__username'),
+    'visibility': ('is_private', None),
+    'year': ('upload_year', None),
+}
+FACET_TITLES = {
+    'category': 'Category',
+    'extension': 'File type',
+    'owner': 'Owner',
+    'visibility': 'Visibility',
+    'year': 'Year uploaded',
+}
+
+
+def _visibility_lookup(value):
+    if value not in ('private', 'public'):
+        raise ValueError(value)
+    return {'is_private': value == 'private'}
+
+
+# Turn a selected GET value into filter() keyword arguments
+_LOOKUPS = {
+    'category': lambda value: {'category__name': value},
+    'extension': lambda value: {'extension': value},
+    'owner': lambda value: {'owner_id': int(value)},
+    'visibility': _visibility_lookup,
+    'year': lambda value: {'uploaded_at__year': int(value)},
+}
+
+
+def apply_facets(queryset, params):
+    """
+    Filter queryset by the facets selected in params (a QueryDict). Invalid
+    values are ignored. Returns (queryset, selected) where selected maps
+    facet names to the applied values.
+    """
+    selected = {}
+    for name, lookup in _LOOKUPS.items():
+        value = params.get(name, '')
+        if not value:
+            continue
+        try:
+            queryset = queryset.filter(**lookup(value))
+        except ValueError:
+            continue
+        selected[name] = value
+    return queryset, selected
+
+
+def _param_value(name, value):
+    if name == 'visibility':
+        return 'private' if value else 'public'
+    return '' if value is None else str(value)
+
+
+def _label(name, value, label):
+    if name == 'category':
+        return value or 'Uncategorized'
+    if name == 'extension':
+        return value or 'Unknown'
+    if name == 'visibility':
+        return 'Private' if value else 'Public'
+    return str(label if label is not None else value)
+
+
+def facet_counts(queryset, params):
+    """
+    Return the facets of queryset as a list of dicts with name, title and
+    values, each value having label, count, selected and the query string
+    that toggles it on or off. Runs a single grouped query.
+    """
+    columns = []
+    for column, label_column in FACETS.values():
+        columns.append(column)
+        if label_column:
+            columns.append(label_column)
+
+    rows = (
+        queryset.order_by()
+        .annotate(upload_year=ExtractYear('uploaded_at'))
+        .values(*columns)
+        .annotate(count=Count('id'))
+    )
+
+    counts = {name: Counter() for name in FACETS}
+    labels = {}
+    for row in rows:
+        for name, (column, label_column) in FACETS.items():
+            value = row[column]
+            counts[name][value] += row['count']
+            labels[name, value] = row[label_column] if label_column else None
+
+    facets = []
+    for name, counter in counts.items():
+        values = []
+        for value, count in counter.most_common():
+            param = _param_value(name, value)
+            selected = params.get(name, '') == param
+            query = None
+            if param:
+                toggled = params.copy()
+                toggled.pop('cursor', None)
+                if selected:
+                    toggled.pop(name, None)
+                else:
+                    toggled[name] = param
+                query = toggled.urlencode()
+            values.append({
+                'label': _label(name, value, labels[name, value]),
+                'count': count,
+                'selected': selected,
+                'query': query,
+            })
+        facets.append({'name': name, 'title': FACET_TITLES[name], 'values': values})
+    return facets
@@ -0,0 +1,86 @@
+"""
+File type detection from content.
+
+sniff() recognises a file's type from its first HEAD_SIZE bytes,
+mismatch() says whether that contradicts the file's extension and
+mime_type() gives the MIME type it implies. A file with one of the
+extensions in EXTENSION_TYPES must start with a signature its format
+allows, so content that isn't recognised at all, such as HTML or a script
+named report.pdf, is rejected like content recognised as something else.
+"""
+import os
+
+HEAD_SIZE = 16
+
+# Leading bytes, and the type and description of files starting with them
+SIGNATURES = (
+    (b'%PDF-', 'pdf', 'PDF document'),
+    (b'\x89PNG\r\n\x1a\n', 'png', 'PNG image'),
+    (b'\xff\xd8\xff', 'jpeg', 'JPEG image'),
+    (b'GIF87a', 'gif', 'GIF image'),
+    (b'GIF89a', 'gif', 'GIF image'),
+    # Word and Excel 2007+ files are ZIP packages, 97-2003 ones OLE2 compound files
+    (b'PK\x03\x04', 'zip', 'ZIP archive'),
+    (b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1', 'ole2', 'Office 97-2003 document'),
+    (b'MZ', 'exe', 'Windows executable'),
+    (b'\x7fELF', 'elf', 'Linux executable'),
+)
+
+# The detected types each allowed extension may have
+EXTENSION_TYPES = {
+    '.pdf': {'pdf'},
+    '.png': {'png'},
+    '.jpg': {'jpeg'},
+    '.jpeg': {'jpeg'},
+    '.docx': {'zip'},
+    '.xlsx': {'zip'},
+    '.doc': {'ole2'},
+    '.xls': {'ole2'},
+}
+
+# MIME types of the detected types that tell what a file is; ZIP and OLE2
+# containers hold several formats, which their extension tells apart
+MIME_TYPES = {
+    'pdf': 'application/pdf',
+    'png': 'image/png',
+    'jpeg': 'image/jpeg',
+    'gif': 'image/gif',
+}
+
+# Formats whose contents are already compressed
+COMPRESSED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.docx', '.xlsx'}
+
+
+def sniff(head):
+    """Return the type of a file starting with head, or None if it isn't recognised."""
+    for signature, file_type, description in SIGNATURES:
+        if head.startswith(signature):
+            return file_type
+    return None
+
+
+def describe(file_type):
+    for signature, known_type, description in SIGNATURES:
+        if known_type == file_type:
+            return description
+    return file_type
+
+
+def mismatch(filename, file_type):
+    """
+    Return why a file called filename whose content was detected as
+    file_type, None if unrecognised, must be rejected, or None if its
+    content is one its extension allows.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    allowed = EXTENSION_TYPES.get(extension)
+    if allowed is None or file_type in allowed:
+        return None
+    if file_type is None:
+        return f'The file content is not a valid {extension} file.'
+    return f'The file content is a {describe(file_type)}, which does not match its {extension} extension.'
+
+
+def mime_type(file_type):
+    """Return the MIME type of files detected as file_type, or None if it doesn't tell."""
+    return MIME_TYPES.get(file_type)
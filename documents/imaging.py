@@ -0,0 +1,52 @@
+"""
+Image resizing for thumbnails, run in worker processes.
+
+This module imports nothing from Django, so a freshly spawned worker only has
+to load Pillow. documents.thumbnails decides what to render and where;
+render() does the CPU-heavy part.
+"""
+import os
+import tempfile
+
+from PIL import Image, ImageOps
+
+JPEG_QUALITY = 85
+
+
+def _flatten(image):
+    """Return image as RGB, with any transparency composited onto white."""
+    if image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info):
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def render(source_path, targets):
+    """
+    Write JPEG renditions of the image at source_path. targets is a list of
+    (max_size, path) pairs; each rendition fits in a max_size square and is
+    never enlarged. Files are written under a temp name and renamed, so
+    readers never see a partial rendition. Returns the paths written.
+    """
+    written = []
+    with Image.open(source_path) as image:
+        largest = max(size for size, path in targets)
+        # JPEGs can be decoded straight at a fraction of their size
+        image.draft('RGB', (largest, largest))
+        image = _flatten(ImageOps.exif_transpose(image))
+        # Largest first, each smaller size is resized from the previous one
+        for size, path in sorted(targets, reverse=True):
+            image.thumbnail((size, size), Image.LANCZOS)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as file:
+                    image.save(file, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+                os.replace(temp_path, path)
+            except BaseException:
+                os.remove(temp_path)
+                raise
+            written.append(path)
+    return written
@@ -0,0 +1,271 @@
+"""
+Bulk document import.
+
+import_files() turns many files into documents at once, for the import page
+and the import_directory management command. Files are taken in batches of
+IMPORT_BATCH_SIZE: each batch is validated and hashed on a pool of
+IMPORT_WORKERS threads, content the blob store doesn't hold yet is written
+to it, and the batch's documents, first versions and notifications are
+inserted with bulk_create in a single transaction. A batch that fails leaves
+neither rows nor newly written files behind.
+
+bulk_create sends no signals, so the work the handlers in documents.signals
+do for a single upload (analytics counters and daily activity, the search
+and typeahead indexes, text extraction and thumbnails) is done here once per
+batch.
+
+Every file gets a result dict with its name, its status (imported, skipped
+or failed), the document's id and, if it failed, the error.
+"""
+import itertools
+import logging
+import os
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.db import transaction
+
+from . import analytics, extraction, search, thumbnails, typeahead
+from .models import (
+    Blob, Category, Document, DocumentVersion, Notification, blob_name, describe_file, validate_file_type
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_WORKERS = 4
+DESCRIPTION = 'Imported document'
+VERSION_COMMENT = 'Initial version (imported)'
+
+
+@contextmanager
+def open_source(source):
+    """Yield a File for source, an uploaded file or a path on the server's disk."""
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as handle:
+            yield File(handle, os.path.basename(source))
+    else:
+        source.seek(0)
+        yield source
+
+
+def describe_source(source):
+    """Validate source's file type and return its file metadata, reading it once."""
+    with open_source(source) as file:
+        validate_file_type(file)
+        metadata = describe_file(file)
+        metadata['original_filename'] = os.path.basename(file.name)[:255]
+    return metadata
+
+
+def _write_blob(storage, source, metadata):
+    with open_source(source) as file:
+        return storage.save(blob_name(metadata['sha256'], metadata['extension']), file)
+
+
+def error_message(error):
+    if isinstance(error, ValidationError):
+        return ' '.join(error.messages)
+    return str(error) or error.__class__.__name__
+
+
+def _result(entry, status, document=None, error=''):
+    return {'name': entry['name'], 'status': status, 'document': document, 'error': error}
+
+
+def add_references(references):
+    """Add references, a Counter of blob names, to the blobs' ref_counts."""
+    Blob.objects.add_references(references)
+
+
+def _record_side_effects(documents, versions):
+    """Do what the post_save handlers would have done for the new rows."""
+    analytics.record_new_documents(documents, versions)
+    search.index_documents(documents)
+    typeahead.invalidate()
+    for version in versions:
+        extraction.schedule(version)
+        thumbnails.schedule(version)
+
+
+def _insert(entries, owner, is_private, storage):
+    """
+    Create the documents, versions and notifications of described entries
+    in one transaction. Returns the documents, in the order of entries.
+    """
+    with transaction.atomic():
+        # Another import may have stored some of this content meanwhile
+        Blob.objects.bulk_create([
+            Blob(sha256=sha256, name=name, size_bytes=size)
+            for sha256, (name, size) in {
+                entry['metadata']['sha256']: (entry['written'], entry['metadata']['size_bytes'])
+                for entry in entries if entry.get('written')
+            }.items()
+        ], ignore_conflicts=True)
+        names = dict(Blob.objects.filter(
+            sha256__in={entry['metadata']['sha256'] for entry in entries}
+        ).values_list('sha256', 'name'))
+
+        # Each entry adds a document and a version referring to its blob
+        add_references(Counter(names[entry['metadata']['sha256']] for entry in entries for _ in range(2)))
+
+        documents = Document.objects.bulk_create([
+            Document(
+                title=os.path.splitext(entry['metadata']['original_filename'])[0][:200],
+                description=DESCRIPTION,
+                file=names[entry['metadata']['sha256']],
+                category=entry['category'],
+                owner=owner,
+                is_private=is_private,
+                **entry['metadata'],
+            )
+            for entry in entries
+        ])
+        versions = DocumentVersion.objects.bulk_create([
+            DocumentVersion(
+                document=document,
+                file=document.file.name,
+                version_number=1,
+                created_by=owner,
+                comment=VERSION_COMMENT,
+                **entry['metadata'],
+            )
+            for entry, document in zip(entries, documents)
+        ])
+        Notification.objects.bulk_create([
+            Notification(
+                user=owner,
+                document=document,
+                notification_type='upload',
+                message=f"You uploaded a new document: '{document.title}'",
+            )
+            for document in documents
+        ])
+        _record_side_effects(documents, versions)
+
+    # Files written for content that was stored concurrently aren't used
+    for entry in entries:
+        if entry.get('written') and entry['written'] != names[entry['metadata']['sha256']]:
+            storage.delete(entry['written'])
+    return documents
+
+
+def _describe_entry(entry):
+    try:
+        return describe_source(entry['source'])
+    except (ValidationError, OSError) as e:
+        return e
+
+
+def _import_batch(entries, owner, is_private, skip_existing, executor, storage):
+    results = {}
+    described = []
+    for entry, outcome in zip(entries, executor.map(_describe_entry, entries)):
+        if isinstance(outcome, Exception):
+            results[id(entry)] = _result(entry, 'failed', error=error_message(outcome))
+        else:
+            entry['metadata'] = outcome
+            described.append(entry)
+
+    if skip_existing and described:
+        existing = {
+            (sha256, filename): pk
+            for sha256, filename, pk in Document.objects.filter(
+                owner=owner, sha256__in={entry['metadata']['sha256'] for entry in described}
+            ).values_list('sha256', 'original_filename', 'pk')
+        }
+        remaining = []
+        for entry in described:
+            key = (entry['metadata']['sha256'], entry['metadata']['original_filename'])
+            if key in existing:
+                results[id(entry)] = _result(entry, 'skipped', document=existing[key])
+            else:
+                remaining.append(entry)
+        described = remaining
+
+    if described:
+        # Write each content the blob store doesn't hold yet, once
+        stored = set(Blob.objects.filter(
+            sha256__in={entry['metadata']['sha256'] for entry in described}
+        ).values_list('sha256', flat=True))
+        new = {}
+        for entry in described:
+            sha256 = entry['metadata']['sha256']
+            if sha256 not in stored and sha256 not in new:
+                new[sha256] = entry
+        writes = [
+            (entry, executor.submit(_write_blob, storage, entry['source'], entry['metadata']))
+            for entry in new.values()
+        ]
+        try:
+            for entry, future in writes:
+                entry['written'] = future.result()
+            documents = _insert(described, owner, is_private, storage)
+        except Exception as e:
+            logger.exception('Import of %s files failed', len(described))
+            for entry, future in writes:
+                if future.exception() is None:
+                    storage.delete(future.result())
+            for entry in described:
+                results[id(entry)] = _result(entry, 'failed', error=error_message(e))
+        else:
+            for entry, document in zip(described, documents):
+                results[id(entry)] = _result(entry, 'imported', document=document.pk)
+    return [results[id(entry)] for entry in entries]
+
+
+def iter_import(entries, owner, is_private=False, skip_existing=False, batch_size=None, workers=None):
+    """
+    Import entries, dicts with the file's source (an uploaded file or a
+    path), a name to report it by and its category, batch by batch,
+    yielding each file's result as its batch finishes. With skip_existing,
+    files owner already has a document for, by content and filename, are
+    skipped, so an interrupted import can be run again.
+    """
+    batch_size = batch_size or getattr(settings, 'IMPORT_BATCH_SIZE', DEFAULT_BATCH_SIZE)
+    workers = workers or getattr(settings, 'IMPORT_WORKERS', DEFAULT_WORKERS)
+    storage = Document._meta.get_field('file').storage
+    entries = iter(entries)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='document-import') as executor:
+        while True:
+            batch = list(itertools.islice(entries, batch_size))
+            if not batch:
+                break
+            yield from _import_batch(batch, owner, is_private, skip_existing, executor, storage)
+
+
+def import_files(files, owner, category=None, is_private=False, **kwargs):
+    """Import uploaded files or paths as documents in category. Returns the results."""
+    entries = (
+        {'source': file, 'name': os.path.basename(getattr(file, 'name', None) or file), 'category': category}
+        for file in files
+    )
+    return list(iter_import(entries, owner, is_private=is_private, **kwargs))
+
+
+def directory_entries(root):
+    """
+    Yield an entry for every file under root, in the Category named after
+    the top-level subdirectory it is in, created if missing. Files directly
+    in root are uncategorized.
+    """
+    root = os.path.abspath(root)
+    categories = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        relative = os.path.relpath(dirpath, root)
+        category = None
+        if relative != os.curdir:
+            top = relative.split(os.sep)[0][:100]
+            if top not in categories:
+                categories[top] = (
+                    Category.objects.filter(name=top).order_by('pk').first() or Category.objects.create(name=top)
+                )
+            category = categories[top]
+        for filename in sorted(filenames):
+            path = os.path.join(dirpath, filename)
+            yield {'source': path, 'name': os.path.relpath(path, root), 'category': category}
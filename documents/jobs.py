@@ -0,0 +1,255 @@
+"""
+Database-backed background job queue.
+
+Jobs are rows of the Job table, so no broker is needed. enqueue() adds one
+for a function registered with @task, by default once the current
+transaction commits. The run_worker management command runs a Worker, which
+leases due jobs, highest priority first, and runs them on a thread or
+process pool.
+
+Leasing selects due jobs with select_for_update(skip_locked=True), so workers
+on databases that support it never wait on each other's rows, then claims
+each with a conditional UPDATE, which keeps it safe on SQLite where
+select_for_update does nothing. A lease lasts JOB_LEASE_SECONDS and the
+Worker renews it while the job runs; a job whose worker died is taken over
+once its lease expires, or marked failed if that was its last attempt. A
+failing job is retried up to its max_attempts with exponential backoff and
+is then marked failed, keeping the last traceback.
+
+Text extraction, delta packing, thumbnail rendering and moving restored
+documents out of cold storage run as jobs when JOB_QUEUE_ENABLED is on,
+instead of on the web process's own pools.
+"""
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import timedelta
+
+import django
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE_SECONDS = 5 * 60
+# Retry delays double from BACKOFF_BASE up to BACKOFF_MAX seconds
+BACKOFF_BASE = 10
+BACKOFF_MAX = 60 * 60
+
+TASKS = {}
+
+
+def task(name):
+    """Register the decorated function as the job called name."""
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def is_enabled():
+    return getattr(settings, 'JOB_QUEUE_ENABLED', False)
+
+
+def enqueue(name, priority=0, delay=0, max_attempts=5, on_commit=True, **kwargs):
+    """
+    Queue the task called name to run with kwargs, which must be JSON
+    serializable. With on_commit the job is only created once the current
+    transaction commits, so it never runs for a rolled back change.
+    Returns the Job, or None when deferred.
+    """
+    if name not in TASKS:
+        raise ValueError(f'Unknown job {name!r}')
+
+    def create():
+        return Job.objects.create(
+            name=name, kwargs=kwargs, priority=priority, max_attempts=max_attempts,
+            run_after=timezone.now() + timedelta(seconds=delay),
+        )
+
+    if on_commit:
+        transaction.on_commit(create)
+        return None
+    return create()
+
+
+def lease_seconds_setting():
+    return getattr(settings, 'JOB_LEASE_SECONDS', DEFAULT_LEASE_SECONDS)
+
+
+def _due(now):
+    # Queued jobs that are due, and running jobs whose worker's lease ran out
+    # with attempts left
+    return Q(status='queued', run_after__lte=now) | Q(
+        status='running', locked_until__lt=now, attempts__lt=F('max_attempts')
+    )
+
+
+def fail_abandoned(now=None):
+    """
+    Mark failed the running jobs whose lease ran out on their last attempt,
+    such as jobs that kill their worker every time. Returns how many.
+    """
+    now = now or timezone.now()
+    failed = Job.objects.filter(status='running', locked_until__lt=now, attempts__gte=F('max_attempts')).update(
+        status='failed', finished_at=now, locked_by='', locked_until=None,
+        last_error='The worker running the job stopped before it finished.',
+    )
+    if failed:
+        logger.warning('%s job(s) failed, their workers stopped on the last attempt', failed)
+    return failed
+
+
+def lease(worker_id, limit, lease_seconds=None):
+    """Claim up to limit due jobs for worker_id. Returns the claimed Jobs."""
+    lease_seconds = lease_seconds or lease_seconds_setting()
+    now = timezone.now()
+    claimed = []
+    fail_abandoned(now)
+    with transaction.atomic():
+        candidates = list(
+            Job.objects.select_for_update(skip_locked=True).filter(_due(now))
+            .order_by('-priority', 'run_after', 'pk').values_list('pk', flat=True)[:limit]
+        )
+        for pk in candidates:
+            # Only succeeds if no other worker claimed the job meanwhile
+            if Job.objects.filter(_due(now), pk=pk).update(
+                status='running', locked_by=worker_id, attempts=F('attempts') + 1,
+                locked_until=now + timedelta(seconds=lease_seconds),
+            ):
+                claimed.append(pk)
+    return list(Job.objects.filter(pk__in=claimed).order_by('-priority', 'run_after', 'pk'))
+
+
+def renew(worker_id, job_ids, lease_seconds=None):
+    """
+    Extend worker_id's leases on the running jobs job_ids, so jobs that run
+    for longer than a lease aren't taken over meanwhile. Returns how many.
+    """
+    lease_seconds = lease_seconds or lease_seconds_setting()
+    return Job.objects.filter(pk__in=job_ids, status='running', locked_by=worker_id).update(
+        locked_until=timezone.now() + timedelta(seconds=lease_seconds)
+    )
+
+
+def backoff(attempts):
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+def run_job(job_id, worker_id):
+    """
+    Run a leased job and record the outcome, unless the lease was lost to
+    another worker meanwhile. Returns the job's new status.
+    """
+    job = Job.objects.get(pk=job_id)
+    try:
+        func = TASKS[job.name]
+        func(**job.kwargs)
+    except Exception:
+        error = traceback.format_exc()
+        logger.warning('Job %s (%s) failed, attempt %s of %s', job.pk, job.name, job.attempts, job.max_attempts)
+        if job.attempts >= job.max_attempts:
+            changes = {'status': 'failed', 'finished_at': timezone.now()}
+        else:
+            changes = {'status': 'queued', 'run_after': timezone.now() + timedelta(seconds=backoff(job.attempts))}
+        changes['last_error'] = error
+    else:
+        changes = {'status': 'done', 'finished_at': timezone.now(), 'last_error': ''}
+    Job.objects.filter(pk=job.pk, status='running', locked_by=worker_id).update(
+        locked_by='', locked_until=None, **changes
+    )
+    return changes['status']
+
+
+def _execute(job_id, worker_id):
+    close_old_connections()
+    try:
+        return run_job(job_id, worker_id)
+    finally:
+        # Pool threads and processes keep their own connection, don't leave it open
+        connection.close()
+
+
+def _setup_process():
+    # Spawned workers start without Django configured
+    django.setup()
+
+
+class Worker:
+    """
+    Leases jobs and runs them on a pool of concurrency threads or, with
+    pool='process', processes, until stopped. The leases of running jobs are
+    renewed every third of JOB_LEASE_SECONDS, so only the jobs of a worker
+    that died are taken over.
+    """
+    def __init__(self, concurrency=4, pool='thread', poll_interval=1.0, worker_id=None, lease_seconds=None):
+        self.concurrency = concurrency
+        self.pool = pool
+        self.poll_interval = poll_interval
+        self.worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.lease_seconds = lease_seconds or lease_seconds_setting()
+        self.stopping = threading.Event()
+
+    def _executor(self):
+        if self.pool == 'process':
+            return ProcessPoolExecutor(
+                max_workers=self.concurrency, mp_context=multiprocessing.get_context('spawn'),
+                initializer=_setup_process,
+            )
+        return ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='job-worker')
+
+    def stop(self):
+        self.stopping.set()
+
+    def _renew(self, running):
+        now = time.monotonic()
+        if running and now >= self.renew_at:
+            renew(self.worker_id, list(running.values()), self.lease_seconds)
+            self.renew_at = now + self.lease_seconds / 3
+
+    def _collect(self, running, timeout):
+        """Wait up to timeout for a running job to finish. Returns the number finished."""
+        done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            del running[future]
+            if future.exception() is not None:
+                logger.error('Job worker error: %s', future.exception())
+        return len(done)
+
+    def run(self, burst=False):
+        """
+        Process jobs until stop() is called or, with burst, until none are
+        due. Returns the number of jobs run.
+        """
+        processed = 0
+        # Future -> id of the job it runs
+        running = {}
+        self.renew_at = time.monotonic() + self.lease_seconds / 3
+        with self._executor() as executor:
+            while not self.stopping.is_set():
+                free = self.concurrency - len(running)
+                jobs = lease(self.worker_id, free, self.lease_seconds) if free else []
+                for job in jobs:
+                    running[executor.submit(_execute, job.pk, self.worker_id)] = job.pk
+                if not running:
+                    if burst:
+                        break
+                    self.stopping.wait(self.poll_interval)
+                    continue
+                processed += self._collect(running, self.poll_interval)
+                self._renew(running)
+            # Let leased jobs finish before exiting
+            while running:
+                processed += self._collect(running, self.poll_interval)
+                self._renew(running)
+        return processed
@@ -0,0 +1,68 @@
+from django.core.management.base import BaseCommand
+
+from documents import analytics
+from documents.models import Document, DocumentVersion, FILE_METADATA_FIELDS, describe_file
+
+
+class Command(BaseCommand):
+    help = (
+        'Record size, extension, MIME type and SHA-256 for documents and versions '
+        'stored before these columns existed. Rows that already have a hash are '
+        'skipped, so the command can be interrupted and run again.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Number of rows read and updated per batch.')
+        parser.add_argument('--start-after', type=int, default=0,
+                            help='Resume after this primary key.')
+        parser.add_argument('--model', choices=['document', 'version', 'all'], default='all')
+
+    def handle(self, *args, **options):
+        models = {
+            'document': [Document],
+            'version': [DocumentVersion],
+            'all': [Document, DocumentVersion],
+        }[options['model']]
+
+        for model in models:
+            updated = self.backfill(model, options['batch_size'], options['start_after'])
+            if model is Document and updated:
+                # Sizes changed under the counters, recompute them
+                analytics.rebuild()
+
+    def backfill(self, model, batch_size, start_after):
+        name = model._meta.verbose_name_plural
+        last_pk = start_after
+        updated = 0
+        missing = 0
+
+        while True:
+            batch = list(
+                model.objects.filter(sha256='', pk__gt=last_pk).order_by('pk')[:batch_size]
+            )
+            if not batch:
+                break
+
+            changed = []
+            for obj in batch:
+                try:
+                    with obj.file.open('rb') as file:
+                        metadata = describe_file(file)
+                except (OSError, ValueError):
+                    # File might not exist
+                    missing += 1
+                    continue
+                for field, value in metadata.items():
+                    setattr(obj, field, value)
+                changed.append(obj)
+
+            model.objects.bulk_update(changed, FILE_METADATA_FIELDS)
+            updated += len(changed)
+            last_pk = batch[-1].pk
+            self.stdout.write(f'{name}: {updated} updated, last id {last_pk}')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Backfilled {updated} {name} ({missing} missing file(s)).'
+        ))
+        return updated
@@ -0,0 +1,57 @@
+import json
+import shutil
+import tempfile
+
+from django.core.management.base import BaseCommand
+from django.test.utils import (
+    override_settings, setup_databases, setup_test_environment,
+    teardown_databases, teardown_test_environment,
+)
+
+from documents import benchmark
+
+
+class Command(BaseCommand):
+    help = (
+        'Seed a synthetic dataset into a scratch database and report p50/p95 '
+        'latency and query counts for every documents URL as JSON.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, default=1000,
+                            help='Number of documents to seed.')
+        parser.add_argument('--users', type=int, default=None,
+                            help='Number of users to seed (default: one per 100 documents).')
+        parser.add_argument('--iterations', type=int, default=20,
+                            help='Timed requests per URL.')
+        parser.add_argument('--clear-cache', action='store_true',
+                            help='Clear the cache before every request to time cold paths.')
+        parser.add_argument('--output', help='Write the JSON report to this file.')
+
+    def handle(self, *args, **options):
+        # The scratch database and media directory are thrown away afterwards
+        media_root = tempfile.mkdtemp()
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            with override_settings(MEDIA_ROOT=media_root):
+                fixtures = benchmark.seed(options['documents'], options['users'])
+                views = benchmark.run_benchmark(
+                    fixtures, options['iterations'], options['clear_cache']
+                )
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        report = json.dumps({
+            'documents': options['documents'],
+            'iterations': options['iterations'],
+            'views': views,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                output.write(report)
+            self.stderr.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from documents import uploads
+
+
+class Command(BaseCommand):
+    help = 'Delete chunked upload sessions that have expired, along with their partial files.'
+
+    def handle(self, *args, **options):
+        count = uploads.cleanup_expired()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {count} expired upload session(s).'))
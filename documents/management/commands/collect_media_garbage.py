@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from documents import media_gc
+
+
+class Command(BaseCommand):
+    help = (
+        'Delete media files, cold copies, thumbnails and upload session files that '
+        'nothing in the database refers to any more.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='List orphaned files without removing them.')
+        parser.add_argument('--grace-hours', type=float, default=None,
+                            help='Leave files younger than this alone (default: MEDIA_GC_GRACE_HOURS).')
+        parser.add_argument('--quarantine', help='Move orphaned files into this directory instead of deleting them.')
+        parser.add_argument('--batch-size', type=int, default=media_gc.DEFAULT_BATCH_SIZE,
+                            help='Files checked against the database per query.')
+
+    def handle(self, *args, **options):
+        count = size = 0
+        orphans = media_gc.collect(
+            grace_hours=options['grace_hours'], dry_run=options['dry_run'],
+            quarantine=options['quarantine'], batch_size=options['batch_size'],
+        )
+        for path, file_size in orphans:
+            count += 1
+            size += file_size
+            if options['dry_run'] or options['verbosity'] > 1:
+                self.stdout.write(path)
+
+        if options['dry_run']:
+            action = 'Would remove'
+        elif options['quarantine']:
+            action = 'Quarantined'
+        else:
+            action = 'Deleted'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} {count} orphaned file(s), {filesizeformat(size)}.'
+        ))
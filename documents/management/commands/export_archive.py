@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from documents import archives
+from documents.models import Document
+
+
+class Command(BaseCommand):
+    help = 'Write documents with their versions and comments to an archive that import_archive can read.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Path of the ZIP archive to write.')
+        parser.add_argument('--owner', action='append', default=[],
+                            help='Only export documents owned by this username (repeatable).')
+        parser.add_argument('--exclude-archived', action='store_true', help='Leave out archived documents.')
+
+    def handle(self, *args, **options):
+        documents = Document.objects.all()
+        if options['owner']:
+            documents = documents.filter(owner__username__in=options['owner'])
+        if options['exclude_archived']:
+            documents = documents.filter(is_archived=False)
+        count = documents.count()
+        if not count:
+            raise CommandError('No documents to export')
+
+        size = 0
+        with open(options['output'], 'wb') as output:
+            for chunk in archives.stream_archive(documents):
+                output.write(chunk)
+                size += len(chunk)
+        self.stdout.write(self.style.SUCCESS(f'Exported {count} document(s) to {options["output"]} ({size} bytes).'))
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+
+from documents import extraction
+from documents.models import DocumentVersion
+
+
+class Command(BaseCommand):
+    help = (
+        'Extract searchable text from document versions that are still pending, '
+        'for example files uploaded before extraction existed or while the '
+        'server was restarting.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Also retry versions whose extraction failed.')
+        parser.add_argument('--all', action='store_true',
+                            help='Re-extract every version.')
+
+    def handle(self, *args, **options):
+        versions = DocumentVersion.objects.all()
+        if not options['all']:
+            statuses = ['pending', 'failed'] if options['retry_failed'] else ['pending']
+            versions = versions.filter(text_status__in=statuses)
+
+        counts = {}
+        for version_id in versions.order_by('pk').values_list('pk', flat=True).iterator():
+            status = extraction.extract_version(version_id)
+            if status:
+                counts[status] = counts.get(status, 0) + 1
+
+        summary = ', '.join(f'{count} {status}' for status, count in sorted(counts.items())) or 'nothing to do'
+        self.stdout.write(self.style.SUCCESS(f'Extracted text: {summary}.'))
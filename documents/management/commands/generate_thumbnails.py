@@ -0,0 +1,79 @@
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from django.core.management.base import BaseCommand
+
+from documents import imaging, thumbnails
+from documents.models import Document, DocumentVersion
+
+
+class Command(BaseCommand):
+    help = 'Render missing thumbnails for PNG and JPEG documents and versions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes.')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Most images queued for the workers at once (default: twice the workers).')
+
+    def images(self):
+        """Yield (storage, name, sha256) once per distinct image content."""
+        seen = set()
+        for model in (Document, DocumentVersion):
+            rows = model.objects.filter(
+                extension__in=thumbnails.IMAGE_EXTENSIONS
+            ).exclude(sha256='').exclude(file='').values_list('file', 'sha256')
+            storage = model._meta.get_field('file').storage
+            for name, sha256 in rows.iterator():
+                if sha256 not in seen:
+                    seen.add(sha256)
+                    yield storage, name, sha256
+
+    def handle(self, *args, **options):
+        self.rendered = self.failed = 0
+        # Only a bounded number of images is queued, however many there are
+        batch_size = options['batch_size'] or 2 * options['workers']
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=options['workers'], mp_context=context) as pool:
+            futures = {}
+            for storage, name, sha256 in self.images():
+                targets = thumbnails.missing_targets(storage, sha256)
+                if not targets:
+                    thumbnails.mark_rendered(sha256)
+                    continue
+                try:
+                    path = storage.path(name)
+                except NotImplementedError:
+                    path = None
+                if path and os.path.isfile(path):
+                    if len(futures) >= batch_size:
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        self.collect(done, futures)
+                    futures[pool.submit(imaging.render, path, targets)] = (name, sha256)
+                    continue
+                # Cold files are decompressed to a temp file, rendered here
+                try:
+                    thumbnails.render(storage, name, sha256)
+                    self.rendered += 1
+                except Exception as e:
+                    self.failed += 1
+                    self.stderr.write(f'{name}: {e}')
+
+            self.collect(wait(futures).done, futures)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendered thumbnails for {self.rendered} image(s), {self.failed} failed.'
+        ))
+
+    def collect(self, done, futures):
+        """Count the finished renders in done and drop them from futures."""
+        for future in done:
+            name, sha256 = futures.pop(future)
+            try:
+                future.result()
+                thumbnails.mark_rendered(sha256)
+                self.rendered += 1
+            except Exception as e:
+                self.failed += 1
+                self.stderr.write(f'{name}: {e}')
@@ -0,0 +1,55 @@
+import csv
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from documents import archives
+
+
+class Command(BaseCommand):
+    help = 'Import the documents, versions and comments in an archive written by export_archive.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--owner', required=True,
+                            help='Username that owns the documents, and any whose user is not kept.')
+        parser.add_argument('--keep-users', action='store_true',
+                            help='Keep owners, version authors and commenters whose username exists here.')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Documents per transaction (default: IMPORT_BATCH_SIZE).')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Threads reading files from the archive (default: IMPORT_WORKERS).')
+        parser.add_argument('--report', help='Write the result of every document to this CSV file.')
+
+    def handle(self, *args, **options):
+        try:
+            owner = User.objects.get(username=options['owner'])
+        except User.DoesNotExist:
+            raise CommandError(f"User '{options['owner']}' does not exist")
+
+        report = open(options['report'], 'w', newline='') if options['report'] else None
+        writer = csv.DictWriter(report, ['name', 'status', 'document', 'error']) if report else None
+        if writer:
+            writer.writeheader()
+
+        counts = {'imported': 0, 'failed': 0}
+        try:
+            results = archives.import_archive(
+                options['path'], owner, keep_users=options['keep_users'],
+                batch_size=options['batch_size'], workers=options['workers'],
+            )
+            for result in results:
+                counts[result['status']] += 1
+                if writer:
+                    writer.writerow(result)
+                if result['status'] == 'failed':
+                    self.stderr.write(f"{result['name']}: {result['error']}")
+        except (archives.ArchiveError, OSError) as e:
+            raise CommandError(str(e))
+        finally:
+            if report:
+                report.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {counts['imported']} document(s), {counts['failed']} failed."
+        ))
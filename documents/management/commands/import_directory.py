@@ -0,0 +1,61 @@
+import csv
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from documents import importer
+
+
+class Command(BaseCommand):
+    help = (
+        'Import every file under a directory on the server as documents, '
+        'in a category per top-level subdirectory.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--owner', required=True, help='Username that will own the documents.')
+        parser.add_argument('--private', action='store_true', help='Make the documents private.')
+        parser.add_argument('--skip-existing', action='store_true',
+                            help='Skip files the owner already has, by content and filename.')
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help='Files per transaction (default: IMPORT_BATCH_SIZE).')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Threads hashing files (default: IMPORT_WORKERS).')
+        parser.add_argument('--report', help='Write the result of every file to this CSV file.')
+
+    def handle(self, *args, **options):
+        if not os.path.isdir(options['path']):
+            raise CommandError(f"{options['path']} is not a directory")
+        try:
+            owner = User.objects.get(username=options['owner'])
+        except User.DoesNotExist:
+            raise CommandError(f"User '{options['owner']}' does not exist")
+
+        report = open(options['report'], 'w', newline='') if options['report'] else None
+        writer = csv.DictWriter(report, ['name', 'status', 'document', 'error']) if report else None
+        if writer:
+            writer.writeheader()
+
+        counts = {'imported': 0, 'skipped': 0, 'failed': 0}
+        try:
+            results = importer.iter_import(
+                importer.directory_entries(options['path']), owner,
+                is_private=options['private'], skip_existing=options['skip_existing'],
+                batch_size=options['batch_size'], workers=options['workers'],
+            )
+            for result in results:
+                counts[result['status']] += 1
+                if writer:
+                    writer.writerow(result)
+                if result['status'] == 'failed':
+                    self.stderr.write(f"{result['name']}: {result['error']}")
+        finally:
+            if report:
+                report.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {counts['imported']} file(s), skipped {counts['skipped']}, "
+            f"{counts['failed']} failed."
+        ))
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from documents import tiering
+
+
+class Command(BaseCommand):
+    help = (
+        'Compress the files of documents archived for longer than the grace period '
+        'into cold storage, and bring back files that active documents use again.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace-days', type=int, default=None,
+                            help='Days a document must have been archived (default: COLD_STORAGE_GRACE_DAYS).')
+        parser.add_argument('--batch-size', type=int, default=100)
+
+    def handle(self, *args, **options):
+        frozen, thawed, reclaimed = tiering.migrate(options['grace_days'], options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Moved {frozen} file(s) to cold storage and {thawed} back, '
+            f'reclaiming {filesizeformat(reclaimed)}.'
+        ))
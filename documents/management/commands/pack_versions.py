@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import filesizeformat
+
+from documents import delta
+from documents.models import DocumentVersion
+
+
+class Command(BaseCommand):
+    help = (
+        'Move older document versions into delta storage and report the bytes '
+        'saved per document.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--report-only', action='store_true',
+                            help='Only print the report, without packing anything.')
+
+    def handle(self, *args, **options):
+        if not options['report_only']:
+            versions = DocumentVersion.objects.exclude(file='').order_by('document_id', 'version_number')
+            written = failed = 0
+            for version_id in versions.values_list('pk', flat=True).iterator():
+                try:
+                    written += delta.pack_version(version_id) or 0
+                except Exception as e:
+                    failed += 1
+                    self.stderr.write(f'Version {version_id}: {e}')
+            self.stdout.write(f'Wrote {filesizeformat(written)} of new chunks.')
+            if failed:
+                self.stdout.write(self.style.WARNING(f'{failed} version(s) could not be packed.'))
+
+        total = 0
+        for row in delta.storage_report():
+            total += row['saved_bytes']
+            self.stdout.write(
+                f"Document {row['document']}: {row['versions']} version(s), "
+                f"{filesizeformat(row['logical_bytes'])} stored as {filesizeformat(row['stored_bytes'])}, "
+                f"saved {filesizeformat(row['saved_bytes'])}"
+            )
+        self.stdout.write(self.style.SUCCESS(f'Saved {filesizeformat(total)} in total.'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from documents import analytics
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the materialized dashboard analytics from scratch to repair drift.'
+
+    def handle(self, *args, **options):
+        count = analytics.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} analytics counter(s).'))
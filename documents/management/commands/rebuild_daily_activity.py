@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from documents import analytics
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily activity rollup from existing documents and versions.'
+
+    def handle(self, *args, **options):
+        count = analytics.rebuild_daily_activity()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt activity for {count} day(s).'))
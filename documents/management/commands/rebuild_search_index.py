@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from documents import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index for document titles and descriptions.'
+
+    def handle(self, *args, **options):
+        count = search.rebuild_index()
+        if count is None:
+            self.stdout.write(self.style.WARNING(
+                'Full-text search is not supported by this database; searches use icontains.'
+            ))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'Indexed {count} document(s).'))
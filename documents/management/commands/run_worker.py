@@ -0,0 +1,34 @@
+import signal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from documents import jobs
+
+
+class Command(BaseCommand):
+    help = (
+        'Run background jobs from the database queue on a pool of threads or '
+        'processes until stopped with Ctrl-C or SIGTERM.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=getattr(settings, 'JOB_WORKER_CONCURRENCY', 4),
+                            help='Number of jobs to run at once.')
+        parser.add_argument('--pool', choices=['thread', 'process'], default='thread',
+                            help='Run jobs on threads, or on processes for CPU-heavy work.')
+        parser.add_argument('--poll-interval', type=float, default=1.0,
+                            help='Seconds to wait between looks for new jobs when idle.')
+        parser.add_argument('--burst', action='store_true',
+                            help='Exit once no jobs are due instead of waiting for more.')
+
+    def handle(self, *args, **options):
+        worker = jobs.Worker(
+            concurrency=options['concurrency'], pool=options['pool'], poll_interval=options['poll_interval']
+        )
+        # Finish the jobs in hand, then exit
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: worker.stop())
+        self.stdout.write(f'Worker {worker.worker_id} running {options["concurrency"]} {options["pool"]}(s).')
+        processed = worker.run(burst=options['burst'])
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} job(s).'))
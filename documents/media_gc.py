@@ -0,0 +1,174 @@
+"""
+Garbage collection of orphaned media files.
+
+Files can outlive the rows that referred to them: legacy per-document and
+per-version files written before the blob store, files of imports and
+uploads that failed part way, renditions of contents no longer stored, cold
+copies and upload session files left behind by a crash. collect() walks
+MEDIA_ROOT, and the cold storage and upload session directories if they are
+elsewhere, with os.scandir, one directory at a time. Files are checked
+against the database in batches of names, so memory stays bounded however
+many files there are.
+
+A file is only collected once it is older than the grace period, so files
+written just before the rows that will refer to them are never touched.
+Orphans are deleted, or moved into a quarantine directory to be inspected,
+and a dry run only reports them. The collect_media_garbage management
+command runs it.
+"""
+import os
+import shutil
+import time
+import uuid
+
+from django.conf import settings
+
+from . import tiering, uploads
+from .models import Blob, Document, DocumentVersion, UploadSession, VersionChunk
+
+DEFAULT_GRACE_HOURS = 24
+DEFAULT_BATCH_SIZE = 1000
+
+
+def iter_files(root, skip=()):
+    """
+    Yield a DirEntry for every file under root. Directories are listed one
+    at a time, so only the paths of directories still to visit are kept.
+    Symlinks are not followed.
+    """
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.path not in skip:
+                            pending.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+        except FileNotFoundError:
+            continue
+
+
+def _is_within(path, directory):
+    return os.path.commonpath([path, directory]) == directory
+
+
+def roots():
+    """
+    The directories to collect from as (path, kind) pairs: MEDIA_ROOT, and
+    the cold storage and upload session directories unless inside it.
+    """
+    media_root = os.path.abspath(settings.MEDIA_ROOT)
+    found = [(media_root, 'media')]
+    for path, kind in ((tiering.cold_root(), 'cold'), (uploads.upload_dir(), 'upload')):
+        path = os.path.abspath(path)
+        if not _is_within(path, media_root):
+            found.append((path, kind))
+    return found
+
+
+def classify(path):
+    """Return (kind, name) for path: what refers to it and its name there."""
+    for directory, kind in ((tiering.cold_root(), 'cold'), (uploads.upload_dir(), 'upload')):
+        directory = os.path.abspath(directory)
+        if _is_within(path, directory):
+            return kind, os.path.relpath(path, directory).replace(os.sep, '/')
+    name = os.path.relpath(path, os.path.abspath(settings.MEDIA_ROOT)).replace(os.sep, '/')
+    if name.startswith('thumbnails/'):
+        return 'thumbnail', name
+    return 'media', name
+
+
+def _rendition_hash(name):
+    # thumbnails/<sha[:2]>/<sha256>-<size>.jpg
+    stem, extension = os.path.splitext(os.path.basename(name))
+    return stem.rsplit('-', 1)[0] if extension == '.jpg' and '-' in stem else None
+
+
+def _session_id(name):
+    stem, extension = os.path.splitext(name)
+    try:
+        return uuid.UUID(stem) if extension == '.part' and '/' not in stem else None
+    except ValueError:
+        return None
+
+
+def referenced(kind, names):
+    """Return the subset of names of the given kind that the database still refers to."""
+    names = list(names)
+    if kind == 'media':
+        found = set(Document.objects.filter(file__in=names).values_list('file', flat=True))
+        found.update(DocumentVersion.objects.filter(file__in=names).values_list('file', flat=True))
+        found.update(VersionChunk.objects.filter(name__in=names).values_list('name', flat=True))
+        found.update(Blob.objects.filter(name__in=names).values_list('name', flat=True))
+        return found
+    if kind == 'thumbnail':
+        hashes = {_rendition_hash(name) for name in names} - {None}
+        used = set(Document.objects.filter(sha256__in=hashes).values_list('sha256', flat=True))
+        used.update(DocumentVersion.objects.filter(sha256__in=hashes).values_list('sha256', flat=True))
+        return {name for name in names if _rendition_hash(name) in used}
+    if kind == 'cold':
+        blobs = {name[:-len('.xz')]: name for name in names if name.endswith('.xz')}
+        return {
+            blobs[name] for name in Blob.objects.filter(tier='cold', name__in=blobs).values_list('name', flat=True)
+        }
+    if kind == 'upload':
+        sessions = {_session_id(name): name for name in names if _session_id(name)}
+        return {sessions[pk] for pk in UploadSession.objects.filter(pk__in=sessions).values_list('pk', flat=True)}
+    return set()
+
+
+def _remove(path, root, quarantine):
+    if quarantine:
+        target = os.path.join(quarantine, os.path.basename(root), os.path.relpath(path, root))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(path, target)
+    else:
+        os.remove(path)
+
+
+def _collect_batch(batch, quarantine, dry_run):
+    by_kind = {}
+    for path, root, size, kind, name in batch:
+        by_kind.setdefault(kind, set()).add(name)
+    used = {kind: referenced(kind, names) for kind, names in by_kind.items()}
+    for path, root, size, kind, name in batch:
+        if name in used[kind]:
+            continue
+        if not dry_run:
+            try:
+                _remove(path, root, quarantine)
+            except FileNotFoundError:
+                continue
+        yield path, size
+
+
+def collect(grace_hours=None, dry_run=False, quarantine=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Delete, or move into the quarantine directory, every media file older
+    than grace_hours that nothing in the database refers to, yielding
+    (path, size) for each. With dry_run, files are only reported.
+    """
+    if grace_hours is None:
+        grace_hours = getattr(settings, 'MEDIA_GC_GRACE_HOURS', DEFAULT_GRACE_HOURS)
+    cutoff = time.time() - grace_hours * 60 * 60
+    quarantine = os.path.abspath(quarantine) if quarantine else None
+    skip = {quarantine} if quarantine else set()
+
+    batch = []
+    for root, kind in roots():
+        for entry in iter_files(root, skip):
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime >= cutoff:
+                continue
+            batch.append((entry.path, root, stat.st_size) + classify(entry.path))
+            if len(batch) >= batch_size:
+                yield from _collect_batch(batch, quarantine, dry_run)
+                batch = []
+    if batch:
+        yield from _collect_batch(batch, quarantine, dry_run)
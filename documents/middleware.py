@@ -0,0 +1,119 @@
+"""
+Opt-in request profiling.
+
+RequestProfilingMiddleware records SQL query count and time, template render
+time and the remaining Python time of each request, and reports them in a
+Server-Timing response header. It also logs a warning when the same SQL
+statement shape runs more than REQUEST_PROFILING_DUPLICATE_THRESHOLD times in
+one request, which is the signature of an N+1 query pattern.
+
+It is enabled with the REQUEST_PROFILING setting. When disabled the middleware
+raises MiddlewareNotUsed, so Django drops it from the chain and it costs
+nothing. It is a synchronous middleware, which Django runs in the same thread
+as the (synchronous) views under both WSGI and ASGI, so the per-thread
+connection wrappers it installs see every query of the request.
+"""
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.base import Template
+
+logger = logging.getLogger(__name__)
+
+_current_profile = ContextVar('request_profile', default=None)
+
+# Collapse literal lists so "IN (%s, %s)" and "IN (%s, %s, %s)" share a shape
+_PLACEHOLDER_LIST = re.compile(r'%s(?:\s*,\s*%s)+')
+
+
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_time = 0.0
+        self.sql_count = 0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        # Database execute wrapper
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - start
+            self.sql_count += 1
+            self.statements[_PLACEHOLDER_LIST.sub('%s', sql)] += 1
+
+    def duplicates(self, threshold):
+        return [(sql, count) for sql, count in self.statements.most_common() if count > threshold]
+
+    def server_timing(self):
+        total = time.perf_counter() - self.started
+        python = max(total - self.sql_time - self.template_time, 0)
+        metrics = [
+            f'sql;dur={self.sql_time * 1000:.1f};desc="{self.sql_count} queries"',
+            f'tpl;dur={self.template_time * 1000:.1f};desc="Template rendering"',
+            f'py;dur={python * 1000:.1f};desc="Python"',
+            f'total;dur={total * 1000:.1f}',
+        ]
+        return ', '.join(metrics)
+
+
+def _profiled_render(render):
+    def wrapper(self, context):
+        profile = _current_profile.get()
+        if profile is None:
+            return render(self, context)
+
+        # Included templates render inside their parent, only time the outermost
+        profile.template_depth += 1
+        start = time.perf_counter()
+        sql_before = profile.sql_time
+        try:
+            return render(self, context)
+        finally:
+            profile.template_depth -= 1
+            if not profile.template_depth:
+                # Lazy querysets evaluated while rendering count as SQL time
+                elapsed = time.perf_counter() - start
+                profile.template_time += elapsed - (profile.sql_time - sql_before)
+    wrapper._request_profiling = True
+    return wrapper
+
+
+class RequestProfilingMiddleware:
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_PROFILING', False):
+            raise MiddlewareNotUsed('REQUEST_PROFILING is disabled')
+        self.get_response = get_response
+        self.duplicate_threshold = getattr(settings, 'REQUEST_PROFILING_DUPLICATE_THRESHOLD', 10)
+        if not getattr(Template._render, '_request_profiling', False):
+            Template._render = _profiled_render(Template._render)
+
+    def __call__(self, request):
+        profile = RequestProfile()
+        token = _current_profile.set(profile)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(profile))
+                response = self.get_response(request)
+        finally:
+            _current_profile.reset(token)
+
+        response['Server-Timing'] = profile.server_timing()
+        for sql, count in profile.duplicates(self.duplicate_threshold):
+            logger.warning(
+                'Possible N+1 query on %s: statement ran %d times: %s',
+                request.path, count, sql
+            )
+        return response
+
@@ -0,0 +1,26 @@
+# Generated by Django 5.0.1 on 2026-10-18 04:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0005_comment_documentshare_notification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalyticsCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('total', 'Total'), ('category', 'Category'), ('extension', 'File Extension'), ('owner', 'Owner')], max_length=20)),
+                ('key', models.CharField(blank=True, max_length=100)),
+                ('document_count', models.BigIntegerField(default=0)),
+                ('total_bytes', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'unique_together': {('dimension', 'key')},
+            },
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.0.1 on 2026-10-18 04:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0006_analyticscounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='extension',
+            field=models.CharField(blank=True, db_index=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='mime_type',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='document',
+            name='size_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='extension',
+            field=models.CharField(blank=True, db_index=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='mime_type',
+            field=models.CharField(blank=True, db_index=True, max_length=100),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='sha256',
+            field=models.CharField(blank=True, db_index=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='size_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.1 on 2026-10-18 04:23
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0007_file_metadata'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='document',
+            index=models.Index(fields=['uploaded_at', 'id'], name='document_uploaded_id_idx'),
+        ),
+    ]
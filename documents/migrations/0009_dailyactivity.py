@@ -0,0 +1,28 @@
+# Generated by Django 5.0.1 on 2026-10-18 04:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0008_document_uploaded_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyActivity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('uploads', models.PositiveIntegerField(default=0)),
+                ('archives', models.PositiveIntegerField(default=0)),
+                ('bytes_added', models.BigIntegerField(default=0)),
+                ('versions_created', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Daily activity',
+                'ordering': ['day'],
+            },
+        ),
+    ]
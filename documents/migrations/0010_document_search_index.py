@@ -0,0 +1,25 @@
+from django.db import migrations
+
+
+def create_search_index(apps, schema_editor):
+    from documents import search
+
+    if schema_editor.connection.alias != 'default':
+        return
+    search.rebuild_index()
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('DROP TABLE IF EXISTS documents_document_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0009_dailyactivity'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.0.1 on 2026-10-18 04:40
+
+from django.db import DatabaseError, migrations, models
+
+
+def add_file_text_column(apps, schema_editor):
+    # FTS5 tables can't be altered, recreate the index with a file_text column.
+    # Versions are extracted afterwards by the extract_text command.
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS documents_document_fts')
+    try:
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE documents_document_fts "
+            "USING fts5(title, description, file_text, tokenize='unicode61')"
+        )
+    except DatabaseError:
+        return
+    schema_editor.execute(
+        "INSERT INTO documents_document_fts (rowid, title, description, file_text) "
+        "SELECT id, title, description, '' FROM documents_document"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0010_document_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='documentversion',
+            name='extracted_text',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='text_status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('done', 'Extracted'), ('failed', 'Failed'), ('unsupported', 'Unsupported')], db_index=True, default='pending', max_length=20),
+        ),
+        # The old code only writes title and description, the extra column is harmless
+        migrations.RunPython(add_file_text_column, migrations.RunPython.noop),
+    ]
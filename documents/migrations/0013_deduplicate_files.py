@@ -0,0 +1,131 @@
+import hashlib
+import os
+import shutil
+from collections import Counter
+
+from django.core.files.storage import default_storage
+from django.db import migrations, transaction
+from django.db.models import F
+
+BATCH_SIZE = 500
+
+
+def file_sha256(storage, name):
+    digest = hashlib.sha256()
+    with storage.open(name, 'rb') as file:
+        for chunk in file.chunks():
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link(storage, name, target):
+    """
+    Make target a copy of the stored file name, which is left in place. On
+    local storage it is a hard link, or a copy renamed into place, so target
+    never holds a partial file.
+    """
+    try:
+        source_path = storage.path(name)
+        target_path = storage.path(target)
+    except NotImplementedError:
+        with storage.open(name, 'rb') as file:
+            storage.save(target, file)
+        return
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        partial = f'{target_path}.partial'
+        shutil.copyfile(source_path, partial)
+        os.replace(partial, target_path)
+
+
+def legacy_batches(model):
+    """Yield the rows whose file is outside the blobs/ tree, a batch at a time."""
+    last_pk = 0
+    while True:
+        batch = list(
+            model.objects.filter(pk__gt=last_pk).exclude(file='').exclude(file__startswith='blobs/')
+            .order_by('pk').only('pk', 'file', 'sha256', 'original_filename')[:BATCH_SIZE]
+        )
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+
+def deduplicate_files(apps, schema_editor):
+    """
+    Point the rows with files under media/documents/ and
+    media/document_versions/ at the content-addressed blobs/ tree, keeping
+    one copy per SHA-256. Rows whose file is missing keep their name.
+
+    Each batch of rows commits on its own. Its contents are linked or copied
+    into blobs/ before the rows are updated, and the old files are deleted
+    only after the update commits and no row uses them, so a migration that
+    fails part way leaves every row with its file and can be run again to
+    carry on. Old files left behind by a crash between the two steps are
+    collected by the collect_media_garbage command.
+    """
+    Blob = apps.get_model('documents', 'Blob')
+    models = [apps.get_model('documents', 'Document'), apps.get_model('documents', 'DocumentVersion')]
+    storage = default_storage
+    alias = schema_editor.connection.alias
+
+    for model in models:
+        for batch in legacy_batches(model):
+            hashes = {}
+            for obj in batch:
+                name = obj.file.name
+                if name not in hashes:
+                    # The recorded hash may predate later edits, so hash every file
+                    hashes[name] = file_sha256(storage, name) if storage.exists(name) else None
+
+            # Every content is in blobs/ before any row refers to it there
+            targets = {}
+            for name, sha256 in hashes.items():
+                if sha256 is None or sha256 in targets:
+                    continue
+                blob = Blob.objects.using(alias).filter(sha256=sha256).first()
+                extension = os.path.splitext(name)[1].lower()
+                target = blob.name if blob else f'blobs/{sha256[:2]}/{sha256}{extension}'
+                if not storage.exists(target):
+                    link(storage, name, target)
+                targets[sha256] = target
+
+            with transaction.atomic(using=alias):
+                references = Counter()
+                for obj in batch:
+                    sha256 = hashes[obj.file.name]
+                    obj.original_filename = obj.original_filename or os.path.basename(obj.file.name)
+                    if sha256 is None:
+                        continue
+                    obj.file.name = targets[sha256]
+                    obj.sha256 = sha256
+                    references[sha256] += 1
+                for sha256, count in references.items():
+                    blob, _ = Blob.objects.using(alias).get_or_create(sha256=sha256, defaults={
+                        'name': targets[sha256], 'size_bytes': storage.size(targets[sha256]),
+                    })
+                    Blob.objects.using(alias).filter(pk=blob.pk).update(ref_count=F('ref_count') + count)
+                model.objects.using(alias).bulk_update(batch, ['file', 'sha256', 'original_filename'])
+
+            # Rows in later batches may still use an old file
+            for name, sha256 in hashes.items():
+                in_use = any(other.objects.using(alias).filter(file=name).exists() for other in models)
+                if sha256 is not None and not in_use:
+                    storage.delete(name)
+
+
+class Migration(migrations.Migration):
+    # Batches commit one by one, see deduplicate_files()
+    atomic = False
+
+    dependencies = [
+        ('documents', '0012_blob'),
+    ]
+
+    operations = [
+        # Files stay in the blobs/ tree when reversed, which the old code reads fine
+        migrations.RunPython(deduplicate_files, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.0.1 on 2026-10-18 05:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0014_uploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VersionChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('name', models.CharField(max_length=255)),
+                ('size_bytes', models.PositiveIntegerField()),
+                ('version', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='documents.documentversion')),
+            ],
+            options={
+                'ordering': ['position'],
+                'unique_together': {('version', 'position')},
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.0.1 on 2026-10-18 05:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0015_versionchunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='blob',
+            name='cold_size_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='blob',
+            name='tier',
+            field=models.CharField(choices=[('hot', 'Hot'), ('cold', 'Cold')], db_index=True, default='hot', max_length=10),
+        ),
+    ]
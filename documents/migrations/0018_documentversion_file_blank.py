@@ -0,0 +1,19 @@
+# Generated by Django 5.0.1 on 2026-10-18 05:57
+
+import documents.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0017_job'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='documentversion',
+            name='file',
+            field=models.FileField(blank=True, upload_to='document_versions/', validators=[documents.models.validate_file_type]),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.0.1 on 2026-10-18 06:06
+
+from django.core.files.storage import default_storage
+from django.db import migrations, models
+
+# As in documents.thumbnails when this migration was written
+SIZES = ('small', 'medium', 'large')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def mark_rendered(apps, schema_editor):
+    """Flag the images whose thumbnails were rendered before the flag existed."""
+    models = [apps.get_model('documents', 'Document'), apps.get_model('documents', 'DocumentVersion')]
+    hashes = set()
+    for model in models:
+        hashes.update(model.objects.filter(extension__in=IMAGE_EXTENSIONS).exclude(sha256='')
+                      .values_list('sha256', flat=True).distinct())
+    rendered = [
+        sha256 for sha256 in hashes
+        if all(default_storage.exists(f'thumbnails/{sha256[:2]}/{sha256}-{size}.jpg') for size in SIZES)
+    ]
+    for model in models:
+        for start in range(0, len(rendered), 500):
+            model.objects.filter(sha256__in=rendered[start:start + 500]).update(thumbnails_rendered=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('documents', '0018_documentversion_file_blank'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='thumbnails_rendered',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='documentversion',
+            name='thumbnails_rendered',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_rendered, migrations.RunPython.noop),
+    ]
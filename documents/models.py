@@ -1,11 +1,37 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models.fields.files import FieldFile
+from django.db.models import F
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.utils import timezone
 import os
 import uuid
+import hashlib
+import mimetypes
+from collections import defaultdict
 from datetime import datetime, timedelta
 
+from . import filetypes
+
+def detect_file_type(file):
+    """
+    Return the type of file sniffed from its first bytes (see
+    documents.filetypes) and record it on file as detected_type. Uploads
+    the upload handlers inspected already carry it, so they aren't read again.
+    """
+    if not hasattr(file, 'detected_type'):
+        file.seek(0)
+        file.detected_type = filetypes.sniff(file.read(filetypes.HEAD_SIZE))
+        file.seek(0)
+    return file.detected_type
+
 def validate_file_type(value):
+    # Uploads whose content contradicted their extension arrive empty
+    upload = value.file if isinstance(value, FieldFile) and not value._committed else value
+    rejection = getattr(upload, 'rejection', None)
+    if rejection:
+        raise ValidationError(rejection)
+    
     # Get the file extension
     ext = os.path.splitext(value.name)[1]
     # Define valid file extensions
@@ -13,6 +39,154 @@ def validate_file_type(value):
     
     if not ext.lower() in valid_extensions:
         raise ValidationError('Unsupported file type. Allowed types: PDF, Word, Excel, and Images')
+    
+    # New content is checked too, stored files and bare names are not
+    if not isinstance(upload, FieldFile) and getattr(upload, 'file', None) is not None:
+        rejection = filetypes.mismatch(value.name, detect_file_type(upload))
+        if rejection:
+            raise ValidationError(rejection)
+
+def describe_file(file):
+    """
+    Returns the size, SHA-256 and MIME type of a file, reading it once in
+    chunks, or not at all if the upload handlers measured it as it arrived.
+    The MIME type follows the detected content where it tells what the file
+    is, and the extension otherwise.
+    """
+    sha256 = getattr(file, 'sha256', None)
+    if sha256:
+        size = file.size
+    else:
+        digest = hashlib.sha256()
+        size = 0
+        for chunk in file.chunks():
+            digest.update(chunk)
+            size += len(chunk)
+        sha256 = digest.hexdigest()
+    mime_type = (
+        filetypes.mime_type(detect_file_type(file))
+        or mimetypes.guess_type(file.name)[0] or 'application/octet-stream'
+    )
+    return {
+        'size_bytes': size,
+        'extension': os.path.splitext(file.name)[1].lower(),
+        'mime_type': mime_type,
+        'sha256': sha256,
+    }
+
+FILE_METADATA_FIELDS = ('size_bytes', 'extension', 'mime_type', 'sha256')
+
+def blob_name(sha256, extension):
+    return f'blobs/{sha256[:2]}/{sha256}{extension}'
+
+class BlobManager(models.Manager):
+    def store(self, file, sha256, extension, storage):
+        """
+        Return the name of the blob holding file's content, writing it to
+        storage only if no blob with that SHA-256 exists yet. file should be
+        the upload itself rather than a FieldFile, so storage can move a
+        temporary file into place instead of copying it.
+        """
+        with transaction.atomic():
+            # Locked until the caller's transaction counts its reference, so a
+            # concurrent release can't delete the blob in between
+            blob = self.select_for_update().filter(sha256=sha256).first()
+            if blob:
+                return blob.name
+            file.seek(0)
+            name = storage.save(blob_name(sha256, extension), file)
+            try:
+                with transaction.atomic():
+                    blob = self.create(sha256=sha256, name=name, size_bytes=file.size)
+            except IntegrityError:
+                # Stored concurrently by another request, keep that copy
+                storage.delete(name)
+                blob = self.select_for_update().get(sha256=sha256)
+            return blob.name
+
+    def add_references(self, references):
+        """
+        Add references, a Counter of blob names, to the blobs' ref_counts with
+        one UPDATE per distinct count rather than one per blob.
+        """
+        by_count = defaultdict(list)
+        for name, count in references.items():
+            by_count[count].append(name)
+        for count, names in by_count.items():
+            self.filter(name__in=names).update(ref_count=F('ref_count') + count)
+
+    def update_references(self, previous_name, name, storage):
+        """Move one reference from the blob called previous_name to the one called name."""
+        if previous_name == name:
+            return
+        if name:
+            self.filter(name=name).update(ref_count=F('ref_count') + 1)
+        if previous_name:
+            self.release(previous_name, storage)
+
+    def release(self, name, storage):
+        """
+        Drop one reference to the blob called name, deleting it with the last
+        one. The file is deleted once the transaction commits, so rows rolled
+        back to still refer to the blob keep their file.
+        """
+        with transaction.atomic():
+            blob = self.select_for_update().filter(name=name).first()
+            if blob is None:
+                return
+            if blob.ref_count > 1:
+                self.filter(pk=blob.pk).update(ref_count=F('ref_count') - 1)
+                return
+            blob.delete()
+            transaction.on_commit(lambda: storage.delete(name))
+
+class Blob(models.Model):
+    """
+    One stored copy of each distinct file content. Documents and versions
+    with identical files point at the same blob, and ref_count counts those
+    rows so the file is deleted along with its last reference.
+    """
+    TIERS = (
+        ('hot', 'Hot'),
+        ('cold', 'Cold'),
+    )
+    
+    sha256 = models.CharField(max_length=64, unique=True)
+    name = models.CharField(max_length=255, unique=True)
+    size_bytes = models.BigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Cold blobs are kept compressed outside storage, see documents.tiering
+    tier = models.CharField(max_length=10, choices=TIERS, default='hot', db_index=True)
+    cold_size_bytes = models.BigIntegerField(default=0)
+
+    objects = BlobManager()
+
+    def __str__(self):
+        return self.name
+
+def store_uploaded_file(instance):
+    """
+    Record the metadata and original name of a newly uploaded file on
+    instance and point its file at the blob with the same content.
+    """
+    # The uploaded file itself, which may carry the upload handlers' measurements
+    for field, value in describe_file(instance.file.file).items():
+        setattr(instance, field, value)
+    instance.original_filename = os.path.basename(instance.file.name)
+    # Set again once the new content's thumbnails are found or rendered
+    instance.thumbnails_rendered = False
+    instance.file.name = Blob.objects.store(
+        instance.file.file, instance.sha256, instance.extension, instance.file.storage
+    )
+    # Already stored, the file field must not save it again
+    instance.file._committed = True
+
+def stored_file_name(instance):
+    """Return the file name currently saved for instance, or None if it is new."""
+    if instance._state.adding or instance.pk is None:
+        return None
+    return type(instance).objects.filter(pk=instance.pk).values_list('file', flat=True).first()
 
 class Category(models.Model):
     name = models.CharField(max_length=100)
@@ -38,10 +212,37 @@ class Document(models.Model):
     is_archived = models.BooleanField(default=False)
     current_version = models.PositiveIntegerField(default=1)
     archived_at = models.DateTimeField(null=True, blank=True)
+    # File metadata, recorded when a new file is written
+    size_bytes = models.BigIntegerField(default=0)
+    extension = models.CharField(max_length=10, blank=True, db_index=True)
+    mime_type = models.CharField(max_length=100, blank=True, db_index=True)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)
+    # Name of the file as uploaded, the stored name is its content hash
+    original_filename = models.CharField(max_length=255, blank=True)
+    # Set once the thumbnails of the file are rendered, see documents.thumbnails
+    thumbnails_rendered = models.BooleanField(default=False)
+    
+    class Meta:
+        indexes = [
+            # Keyset pagination orders listings by (uploaded_at, id)
+            models.Index(fields=['uploaded_at', 'id'], name='document_uploaded_id_idx'),
+        ]
     
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            # Newly uploaded files are stored once per distinct content
+            if self.file and not self.file._committed:
+                store_uploaded_file(self)
+            previous_name = stored_file_name(self)
+            super().save(*args, **kwargs)
+            Blob.objects.update_references(previous_name, self.file.name, self.file.storage)
+
+    def get_filename(self):
+        return self.original_filename or os.path.basename(self.file.name)
+
     def get_latest_version(self):
         return self.versions.first()
     
@@ -49,20 +250,31 @@ class Document(models.Model):
         latest = self.get_latest_version()
         return latest.file if latest else self.file
 
-    def delete(self, *args, **kwargs):
-        # Delete the file from storage when deleting the document
-        if self.file:
-            if os.path.isfile(self.file.path):
-                os.remove(self.file.path)
-        super().delete(*args, **kwargs)
 
 class DocumentVersion(models.Model):
+    TEXT_STATUSES = (
+        ('pending', 'Pending'),
+        ('done', 'Extracted'),
+        ('failed', 'Failed'),
+        ('unsupported', 'Unsupported'),
+    )
+    
     document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='versions')
-    file = models.FileField(upload_to='document_versions/', validators=[validate_file_type])
+    # Empty once the version is packed into delta storage chunks
+    file = models.FileField(upload_to='document_versions/', validators=[validate_file_type], blank=True)
     version_number = models.PositiveIntegerField(default=1)
     created_at = models.DateTimeField(auto_now_add=True)
     comment = models.TextField(blank=True)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE)
+    size_bytes = models.BigIntegerField(default=0)
+    extension = models.CharField(max_length=10, blank=True, db_index=True)
+    mime_type = models.CharField(max_length=100, blank=True, db_index=True)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)
+    original_filename = models.CharField(max_length=255, blank=True)
+    # Plain text of the file, filled in by documents.extraction after upload
+    extracted_text = models.TextField(blank=True)
+    text_status = models.CharField(max_length=20, choices=TEXT_STATUSES, default='pending', db_index=True)
+    thumbnails_rendered = models.BooleanField(default=False)
     
     class Meta:
         ordering = ['-version_number']
@@ -70,6 +282,38 @@ class DocumentVersion(models.Model):
     def __str__(self):
         return f"{self.document.title} - v{self.version_number}"
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            if self.file and not self.file._committed:
+                store_uploaded_file(self)
+            elif self.file and not self.sha256 and self.file.name == self.document.file.name:
+                # Version created from the document's own file, reuse its metadata
+                for field in FILE_METADATA_FIELDS + ('original_filename',):
+                    setattr(self, field, getattr(self.document, field))
+            previous_name = stored_file_name(self)
+            super().save(*args, **kwargs)
+            Blob.objects.update_references(previous_name, self.file.name, self.file.storage)
+
+    def get_filename(self):
+        return self.original_filename or os.path.basename(self.file.name)
+
+class VersionChunk(models.Model):
+    """
+    One content-defined chunk of a version kept in delta storage, in order.
+    name is the Blob holding the chunk. See documents.delta.
+    """
+    version = models.ForeignKey(DocumentVersion, on_delete=models.CASCADE, related_name='chunks')
+    position = models.PositiveIntegerField()
+    name = models.CharField(max_length=255)
+    size_bytes = models.PositiveIntegerField()
+    
+    class Meta:
+        ordering = ['position']
+        unique_together = ('version', 'position')
+    
+    def __str__(self):
+        return f"{self.version} chunk {self.position}"
+
 class DocumentShare(models.Model):
     document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name='shares')
     shared_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='shared_documents')
@@ -91,7 +335,9 @@ class DocumentShare(models.Model):
     @classmethod
     def get_valid_share(cls, token):
         try:
-            share = cls.objects.get(token=token, is_active=True)
+            share = cls.objects.select_related(
+                'document__category', 'document__owner'
+            ).get(token=token, is_active=True)
             if not share.is_expired():
                 return share
         except (cls.DoesNotExist, ValueError):
@@ -142,4 +388,114 @@ class UserProfile(models.Model):
     role = models.CharField(max_length=20, choices=USER_ROLES, default='member')
     
     def __str__(self):
-        return f"{self.user.username} - {self.role}"
\ No newline at end of file
+        return f"{self.user.username} - {self.role}"
+
+class AnalyticsCounter(models.Model):
+    """
+    Materialized document statistics, maintained incrementally by signals.
+    Only active (non-archived) documents are counted.
+    """
+    DIMENSIONS = (
+        ('total', 'Total'),
+        ('category', 'Category'),
+        ('extension', 'File Extension'),
+        ('owner', 'Owner'),
+    )
+    dimension = models.CharField(max_length=20, choices=DIMENSIONS)
+    # Category/owner primary key, file extension, or '' for totals and uncategorized
+    key = models.CharField(max_length=100, blank=True)
+    document_count = models.BigIntegerField(default=0)
+    total_bytes = models.BigIntegerField(default=0)
+
+    class Meta:
+        unique_together = ('dimension', 'key')
+
+    def __str__(self):
+        return f"{self.dimension}:{self.key} ({self.document_count} docs)"
+
+class DailyActivity(models.Model):
+    """
+    Per-day rollup of document activity, maintained by signals so trend
+    charts read one row per day instead of aggregating the documents table.
+    """
+    day = models.DateField(unique=True)
+    # Uploads of documents that are still active, archived ones aren't charted
+    uploads = models.PositiveIntegerField(default=0)
+    archives = models.PositiveIntegerField(default=0)
+    bytes_added = models.BigIntegerField(default=0)
+    versions_created = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        ordering = ['day']
+        verbose_name_plural = "Daily activity"
+
+    def __str__(self):
+        return f"{self.day}: {self.uploads} uploads"
+
+class UploadSession(models.Model):
+    """
+    A chunked upload in progress. Chunks are written into a temp file at
+    their offsets and received holds the merged [start, end) byte ranges
+    written so far. See documents.uploads.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    # Set when the upload becomes a new version of an existing document
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, null=True, blank=True,
+                                 related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    size = models.BigIntegerField()
+    received = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.received_bytes}/{self.size} bytes)"
+
+    @property
+    def received_bytes(self):
+        return sum(end - start for start, end in self.received)
+
+    @property
+    def is_complete(self):
+        return self.received == [[0, self.size]]
+
+    @property
+    def is_expired(self):
+        return self.expires_at < timezone.now()
+
+class Job(models.Model):
+    """
+    A unit of background work in the database-backed queue. Workers lease
+    due jobs, highest priority first, and retry failures with backoff.
+    See documents.jobs.
+    """
+    STATUSES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    
+    name = models.CharField(max_length=100)
+    kwargs = models.JSONField(default=dict)
+    priority = models.IntegerField(default=0)
+    status = models.CharField(max_length=10, choices=STATUSES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    # Set while a worker holds the job, which others may take over once it expires
+    locked_by = models.CharField(max_length=100, blank=True)
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        indexes = [
+            # Workers look for due jobs by status, priority and run_after
+            models.Index(fields=['status', 'priority', 'run_after'], name='job_due_idx'),
+        ]
+    
+    def __str__(self):
+        return f"{self.name} ({self.status})"
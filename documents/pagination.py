@@ -0,0 +1,122 @@
+"""
+Keyset (cursor) pagination for document listings.
+
+Pages are ordered newest first on (uploaded_at, id), or by search rank for
+full-text results, and the cursor carries the position of the last row shown,
+so fetching a deep page is the same indexed range scan as fetching the first
+one, unlike OFFSET pagination.
+"""
+import base64
+import binascii
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 200
+
+
+class KeysetPage:
+    """
+    One page of results plus the query strings needed to link to the next
+    page and back to the first one.
+    """
+    def __init__(self, object_list, next_cursor, params, is_first):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.is_first = is_first
+        self._params = params
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def next_query(self):
+        params = self._params.copy()
+        params['cursor'] = self.next_cursor
+        return params.urlencode()
+
+    @property
+    def first_query(self):
+        return self._params.urlencode()
+
+
+def get_page_size(request):
+    default = getattr(settings, 'DOCUMENTS_PAGE_SIZE', DEFAULT_PAGE_SIZE)
+    try:
+        page_size = int(request.GET.get('page_size', default))
+    except (TypeError, ValueError):
+        page_size = default
+    return max(1, min(page_size, MAX_PAGE_SIZE))
+
+
+# Supported keyset orderings: the sort key field, whether it sorts
+# descending, and how its value is written to and read from a cursor
+ORDERINGS = {
+    'uploaded_at': ('uploaded_at', True, lambda value: value.isoformat(), parse_datetime),
+    # Full-text search rank, where lower values are better matches
+    'search_rank': ('search_rank', False, repr, float),
+}
+
+
+def encode_cursor(document, ordering='uploaded_at'):
+    field, _, write, _ = ORDERINGS[ordering]
+    value = f'{write(getattr(document, field))}|{document.pk}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor, ordering='uploaded_at'):
+    """Return (key, pk) for a cursor, or None if it is missing or invalid."""
+    if not cursor:
+        return None
+    _, _, _, read = ORDERINGS[ordering]
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode()).decode()
+        key, pk = value.rsplit('|', 1)
+        key = read(key)
+        pk = int(pk)
+    except (binascii.Error, UnicodeError, ValueError):
+        return None
+    if key is None:
+        return None
+    return key, pk
+
+
+def paginate_documents(request, queryset, ordering='uploaded_at'):
+    """
+    Return the page of queryset selected by the request's cursor and
+    page_size parameters. Other GET parameters such as q and category are
+    preserved in the page links. Pass ordering='search_rank' for querysets
+    annotated with a full-text search rank.
+    """
+    field, descending, _, _ = ORDERINGS[ordering]
+    page_size = get_page_size(request)
+    position = decode_cursor(request.GET.get('cursor'), ordering)
+
+    if descending:
+        queryset = queryset.order_by(f'-{field}', '-id')
+    else:
+        queryset = queryset.order_by(field, 'id')
+    if position:
+        key, pk = position
+        lookup = 'lt' if descending else 'gt'
+        queryset = queryset.filter(
+            Q(**{f'{field}__{lookup}': key}) |
+            Q(**{field: key, f'id__{lookup}': pk})
+        )
+
+    # Fetch one extra row to know whether there is a next page
+    items = list(queryset[:page_size + 1])
+    next_cursor = encode_cursor(items[page_size - 1], ordering) if len(items) > page_size else None
+
+    params = request.GET.copy()
+    params.pop('cursor', None)
+    return KeysetPage(items[:page_size], next_cursor, params, is_first=position is None)
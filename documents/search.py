@@ -0,0 +1,171 @@
+"""
+Full-text search over document titles, descriptions and file contents.
+
+On SQLite builds with FTS5 the documents_document_fts virtual table holds one
+row per document, keyed by the document id, with the text extracted from the
+latest version's file as its file_text column. It is kept in sync by the signal
+handlers in documents.signals and by documents.extraction. Searches use it for relevance-ranked results
+with highlighted snippets. Other databases, or SQLite without FTS5, fall back
+to the title/description icontains filter.
+"""
+import re
+
+from django.db import DatabaseError, connection
+from django.db.models import FloatField, Q
+from django.db.models.expressions import RawSQL
+
+FTS_TABLE = 'documents_document_fts'
+
+# Snippet highlight markers, replaced with <mark> after HTML escaping
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+_TOKEN = re.compile(r'\w+', re.UNICODE)
+
+_available = None
+
+
+def create_index():
+    """Create the FTS5 table if the database supports it. Returns True on success."""
+    global _available
+    if connection.vendor != 'sqlite':
+        _available = False
+        return False
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} "
+                f"USING fts5(title, description, file_text, tokenize='unicode61')"
+            )
+    except DatabaseError:
+        # SQLite was built without FTS5
+        _available = False
+        return False
+    _available = True
+    return True
+
+
+def is_available():
+    global _available
+    if _available is None:
+        _available = (
+            connection.vendor == 'sqlite' and
+            FTS_TABLE in connection.introspection.table_names()
+        )
+    return _available
+
+
+def index_document(document, file_text=None):
+    """
+    Index document, with file_text as the text of its file. When it is
+    None the text already extracted for the latest version is used.
+    """
+    if not is_available():
+        return
+    if file_text is None:
+        file_text = document.versions.values_list('extracted_text', flat=True).first() or ''
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [document.pk])
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, title, description, file_text) VALUES (%s, %s, %s, %s)",
+            [document.pk, document.title, document.description, file_text]
+        )
+
+
+def index_documents(documents):
+    """Index newly created documents, which have no extracted text yet, in one batch."""
+    if not is_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} (rowid, title, description, file_text) VALUES (%s, %s, %s, '')",
+            [(document.pk, document.title, document.description) for document in documents]
+        )
+
+
+def remove_document(document_id):
+    if not is_available():
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [document_id])
+
+
+def rebuild_index():
+    """Repopulate the index from the documents table. Returns the row count, or None without FTS."""
+    if not create_index():
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        # Migration 0010 builds the index before versions have extracted text
+        columns = connection.introspection.get_table_description(cursor, 'documents_documentversion')
+        if 'extracted_text' in {column.name for column in columns}:
+            file_text = (
+                "COALESCE((SELECT v.extracted_text FROM documents_documentversion v "
+                "WHERE v.document_id = d.id ORDER BY v.version_number DESC LIMIT 1), '')"
+            )
+        else:
+            file_text = "''"
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE} (rowid, title, description, file_text) "
+            f"SELECT d.id, d.title, d.description, {file_text} FROM documents_document d"
+        )
+        cursor.execute(f"SELECT COUNT(*) FROM {FTS_TABLE}")
+        return cursor.fetchone()[0]
+
+
+def match_expression(query):
+    """
+    Turn free text into an FTS5 query: every word must match, the last one
+    as a prefix so results appear while typing. Returns '' if there are no words.
+    """
+    words = _TOKEN.findall(query)
+    if not words:
+        return ''
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def search_documents(queryset, query):
+    """
+    Filter queryset to documents matching query. Returns (queryset, ranked),
+    where ranked means it is annotated with search_rank (lower is better)
+    and should be ordered by it.
+    """
+    expression = match_expression(query)
+    if not is_available() or not expression:
+        return queryset.filter(
+            Q(title__icontains=query) |
+            Q(description__icontains=query)
+        ), False
+
+    queryset = queryset.filter(id__in=RawSQL(
+        f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [expression]
+    )).annotate(search_rank=RawSQL(
+        f"SELECT bm25({FTS_TABLE}) FROM {FTS_TABLE} "
+        f"WHERE {FTS_TABLE} MATCH %s AND rowid = documents_document.id",
+        [expression], output_field=FloatField()
+    ))
+    return queryset, True
+
+
+def attach_snippets(documents, query):
+    """
+    Set search_snippet on each document to a highlighted extract of its
+    title, description or file contents, with one query for the whole page.
+    """
+    expression = match_expression(query)
+    if not documents or not expression or not is_available():
+        return documents
+    ids = [document.pk for document in documents]
+    placeholders = ', '.join(['%s'] * len(ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT rowid, snippet({FTS_TABLE}, -1, %s, %s, '...', 16) FROM {FTS_TABLE} "
+            f"WHERE {FTS_TABLE} MATCH %s AND rowid IN ({placeholders})",
+            [HIGHLIGHT_START, HIGHLIGHT_END, expression, *ids]
+        )
+        snippets = dict(cursor.fetchall())
+    for document in documents:
+        document.search_snippet = snippets.get(document.pk, '')
+    return documents
@@ -1,7 +1,11 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, pre_save, post_delete
 from django.dispatch import receiver
 from django.contrib.auth.models import User
-from .models import UserProfile
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from .models import Blob, UserProfile, Document, DocumentVersion, Category, VersionChunk
+from . import analytics, delta, extraction, search, thumbnails, tiering, typeahead
 
 @receiver(post_save, sender=User)
 def create_user_profile(sender, instance, created, **kwargs):
@@ -12,4 +16,116 @@ def create_user_profile(sender, instance, created, **kwargs):
 def save_user_profile(sender, instance, **kwargs):
     if not hasattr(instance, 'profile'):
         UserProfile.objects.create(user=instance)
-    instance.profile.save()
\ No newline at end of file
+    instance.profile.save()
+
+@receiver(pre_save, sender=Document)
+def snapshot_document_analytics(sender, instance, **kwargs):
+    # Remember what the stored row contributed so post_save can apply a delta
+    previous = None
+    if instance.pk:
+        previous = sender.objects.filter(pk=instance.pk).only(
+            'is_archived', 'category', 'owner', 'extension', 'size_bytes'
+        ).first()
+    instance._analytics_previous = analytics.document_contribution(previous)
+    instance._was_archived = previous.is_archived if previous else False
+
+@receiver(post_save, sender=Document)
+def update_document_analytics(sender, instance, created, **kwargs):
+    previous = getattr(instance, '_analytics_previous', None)
+    analytics.record_change(previous, analytics.document_contribution(instance))
+    
+    # Daily activity rollup
+    upload_day = timezone.localdate(instance.uploaded_at)
+    if created:
+        analytics.record_activity(
+            upload_day, uploads=0 if instance.is_archived else 1, bytes_added=instance.size_bytes
+        )
+    was_archived = getattr(instance, '_was_archived', False)
+    if instance.is_archived and not was_archived:
+        analytics.record_activity(
+            timezone.localdate(instance.archived_at or timezone.now()), archives=1
+        )
+        if not created:
+            # Archived documents drop out of the upload chart, restored ones return
+            analytics.record_upload_change(upload_day, -1)
+    elif was_archived and not instance.is_archived:
+        analytics.record_upload_change(upload_day, 1)
+    analytics.invalidate()
+
+@receiver(post_save, sender=DocumentVersion)
+def update_version_activity(sender, instance, created, **kwargs):
+    if created:
+        # The first version shares the document's upload, later ones add bytes
+        bytes_added = instance.size_bytes if instance.version_number > 1 else 0
+        analytics.record_activity(
+            timezone.localdate(instance.created_at), versions_created=1, bytes_added=bytes_added
+        )
+        analytics.invalidate()
+
+@receiver(post_delete, sender=Document)
+def remove_document_analytics(sender, instance, **kwargs):
+    analytics.record_change(analytics.document_contribution(instance), None)
+    if not instance.is_archived:
+        analytics.record_upload_change(timezone.localdate(instance.uploaded_at), -1)
+    analytics.invalidate()
+
+@receiver(post_delete, sender=Category)
+def uncategorize_category_analytics(sender, instance, **kwargs):
+    # on_delete=SET_NULL updates documents without sending signals
+    analytics.move_category(instance.pk, None)
+    analytics.invalidate()
+
+@receiver(post_save, sender=Category)
+def invalidate_category_analytics(sender, instance, **kwargs):
+    # Category names appear in the cached charts
+    analytics.invalidate()
+
+@receiver(post_save, sender=Document)
+def index_document_text(sender, instance, **kwargs):
+    search.index_document(instance)
+    typeahead.document_saved(instance)
+
+@receiver(post_delete, sender=Document)
+def unindex_document_text(sender, instance, **kwargs):
+    search.remove_document(instance.pk)
+    typeahead.document_deleted(instance.pk)
+
+@receiver(post_save, sender=DocumentVersion)
+def schedule_text_extraction(sender, instance, created, **kwargs):
+    if created:
+        extraction.schedule(instance)
+
+@receiver(post_save, sender=DocumentVersion)
+def schedule_thumbnails(sender, instance, created, **kwargs):
+    # Every upload creates a version, documents share its renditions by hash
+    if created:
+        thumbnails.schedule(instance)
+
+@receiver(post_save, sender=DocumentVersion)
+def schedule_delta_packing(sender, instance, created, **kwargs):
+    # A new version makes the previous ones candidates for delta storage
+    if created and instance.version_number > 1:
+        delta.schedule(instance)
+
+@receiver(post_delete, sender=Document)
+@receiver(post_delete, sender=DocumentVersion)
+def release_file_blob(sender, instance, **kwargs):
+    # Deleting the last document or version with this content deletes the file
+    if not instance.file:
+        return
+    name = instance.file.name
+    if Blob.objects.filter(name=name).exists():
+        Blob.objects.release(name, instance.file.storage)
+    elif not (Document.objects.filter(file=name).exists() or DocumentVersion.objects.filter(file=name).exists()):
+        # A file stored before the blob store, used by nothing else now
+        storage = instance.file.storage
+        transaction.on_commit(lambda: storage.delete(name))
+
+@receiver(post_delete, sender=VersionChunk)
+def release_chunk_blob(sender, instance, **kwargs):
+    Blob.objects.release(instance.name, default_storage)
+
+@receiver(post_delete, sender=Blob)
+def delete_cold_blob(sender, instance, **kwargs):
+    if instance.tier == 'cold':
+        tiering.delete_cold_copy(instance)
@@ -1,4 +1,10 @@
 from django import template
+from django.urls import reverse
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from documents import thumbnails
+from documents.search import HIGHLIGHT_END, HIGHLIGHT_START
 
 register = template.Library()
 
@@ -12,9 +18,33 @@ def split(value, key):
 @register.filter
 def get_file_extension(filename):
     """
-    Returns the file extension from a filename.
+    Returns the file extension from a filename, or from the stored
+    extension of a document or version without touching its file.
     """
+    if hasattr(filename, 'extension'):
+        if filename.extension:
+            return filename.extension.lstrip('.').upper()
+        filename = filename.file.name
     try:
         return filename.split('.')[-1].upper()
     except (AttributeError, IndexError):
-        return ''
\ No newline at end of file
+        return ''
+
+@register.filter
+def highlight_snippet(snippet):
+    """
+    Returns a search snippet as HTML with matched terms wrapped in <mark>.
+    """
+    html = escape(snippet or '')
+    return mark_safe(html.replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>'))
+
+@register.filter
+def thumbnail_url(obj, size='small'):
+    """
+    Returns the URL of a document's or version's thumbnail, or an empty
+    string if it isn't an image or the thumbnail isn't rendered yet. Only
+    the row's thumbnails_rendered flag is read, never storage.
+    """
+    if not obj.thumbnails_rendered or not thumbnails.has_thumbnail(obj):
+        return ''
+    return reverse('document_thumbnail', args=[obj.sha256, size])
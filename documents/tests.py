@@ -1,17 +1,66 @@
+import hashlib
+import io
+import json
 import os
 import tempfile
-from django.test import TestCase, Client, override_settings
+import threading
+import time
+import uuid
+import weakref
+import zipfile
+import zlib
+from datetime import date, timedelta
+from unittest import mock
+from django.test import TestCase, TransactionTestCase, Client, RequestFactory, override_settings
+from django.http import HttpResponse
 from django.urls import reverse
 from django.contrib.auth.models import User
-from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
 from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.utils import timezone
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
 
-from .models import Category, Document, DocumentVersion, UserProfile
+from . import (
+    analytics, archives, benchmark, delta, exports, extraction, imaging, importer, jobs, media_gc, search,
+    thumbnails, tiering, typeahead, upload_handlers, uploads
+)
+from . import urls as document_urls
+from .middleware import RequestProfile, RequestProfilingMiddleware
+from .models import (
+    AnalyticsCounter, Blob, Category, Comment, DailyActivity, Document, DocumentShare,
+    DocumentVersion, Job, Notification, UploadSession, UserProfile, VersionChunk, validate_file_type
+)
 from .forms import DocumentForm, UserRegistrationForm
 
 # Create a temporary media directory for test file uploads
 TEMP_MEDIA_ROOT = tempfile.mkdtemp()
 
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
+class DocumentTestCase(TestCase):
+    """
+    Base for the feature test cases: files go to the temporary media
+    directory and each test starts logged in as owner, with another user and
+    a category to file documents under.
+    """
+    def setUp(self):
+        self.owner = User.objects.create_user(username='owner')
+        self.other = User.objects.create_user(username='other')
+        self.category = Category.objects.create(name='Documents')
+        self.client.force_login(self.owner)
+    
+    def make_document(self, title='Report', filename='report.pdf', content=b'content', **fields):
+        """Create a document directly, owned by owner and in category unless fields say otherwise"""
+        fields = {'owner': self.owner, 'category': self.category, **fields}
+        return Document.objects.create(title=title, file=SimpleUploadedFile(filename, content), **fields)
+
+
 @override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT)
 class DocumentManagementTestCase(TestCase):
     def setUp(self):
@@ -61,7 +110,7 @@ class DocumentManagementTestCase(TestCase):
         # Create test document with sample file
         self.sample_file = SimpleUploadedFile(
             name='test_document.pdf',
-            content=b'This is a test PDF file content',
+            content=b'%PDF-1.4 This is a test PDF file content',
             content_type='application/pdf'
         )
         
@@ -159,7 +208,7 @@ class DocumentManagementTestCase(TestCase):
         
         test_file = SimpleUploadedFile(
             name='create_test.pdf',
-            content=b'Test PDF content for document creation',
+            content=b'%PDF-1.4 Test PDF content for document creation',
             content_type='application/pdf'
         )
         
@@ -241,7 +290,7 @@ class DocumentManagementTestCase(TestCase):
         # Test editing document with new file
         new_test_file = SimpleUploadedFile(
             name='updated_doc.pdf',
-            content=b'Updated PDF content',
+            content=b'%PDF-1.4 Updated PDF content',
             content_type='application/pdf'
         )
         
@@ -478,7 +527,7 @@ class DocumentManagementTestCase(TestCase):
         
         test_file = SimpleUploadedFile(
             name='viewer_test.pdf',
-            content=b'Test PDF content for viewer upload test',
+            content=b'%PDF-1.4 Test PDF content for viewer upload test',
             content_type='application/pdf'
         )
         
@@ -601,7 +650,7 @@ class DocumentManagementTestCase(TestCase):
         
         test_file = SimpleUploadedFile(
             name='file_storage_test.pdf',
-            content=b'Test PDF content for storage testing',
+            content=b'%PDF-1.4 Test PDF content for storage testing',
             content_type='application/pdf'
         )
         
@@ -623,7 +672,9 @@ class DocumentManagementTestCase(TestCase):
         
         # Test file deletion when document is deleted
         file_path = document.file.path
-        document.delete()
+        # The file is deleted once the deletion commits
+        with self.captureOnCommitCallbacks(execute=True):
+            document.delete()
         self.assertFalse(os.path.exists(file_path))
     
     def test_file_type_validation(self):
@@ -632,11 +683,11 @@ class DocumentManagementTestCase(TestCase):
         
         # Test uploading allowed file types
         valid_files = [
-            ('test.pdf', b'PDF content', 'application/pdf'),
-            ('test.doc', b'DOC content', 'application/msword'),
-            ('test.docx', b'DOCX content', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
-            ('test.png', b'PNG content', 'image/png'),
-            ('test.jpg', b'JPG content', 'image/jpeg')
+            ('test.pdf', b'%PDF-1.4 PDF content', 'application/pdf'),
+            ('test.doc', b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1 DOC content', 'application/msword'),
+            ('test.docx', b'PK\x03\x04 DOCX content', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+            ('test.png', b'\x89PNG\r\n\x1a\n PNG content', 'image/png'),
+            ('test.jpg', b'\xff\xd8\xff JPG content', 'image/jpeg')
         ]
         
         for filename, content, content_type in valid_files:
@@ -695,7 +746,7 @@ class DocumentManagementTestCase(TestCase):
         # Create initial document
         initial_file = SimpleUploadedFile(
             name='version_test_v1.pdf',
-            content=b'Version 1 content',
+            content=b'%PDF-1.4 Version 1 content',
             content_type='application/pdf'
         )
         
@@ -717,7 +768,7 @@ class DocumentManagementTestCase(TestCase):
         # Create version 2
         version2_file = SimpleUploadedFile(
             name='version_test_v2.pdf',
-            content=b'Version 2 content',
+            content=b'%PDF-1.4 Version 2 content',
             content_type='application/pdf'
         )
         
@@ -746,7 +797,7 @@ class DocumentManagementTestCase(TestCase):
         # Create version 3
         version3_file = SimpleUploadedFile(
             name='version_test_v3.pdf',
-            content=b'Version 3 content',
+            content=b'%PDF-1.4 Version 3 content',
             content_type='application/pdf'
         )
         
@@ -807,7 +858,7 @@ class DocumentManagementTestCase(TestCase):
         # Upload a document
         test_file = SimpleUploadedFile(
             name='workflow_doc.pdf',
-            content=b'Workflow test document content',
+            content=b'%PDF-1.4 Workflow test document content',
             content_type='application/pdf'
         )
         
@@ -896,4 +947,2230 @@ class DocumentManagementTestCase(TestCase):
         self.assertEqual(response.status_code, 403)  # Forbidden
         
         response = self.client.get(reverse('delete_document', args=[other_doc.id]))
-        self.assertEqual(response.status_code, 403)  # Forbidden
\ No newline at end of file
+        self.assertEqual(response.status_code, 403)  # Forbidden
+
+class AnalyticsCounterTestCase(DocumentTestCase):
+    def counter(self, dimension, key):
+        counter = AnalyticsCounter.objects.filter(dimension=dimension, key=key).first()
+        return (counter.document_count, counter.total_bytes) if counter else (0, 0)
+    
+    def test_counters_follow_document_lifecycle(self):
+        """Test counters are updated on save, archive, restore and delete"""
+        document = self.make_document(content=b'12345')
+        self.make_document('Photo', 'photo.png', b'1234567890', category=None, owner=self.other)
+        
+        self.assertEqual(self.counter('total', ''), (2, 15))
+        self.assertEqual(self.counter('category', str(self.category.pk)), (1, 5))
+        self.assertEqual(self.counter('category', ''), (1, 10))
+        self.assertEqual(self.counter('extension', '.pdf'), (1, 5))
+        self.assertEqual(self.counter('owner', str(self.owner.pk)), (1, 5))
+        
+        # Archiving removes the document from the counters, restoring adds it back
+        document.is_archived = True
+        document.save()
+        self.assertEqual(self.counter('total', ''), (1, 10))
+        self.assertEqual(self.counter('extension', '.pdf'), (0, 0))
+        
+        document.is_archived = False
+        document.save()
+        self.assertEqual(self.counter('total', ''), (2, 15))
+        
+        # Changing category moves the contribution
+        document.category = None
+        document.save()
+        self.assertEqual(self.counter('category', str(self.category.pk)), (0, 0))
+        self.assertEqual(self.counter('category', ''), (2, 15))
+        
+        document.delete()
+        self.assertEqual(self.counter('total', ''), (1, 10))
+        self.assertEqual(self.counter('owner', str(self.owner.pk)), (0, 0))
+    
+    def test_category_delete_moves_counters(self):
+        """Test deleting a category moves its counters to Uncategorized"""
+        self.make_document(content=b'12345')
+        self.client.post(reverse('delete_category', args=[self.category.pk]))
+        
+        uncategorized = Category.objects.get(name='Uncategorized')
+        self.assertEqual(self.counter('category', str(self.category.pk)), (0, 0))
+        self.assertEqual(self.counter('category', str(uncategorized.pk)), (1, 5))
+    
+    def test_dashboard_reads_counters(self):
+        """Test dashboard analytics come from the counters"""
+        self.make_document(content=b'12345')
+        self.make_document('Photo', 'photo.png', b'1234567890', owner=self.other)
+        
+        response = self.client.get(reverse('dashboard'))
+        analytics = response.context['analytics']
+        self.assertEqual(analytics['total_documents'], 2)
+        self.assertEqual(analytics['user_documents'], 1)
+        self.assertEqual(analytics['active_categories_count'], 1)
+        self.assertEqual(analytics['category_stats'], [{'label': 'Documents', 'count': 2}])
+        self.assertEqual(analytics['file_types'], {'.pdf': 1, '.png': 1})
+    
+    def test_rebuild_analytics_command(self):
+        """Test the rebuild command repairs drifted counters"""
+        self.make_document(content=b'12345')
+        self.make_document('Photo', 'photo.png', b'1234567890')
+        expected = list(AnalyticsCounter.objects.order_by('dimension', 'key').values_list(
+            'dimension', 'key', 'document_count', 'total_bytes'
+        ))
+        
+        AnalyticsCounter.objects.all().update(document_count=99, total_bytes=0)
+        call_command('rebuild_analytics', stdout=io.StringIO())
+        
+        rebuilt = list(AnalyticsCounter.objects.order_by('dimension', 'key').values_list(
+            'dimension', 'key', 'document_count', 'total_bytes'
+        ))
+        self.assertEqual(rebuilt, expected)
+
+
+class FileMetadataTestCase(DocumentTestCase):
+    def test_upload_records_metadata(self):
+        """Test upload and edit record size, extension, MIME type and hash"""
+        content = b'%PDF-1.4 metadata test'
+        self.client.post(reverse('upload_document'), {
+            'title': 'Metadata Test',
+            'file': SimpleUploadedFile('Metadata.PDF', content),
+            'category': self.category.pk,
+        })
+        document = Document.objects.get(title='Metadata Test')
+        self.assertEqual(document.size_bytes, len(content))
+        self.assertEqual(document.extension, '.pdf')
+        self.assertEqual(document.mime_type, 'application/pdf')
+        self.assertEqual(document.sha256, hashlib.sha256(content).hexdigest())
+        
+        # The initial version shares the document's file and metadata
+        version = document.versions.get()
+        self.assertEqual(version.sha256, document.sha256)
+        self.assertEqual(version.size_bytes, len(content))
+        
+        new_content = b'\x89PNG\r\n\x1a\n image bytes'
+        self.client.post(reverse('edit_document', args=[document.pk]), {
+            'title': 'Metadata Test',
+            'file': SimpleUploadedFile('image.png', new_content),
+            'category': self.category.pk,
+        })
+        version = document.versions.first()
+        self.assertEqual(version.version_number, 2)
+        self.assertEqual(version.extension, '.png')
+        self.assertEqual(version.mime_type, 'image/png')
+        self.assertEqual(version.sha256, hashlib.sha256(new_content).hexdigest())
+    
+    def test_backfill_file_metadata_command(self):
+        """Test the backfill command fills in rows created before the columns existed"""
+        content = b'legacy spreadsheet'
+        document = self.make_document('Legacy', 'legacy.xlsx', content)
+        DocumentVersion.objects.create(document=document, file=document.file, created_by=self.owner)
+        Document.objects.update(size_bytes=0, extension='', mime_type='', sha256='')
+        DocumentVersion.objects.update(size_bytes=0, extension='', mime_type='', sha256='')
+        
+        call_command('backfill_file_metadata', batch_size=1, stdout=io.StringIO())
+        
+        digest = hashlib.sha256(content).hexdigest()
+        document.refresh_from_db()
+        self.assertEqual(document.sha256, digest)
+        self.assertEqual(document.size_bytes, len(content))
+        self.assertEqual(document.extension, '.xlsx')
+        self.assertEqual(DocumentVersion.objects.get().sha256, digest)
+        # Counters are rebuilt from the backfilled sizes
+        self.assertEqual(AnalyticsCounter.objects.get(dimension='total').total_bytes, len(content))
+
+
+class KeysetPaginationTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            self.make_document(f'Paged Document {i}', f'paged_{i}.pdf', category=self.category if i % 2 else None)
+        # Identical timestamps force the id tie-breaker to keep the order stable
+        Document.objects.update(uploaded_at=timezone.now())
+    
+    def collect_pages(self, url_name, params):
+        titles = []
+        params = dict(params)
+        while True:
+            response = self.client.get(reverse(url_name), params)
+            self.assertEqual(response.status_code, 200)
+            titles.extend(doc.title for doc in response.context['documents'])
+            page = response.context['page']
+            if not page.has_next:
+                return titles
+            params['cursor'] = page.next_cursor
+    
+    def test_dashboard_pages_cover_every_document_once(self):
+        """Test walking the cursor visits each document once, newest first"""
+        titles = self.collect_pages('dashboard', {'page_size': 2})
+        self.assertEqual(titles, [f'Paged Document {i}' for i in reversed(range(5))])
+    
+    def test_filters_are_kept_across_pages(self):
+        """Test q and category filters apply to every page"""
+        titles = self.collect_pages('dashboard', {'page_size': 1, 'category': 'Documents'})
+        self.assertEqual(titles, ['Paged Document 3', 'Paged Document 1'])
+        
+        response = self.client.get(reverse('dashboard'), {'page_size': 1, 'q': 'Document'})
+        self.assertIn('q=Document', response.context['page'].next_query)
+    
+    def test_archive_and_export_listings_are_paginated(self):
+        """Test archived and export listings use the same cursor pagination"""
+        titles = self.collect_pages('export_documents', {'page_size': 3})
+        self.assertEqual(len(titles), 5)
+        
+        Document.objects.update(is_archived=True)
+        titles = self.collect_pages('archived_documents', {'page_size': 4})
+        self.assertEqual(len(set(titles)), 5)
+    
+    def test_invalid_cursor_returns_first_page(self):
+        """Test a malformed cursor falls back to the first page"""
+        response = self.client.get(reverse('dashboard'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['page'].is_first)
+        self.assertEqual(len(response.context['documents']), 5)
+
+
+class AnalyticsCacheTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+    
+    def assert_cached_and_invalidated(self, cache_queries=0):
+        self.make_document('first')
+        self.assertEqual(analytics.dashboard_stats(self.owner)['total_documents'], 1)
+        
+        # Both tiers are served from the cache
+        with self.assertNumQueries(cache_queries):
+            stats = analytics.dashboard_stats(self.owner)
+        self.assertEqual(stats['user_documents'], 1)
+        
+        # Saving, archiving and deleting documents invalidates the cache
+        document = self.make_document('second')
+        self.assertEqual(analytics.dashboard_stats(self.owner)['total_documents'], 2)
+        document.is_archived = True
+        document.save()
+        self.assertEqual(analytics.dashboard_stats(self.owner)['total_documents'], 1)
+        document.delete()
+        self.assertEqual(len(analytics.dashboard_stats(self.owner)['recent_uploads']), 1)
+        
+        # So does renaming a category shown in the charts
+        category = Category.objects.create(name='Before')
+        document = self.make_document('third')
+        document.category = category
+        document.save()
+        self.assertIn('Before', [c['label'] for c in analytics.dashboard_stats(self.owner)['category_stats']])
+        category.name = 'After'
+        category.save()
+        self.assertIn('After', [c['label'] for c in analytics.dashboard_stats(self.owner)['category_stats']])
+    
+    def test_locmem_backend(self):
+        """Test caching and invalidation with the local-memory backend"""
+        self.assert_cached_and_invalidated()
+    
+    def test_file_based_backend(self):
+        """Test caching and invalidation with the file-based backend"""
+        with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': tempfile.mkdtemp(),
+        }}):
+            self.assert_cached_and_invalidated()
+    
+    def test_database_backend(self):
+        """Test caching and invalidation with the database backend"""
+        with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+            'LOCATION': 'documents_test_cache',
+        }}):
+            call_command('createcachetable', stdout=io.StringIO())
+            # Only the generation and one multi-get of the cached tiers are read
+            self.assert_cached_and_invalidated(cache_queries=2)
+
+
+class DailyActivityTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.document = self.make_document('Activity', 'activity.pdf', b'12345')
+        DocumentVersion.objects.create(
+            document=self.document, file=self.document.file, created_by=self.owner
+        )
+        DocumentVersion.objects.create(
+            document=self.document, file=SimpleUploadedFile('activity_v2.pdf', b'1234567'),
+            version_number=2, created_by=self.owner
+        )
+        self.document.is_archived = True
+        self.document.archived_at = timezone.now()
+        self.document.save()
+    
+    def test_signals_maintain_rollup(self):
+        """Test uploads, archives, versions and bytes are rolled up per day"""
+        today = DailyActivity.objects.get(day=timezone.localdate())
+        # The archived document no longer counts as an upload
+        self.assertEqual(today.uploads, 0)
+        self.assertEqual(today.archives, 1)
+        self.assertEqual(today.versions_created, 2)
+        self.assertEqual(today.bytes_added, 12)
+        
+        # Restoring and saving again does not count a second archive
+        self.document.is_archived = False
+        self.document.save()
+        self.document.save()
+        today = DailyActivity.objects.get(day=timezone.localdate())
+        self.assertEqual(today.archives, 1)
+        self.assertEqual(today.uploads, 1)
+        
+        self.document.delete()
+        self.assertEqual(DailyActivity.objects.get(day=timezone.localdate()).uploads, 0)
+    
+    def test_rebuild_daily_activity_command(self):
+        """Test the rebuild command reproduces the signal-maintained rollup"""
+        expected = list(DailyActivity.objects.values())
+        DailyActivity.objects.all().delete()
+        call_command('rebuild_daily_activity', stdout=io.StringIO())
+        rebuilt = list(DailyActivity.objects.values())
+        for row in expected + rebuilt:
+            row.pop('id')
+        self.assertEqual(rebuilt, expected)
+    
+    def test_dashboard_activity_window(self):
+        """Test the chart window parameter selects the number of days"""
+        self.make_document('Active', 'active.pdf', b'123')
+        response = self.client.get(reverse('dashboard'), {'window': 90, 'q': 'Active', 'category': '3'})
+        self.assertEqual(response.context['activity_window'], 90)
+        data = response.context['analytics']['activity_data']
+        self.assertEqual(len(data), 90)
+        # Only the document that isn't archived is charted
+        self.assertEqual(data[-1], 1)
+        # The window links keep the search and filters
+        self.assertIn((30, 'window=30&q=Active&category=3'), response.context['activity_windows'])
+        
+        # Unsupported windows fall back to a week
+        response = self.client.get(reverse('dashboard'), {'window': 5000})
+        self.assertEqual(len(response.context['analytics']['activity_data']), 7)
+
+
+class QueryBudgetTestCase(DocumentTestCase):
+    """
+    Seeds data at two sizes and checks each view stays within a fixed number
+    of queries that does not grow with the number of rows it renders.
+    """
+    # Maximum queries per request, including session, user and the
+    # notification count context processor
+    QUERY_BUDGETS = {
+        'dashboard': 11,
+        # One grouped query more for the facet counts
+        'faceted_dashboard': 12,
+        'archived_documents': 6,
+        'export_documents': 4,
+        'document_detail': 5,
+        'shared_document': 6,
+        'notifications': 5,
+        'manage_shares': 6,
+    }
+    
+    def setUp(self):
+        super().setUp()
+        self.document = self.make_document('Budget Document', 'budget.pdf')
+        self.share = DocumentShare.objects.create(document=self.document, shared_by=self.owner)
+        self.seeded = 0
+    
+    def seed(self, count):
+        """Add count rows of every kind the views render"""
+        start = self.seeded
+        self.seeded += count
+        users = User.objects.bulk_create([
+            User(username=f'budget_user_{i}') for i in range(start, self.seeded)
+        ])
+        categories = Category.objects.bulk_create([
+            Category(name=f'Budget Category {i}') for i in range(start, self.seeded)
+        ])
+        documents = Document.objects.bulk_create([
+            Document(
+                title=f'Seeded {i}', owner=user, category=category,
+                file=f'documents/seeded_{i}.pdf', extension='.pdf',
+                is_archived=i % 2 == 0,
+            )
+            for i, user, category in zip(range(start, self.seeded), users, categories)
+        ])
+        Comment.objects.bulk_create([
+            Comment(document=self.document, user=user, text='Seeded comment') for user in users
+        ])
+        DocumentShare.objects.bulk_create([
+            DocumentShare(document=self.document, shared_by=self.owner) for _ in users
+        ])
+        Notification.objects.bulk_create([
+            Notification(user=self.owner, document=document, notification_type='upload', message='Seeded')
+            for document in documents
+        ])
+    
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+    
+    def assert_query_budget(self, name, url):
+        self.seed(2)
+        small = self.count_queries(url)
+        self.seed(20)
+        large = self.count_queries(url)
+        self.assertEqual(small, large, f'{name} queries grow with row count')
+        self.assertLessEqual(large, self.QUERY_BUDGETS[name], f'{name} exceeds its query budget')
+    
+    def test_listing_views(self):
+        """Test dashboard, archive and export listings have a constant query count"""
+        for name in ('dashboard', 'archived_documents', 'export_documents'):
+            with self.subTest(view=name):
+                self.assert_query_budget(name, reverse(name))
+    
+    def test_faceted_dashboard(self):
+        """Test facet counts cost one query regardless of the number of facet values"""
+        url = reverse('dashboard') + '?visibility=public&extension=.pdf'
+        self.assert_query_budget('faceted_dashboard', url)
+    
+    def test_document_detail(self):
+        """Test comments on the detail page are loaded without N+1 queries"""
+        self.assert_query_budget('document_detail', reverse('document_detail', args=[self.document.pk]))
+    
+    def test_shared_document(self):
+        """Test the shared document page loads the document and comments without N+1 queries"""
+        self.assert_query_budget('shared_document', reverse('shared_document', args=[self.share.token]))
+    
+    def test_notifications(self):
+        """Test notifications load their documents without N+1 queries"""
+        self.assert_query_budget('notifications', reverse('notifications'))
+    
+    def test_manage_shares(self):
+        """Test the share list has a constant query count"""
+        self.assert_query_budget('manage_shares', reverse('manage_shares', args=[self.document.pk]))
+
+
+class RequestProfilingTestCase(DocumentTestCase):
+    def test_disabled_by_default(self):
+        """Test the middleware is left out of the chain unless enabled"""
+        response = self.client.get(reverse('dashboard'))
+        self.assertNotIn('Server-Timing', response)
+    
+    @override_settings(REQUEST_PROFILING=True)
+    def test_server_timing_header(self):
+        """Test SQL, template and Python timings are reported"""
+        response = self.client.get(reverse('dashboard'))
+        timing = response['Server-Timing']
+        for metric in ('sql;dur=', 'tpl;dur=', 'py;dur=', 'total;dur='):
+            self.assertIn(metric, timing)
+        self.assertRegex(timing, r'desc="[1-9]\d* queries"')
+    
+    @override_settings(REQUEST_PROFILING=True)
+    async def test_server_timing_under_asgi(self):
+        """Test the header is also added when served through the ASGI handler"""
+        await self.async_client.aforce_login(self.owner)
+        response = await self.async_client.get(reverse('notifications'))
+        self.assertIn('sql;dur=', response['Server-Timing'])
+    
+    @override_settings(REQUEST_PROFILING=True, REQUEST_PROFILING_DUPLICATE_THRESHOLD=2)
+    def test_repeated_statements_are_logged(self):
+        """Test a statement shape repeated past the threshold logs a warning"""
+        def n_plus_one_view(request):
+            for pk in range(3):
+                User.objects.filter(pk=pk).exists()
+            return HttpResponse()
+        
+        middleware = RequestProfilingMiddleware(n_plus_one_view)
+        with self.assertLogs('documents.middleware', 'WARNING') as logs:
+            response = middleware(RequestFactory().get('/'))
+        self.assertIn('desc="3 queries"', response['Server-Timing'])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('statement ran 3 times', logs.output[0])
+    
+    def test_statement_shapes_ignore_list_lengths(self):
+        """Test IN lists of different lengths count as the same statement"""
+        profile = RequestProfile()
+        execute = lambda sql, params, many, context: None
+        profile(execute, 'SELECT * FROM t WHERE id IN (%s, %s)', [1, 2], False, {})
+        profile(execute, 'SELECT * FROM t WHERE id IN (%s, %s, %s)', [1, 2, 3], False, {})
+        self.assertEqual(profile.duplicates(1), [('SELECT * FROM t WHERE id IN (%s)', 2)])
+
+
+class BenchmarkTestCase(DocumentTestCase):
+    def test_seed_and_benchmark_every_url(self):
+        """Test the synthetic dataset supports a request to every documents URL"""
+        fixtures = benchmark.seed(documents=30, users=3, categories=4)
+        self.assertEqual(Document.objects.count(), 30)
+        self.assertEqual(DocumentVersion.objects.count(), 30)
+        self.assertEqual(AnalyticsCounter.objects.get(dimension='total').document_count, 27)
+        
+        report = benchmark.run_benchmark(fixtures, iterations=2)
+        self.assertEqual(set(report), {pattern.name for pattern in document_urls.urlpatterns})
+        for name, result in report.items():
+            self.assertLess(result['status'], 400, name)
+            self.assertLessEqual(result['p50_ms'], result['p95_ms'])
+    
+    def test_percentile(self):
+        """Test nearest-rank percentiles"""
+        values = list(range(1, 101))
+        self.assertEqual(benchmark.percentile(values, 50), 50)
+        self.assertEqual(benchmark.percentile(values, 95), 95)
+        self.assertEqual(benchmark.percentile([7], 95), 7)
+
+
+class FullTextSearchTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.report = self.make_document('Quarterly budget report', description='Numbers for the board')
+        self.minutes = self.make_document('Meeting minutes', description='We discussed the budget briefly')
+        self.make_document('Holiday photo', description='Nothing to see here')
+    
+    def search(self, query, **params):
+        response = self.client.get(reverse('dashboard'), {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return response
+    
+    def test_ranked_results_with_snippets(self):
+        """Test matches are ranked and highlighted"""
+        response = self.search('budget')
+        documents = response.context['documents']
+        self.assertEqual({doc.pk for doc in documents}, {self.report.pk, self.minutes.pk})
+        ranks = [doc.search_rank for doc in documents]
+        self.assertEqual(ranks, sorted(ranks))
+        self.assertContains(response, '<mark>budget</mark>', html=False)
+        
+        # The last word matches as a prefix
+        self.assertEqual(len(self.search('quarter').context['documents']), 1)
+    
+    def test_ranked_results_paginate(self):
+        """Test relevance-ordered results can be paged with a cursor"""
+        response = self.search('budget', page_size=1)
+        first = response.context['documents'][0]
+        response = self.search('budget', page_size=1, cursor=response.context['page'].next_cursor)
+        second = response.context['documents'][0]
+        self.assertEqual({first.pk, second.pk}, {self.report.pk, self.minutes.pk})
+        self.assertFalse(response.context['page'].has_next)
+    
+    def test_index_follows_saves_and_deletes(self):
+        """Test the index is updated when documents change"""
+        self.minutes.description = 'Nothing about money'
+        self.minutes.save()
+        self.assertEqual([doc.pk for doc in self.search('budget').context['documents']], [self.report.pk])
+        
+        self.report.delete()
+        self.assertEqual(len(self.search('budget').context['documents']), 0)
+    
+    def test_rebuild_search_index_command(self):
+        """Test the rebuild command repopulates the index"""
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {search.FTS_TABLE}')
+        self.assertEqual(len(self.search('budget').context['documents']), 0)
+        
+        call_command('rebuild_search_index', stdout=io.StringIO())
+        self.assertEqual(len(self.search('budget').context['documents']), 2)
+    
+    def test_fallback_without_full_text_index(self):
+        """Test searches use icontains when FTS5 is unavailable"""
+        with mock.patch.object(search, '_available', False):
+            response = self.search('report budget')
+            self.assertEqual(len(response.context['documents']), 0)
+            response = self.search('budget')
+            self.assertEqual(len(response.context['documents']), 2)
+            self.assertFalse(hasattr(response.context['documents'][0], 'search_snippet'))
+
+
+def make_zip(parts):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for name, content in parts.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+def make_docx(*paragraphs):
+    body = ''.join(f'<w:p><w:r><w:t>{text}</w:t></w:r></w:p>' for text in paragraphs)
+    return make_zip({'word/document.xml': (
+        f'<w:document xmlns:w="{extraction.WORD_NS[1:-1]}"><w:body>{body}</w:body></w:document>'
+    )})
+
+
+def make_xlsx(shared_strings, rows):
+    strings = ''.join(f'<si><t>{text}</t></si>' for text in shared_strings)
+    cells = ''.join(
+        '<row>' + ''.join(f'<c t="s"><v>{index}</v></c>' for index in row) + '</row>'
+        for row in rows
+    )
+    namespace = extraction.SHEET_NS[1:-1]
+    return make_zip({
+        'xl/sharedStrings.xml': f'<sst xmlns="{namespace}">{strings}</sst>',
+        'xl/worksheets/sheet1.xml': f'<worksheet xmlns="{namespace}"><sheetData>{cells}</sheetData></worksheet>',
+    })
+
+
+def make_pdf(content):
+    stream = zlib.compress(content)
+    return (
+        b'%%PDF-1.4\n1 0 obj\n<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(stream) +
+        stream + b'\nendstream\nendobj\n'
+        b'2 0 obj\n<< /Subtype /Image /Length 11 >>\nstream\nBT (x) Tj ET\nendstream\nendobj\n%%EOF\n'
+    )
+
+
+@override_settings(TEXT_EXTRACTION_BACKGROUND=False)
+class TextExtractionTestCase(DocumentTestCase):
+    def test_extracts_docx_xlsx_and_pdf(self):
+        """Test text is read from each supported format"""
+        text = extraction.extract_text(io.BytesIO(make_docx('First line', 'Second line')), '.docx')
+        self.assertEqual(text, 'First line\nSecond line\n')
+        
+        text = extraction.extract_text(io.BytesIO(make_xlsx(['Region', 'North'], [[0], [1, 0]])), '.xlsx')
+        self.assertEqual(text.split(), ['Region', 'North', 'Region'])
+        
+        pdf = make_pdf(b'BT /F1 12 Tf 72 712 Td (Quarterly \\(draft\\)) Tj [(reve) 10 (nue) -300 (report)] TJ ET')
+        # Small chunks exercise streams split across reads
+        with mock.patch.object(extraction, 'CHUNK_SIZE', 7):
+            text = extraction.extract_text(io.BytesIO(pdf), '.pdf')
+        self.assertEqual(text.split(), ['Quarterly', '(draft)', 'revenue', 'report'])
+        
+        self.assertIsNone(extraction.extract_text(io.BytesIO(b'image'), '.png'))
+    
+    def test_finished_elements_are_released(self):
+        """Test parsed rows are detached from the tree instead of piling up under it"""
+        rows = ''.join(f'<row><c><v>{index}</v></c></row>' for index in range(2000))
+        part = io.BytesIO(
+            f'<worksheet xmlns="{extraction.SHEET_NS[1:-1]}"><sheetData>{rows}</sheetData></worksheet>'.encode()
+        )
+        seen = []
+        most_alive = 0
+        for row in extraction.iter_elements(part, {extraction.SHEET_NS + 'row'}):
+            self.assertEqual(row.find(extraction.SHEET_NS + 'c/' + extraction.SHEET_NS + 'v').text, str(len(seen)))
+            seen.append(weakref.ref(row))
+            most_alive = max(most_alive, sum(ref() is not None for ref in seen))
+        self.assertEqual(len(seen), 2000)
+        self.assertEqual(most_alive, 1)
+    
+    @override_settings(TEXT_EXTRACTION_MAX_CHARS=20)
+    def test_output_is_capped(self):
+        """Test extracted text stops at the configured limit"""
+        rows = [[0]] * 1000
+        text = extraction.extract_text(io.BytesIO(make_xlsx(['cell value'], rows)), '.xlsx')
+        self.assertEqual(len(text), 20)
+    
+    @override_settings(TEXT_EXTRACTION_MAX_CHARS=20)
+    def test_shared_strings_stop_at_the_cap(self):
+        """Test shared strings past the character cap aren't read or kept"""
+        read = []
+        iter_elements = extraction.iter_elements
+        
+        def counting(part, tags):
+            for element in iter_elements(part, tags):
+                read.append(element.tag)
+                yield element
+        
+        workbook = make_xlsx([f'cell value {index}' for index in range(5000)], [[0, 1, 4999]])
+        with mock.patch.object(extraction, 'iter_elements', counting):
+            text = extraction.extract_text(io.BytesIO(workbook), '.xlsx')
+        self.assertEqual(read.count(extraction.SHEET_NS + 'si'), 2)
+        self.assertEqual(text, 'cell value 0 cell va')
+    
+    def test_upload_is_extracted_after_commit_and_searchable(self):
+        """Test uploads are extracted off the request and their contents found by search"""
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            self.client.post(reverse('upload_document'), {
+                'title': 'Board pack',
+                'description': 'Monthly numbers',
+                'category': self.category.pk,
+                'file': SimpleUploadedFile('pack.docx', make_docx('Confidential forecast for Zanzibar')),
+            })
+        version = DocumentVersion.objects.get(document__title='Board pack')
+        # Nothing is extracted during the request itself
+        self.assertEqual(version.text_status, 'pending')
+        
+        for callback in callbacks:
+            callback()
+        version.refresh_from_db()
+        self.assertEqual(version.text_status, 'done')
+        self.assertIn('Zanzibar', version.extracted_text)
+        
+        response = self.client.get(reverse('dashboard'), {'q': 'zanzibar'})
+        self.assertEqual([doc.title for doc in response.context['documents']], ['Board pack'])
+        self.assertContains(response, '<mark>Zanzibar</mark>', html=False)
+    
+    def test_extract_text_command(self):
+        """Test the command extracts pending versions and records failures"""
+        good = self.make_document('Sheet', 'sheet.xlsx', make_xlsx(['Quokka'], [[0]]))
+        DocumentVersion.objects.create(document=good, file=good.file, created_by=self.owner)
+        bad = self.make_document('Broken', 'broken.docx', b'not a zip')
+        DocumentVersion.objects.create(document=bad, file=bad.file, created_by=self.owner)
+        image = self.make_document('Photo', 'photo.png', b'PNG content')
+        DocumentVersion.objects.create(document=image, file=image.file, created_by=self.owner)
+        
+        out = io.StringIO()
+        with self.assertLogs('documents.extraction', 'WARNING'):
+            call_command('extract_text', stdout=out)
+        self.assertIn('1 done, 1 failed, 1 unsupported', out.getvalue())
+        self.assertEqual(good.versions.get().text_status, 'done')
+        
+        response = self.client.get(reverse('dashboard'), {'q': 'quokka'})
+        self.assertEqual([doc.title for doc in response.context['documents']], ['Sheet'])
+
+
+class TypeaheadTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        # A fresh generation makes the index rebuild from this test's data
+        cache.clear()
+        self.make_document('Budget 2024')
+        self.make_document('Annual budget review', owner=self.other)
+        self.make_document('Budget secrets', owner=self.other, is_private=True)
+        self.make_document('Budget draft', is_private=True)
+        self.make_document('Budget archive', is_archived=True)
+    
+    def suggest(self, prefix, **params):
+        response = self.client.get(reverse('suggest_documents'), {'q': prefix, **params})
+        self.assertEqual(response.status_code, 200)
+        return [result['title'] for result in response.json()['results']]
+    
+    def test_prefix_matches_respect_visibility(self):
+        """Test suggestions match title and word prefixes visible on the dashboard"""
+        self.assertEqual(self.suggest('BUD'), ['Budget 2024', 'Budget draft', 'Annual budget review'])
+        self.assertEqual(self.suggest('bud', limit=2), ['Budget 2024', 'Budget draft'])
+        self.assertEqual(self.suggest('review'), ['Annual budget review'])
+        self.assertEqual(self.suggest('secret'), [])
+        self.assertEqual(self.suggest(''), [])
+        
+        self.client.force_login(self.other)
+        self.assertEqual(self.suggest('budget s'), ['Budget secrets'])
+    
+    def test_index_is_updated_incrementally(self):
+        """Test saves and deletes update the built index without a rebuild"""
+        self.suggest('bud')
+        index = typeahead._index
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            document = self.make_document('Budget forecast')
+        with self.captureOnCommitCallbacks(execute=True):
+            Document.objects.get(title='Budget 2024').delete()
+        with self.captureOnCommitCallbacks(execute=True):
+            document.title = 'Forecast for budget'
+            document.save()
+        
+        with self.assertNumQueries(3):
+            # Session, user and profile only, the titles come from memory
+            titles = self.suggest('bud')
+        self.assertEqual(titles, ['Budget draft', 'Forecast for budget', 'Annual budget review'])
+        self.assertIs(typeahead._index, index)
+    
+    def test_lookups_wait_for_updates(self):
+        """Test a lookup doesn't scan the index while an update holds the lock"""
+        self.suggest('bud')
+        results = []
+        with typeahead._lock:
+            lookup = threading.Thread(target=lambda: results.append(typeahead.suggest('bud', self.owner)))
+            lookup.start()
+            lookup.join(0.2)
+            self.assertTrue(lookup.is_alive())
+        lookup.join()
+        self.assertEqual([title for pk, title in results[0]], ['Budget 2024', 'Budget draft', 'Annual budget review'])
+    
+    def test_deploy_check_warns_about_process_local_caches(self):
+        """Test the deploy check flags caches other processes can't see"""
+        self.assertEqual([warning.id for warning in typeahead.check_shared_cache(None)], ['documents.W001'])
+        shared = {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache', 'LOCATION': 'cache'}}
+        with override_settings(CACHES=shared):
+            self.assertEqual(typeahead.check_shared_cache(None), [])
+    
+    def test_admin_visibility_actions_update_the_index(self):
+        """Test making documents private in the admin hides them from other users' suggestions"""
+        admin_user = User.objects.create_superuser(username='typeahead_admin', password='adminpassword')
+        self.client.force_login(self.other)
+        self.assertEqual(self.suggest('budget 2'), ['Budget 2024'])
+        
+        self.client.force_login(admin_user)
+        document = Document.objects.get(title='Budget 2024')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('admin:documents_document_changelist'), {
+                'action': 'make_private', '_selected_action': [document.pk],
+            })
+        self.client.force_login(self.other)
+        self.assertEqual(self.suggest('budget 2'), [])
+        self.client.force_login(self.owner)
+        self.assertEqual(self.suggest('budget 2'), ['Budget 2024'])
+    
+    def test_scan_stops_at_limit_of_visible_matches(self):
+        """Test other users' private titles aren't scanned at all"""
+        index = typeahead.PrefixIndex()
+        index.load(
+            [(pk, f'Budget {pk}', self.other.pk, True, False) for pk in range(1000, 6000)] +
+            [(1, 'Budget mine', self.owner.pk, True, False), (2, 'Budget shared', self.other.pk, False, False)]
+        )
+        scanned = []
+        matches = index._matches
+        
+        def counting_matches(entries, prefix):
+            for entry in matches(entries, prefix):
+                scanned.append(entry)
+                yield entry
+        
+        with mock.patch.object(index, '_matches', counting_matches):
+            results = index.search('budget', self.owner, limit=1)
+        self.assertEqual(results, [(1, 'Budget mine')])
+        self.assertLessEqual(len(scanned), 2)
+        self.assertEqual(index.search('budget', self.owner), [(1, 'Budget mine'), (2, 'Budget shared')])
+        self.assertEqual(len(index.search('budget', self.other, limit=50)), 50)
+    
+    def test_changes_from_other_processes_trigger_rebuild(self):
+        """Test a generation bump by another process rebuilds the index"""
+        self.suggest('bud')
+        Document.objects.filter(title='Budget 2024').update(title='Budget 2025')
+        cache.incr(typeahead.GENERATION_KEY)
+        
+        self.assertEqual(self.suggest('budget 2'), ['Budget 2025'])
+
+
+class FacetTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.make_document('Sales report', 'report.pdf')
+        self.make_document('Sales figures', 'figures.xlsx', is_private=True)
+        self.make_document('Sales memo', 'memo.docx', owner=self.other, category=None)
+        self.make_document('Hidden sales', 'hidden.pdf', owner=self.other, is_private=True)
+    
+    def get_facets(self, response):
+        return {
+            facet['name']: {value['label']: value['count'] for value in facet['values']}
+            for facet in response.context['facets']
+        }
+    
+    def test_facet_counts_for_search(self):
+        """Test searching returns counts for every facet of the visible results"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('dashboard'), {'q': 'sales'})
+        facets = self.get_facets(response)
+        year = str(timezone.now().year)
+        
+        self.assertEqual(facets['category'], {'Documents': 2, 'Uncategorized': 1})
+        self.assertEqual(facets['extension'], {'.pdf': 1, '.xlsx': 1, '.docx': 1})
+        self.assertEqual(facets['owner'], {'owner': 2, 'other': 1})
+        self.assertEqual(facets['visibility'], {'Public': 2, 'Private': 1})
+        self.assertEqual(facets['year'], {year: 3})
+        
+        facet_queries = [query for query in queries if 'GROUP BY' in query['sql'] and 'extension' in query['sql']]
+        self.assertEqual(len(facet_queries), 1)
+    
+    def test_selecting_facets_narrows_results(self):
+        """Test facet links filter the listing and the counts"""
+        response = self.client.get(reverse('dashboard'), {'q': 'sales'})
+        owner_facet = next(facet for facet in response.context['facets'] if facet['name'] == 'owner')
+        other = next(value for value in owner_facet['values'] if value['label'] == 'other')
+        
+        response = self.client.get(reverse('dashboard') + '?' + other['query'])
+        self.assertEqual([doc.title for doc in response.context['documents']], ['Sales memo'])
+        self.assertEqual(self.get_facets(response)['owner'], {'other': 1})
+        self.assertEqual(response.context['selected_facets'], {'owner': str(self.other.pk)})
+        
+        response = self.client.get(reverse('dashboard'), {'visibility': 'private', 'extension': '.xlsx'})
+        self.assertEqual([doc.title for doc in response.context['documents']], ['Sales figures'])
+        
+        # Invalid values are ignored rather than failing the request
+        response = self.client.get(reverse('dashboard'), {'owner': 'nobody', 'year': 'last'})
+        self.assertEqual(len(response.context['documents']), 3)
+        self.assertIsNone(response.context['facets'])
+    
+    def test_archived_search_renders_facets(self):
+        """Test archived searches show facets for the archived results"""
+        Document.objects.filter(title__in=['Sales report', 'Sales memo']).update(is_archived=True)
+        response = self.client.get(reverse('archived_documents'), {'q': 'sales'})
+        self.assertEqual(self.get_facets(response)['owner'], {'owner': 1, 'other': 1})
+        owner_facet = next(facet for facet in response.context['facets'] if facet['name'] == 'owner')
+        other = next(value for value in owner_facet['values'] if value['label'] == 'other')
+        self.assertContains(response, f'href="?{other["query"].replace("&", "&amp;")}"', html=False)
+        
+        response = self.client.get(reverse('archived_documents') + '?' + other['query'])
+        self.assertEqual([doc.title for doc in response.context['documents']], ['Sales memo'])
+        self.assertEqual(response.context['selected_facets'], {'owner': str(self.other.pk)})
+
+
+class StreamingDownloadTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = bytes(range(256)) * 1024
+        self.document = self.make_document('Large PDF', 'large.pdf', self.content, is_private=True)
+        self.share = DocumentShare.objects.create(document=self.document, shared_by=self.owner)
+        self.url = reverse('download_shared_document', args=[self.share.token])
+        # Share links are for visitors without an account
+        self.client.logout()
+    
+    def test_full_download_is_streamed(self):
+        """Test downloads stream in chunks with validators and range support advertised"""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Content-Length'], str(len(self.content)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['ETag'], f'"{self.document.sha256}"')
+        self.assertIn('Last-Modified', response)
+        self.assertIn('attachment', response['Content-Disposition'])
+    
+    def test_range_requests(self):
+        """Test single byte ranges return 206 with the requested bytes"""
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.content[100:200])
+        
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-10:])
+        
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.content) - 5}-')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-5:])
+        
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.content)}')
+        
+        # Multiple ranges fall back to the whole file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1,5-6')
+        self.assertEqual(response.status_code, 200)
+    
+    def test_conditional_requests(self):
+        """Test If-None-Match, If-Modified-Since and If-Range"""
+        etag = self.client.get(self.url)['ETag']
+        last_modified = self.client.get(self.url)['Last-Modified']
+        
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH='"stale"').status_code, 200)
+        
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag)
+        self.assertEqual(response.status_code, 206)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+    
+    def test_download_count_ignores_resumed_ranges(self):
+        """Test only downloads starting at byte zero are counted"""
+        self.client.get(self.url)
+        self.client.get(self.url, HTTP_RANGE='bytes=0-99')
+        self.client.get(self.url, HTTP_RANGE='bytes=100-')
+        self.client.get(self.url, HTTP_IF_NONE_MATCH=f'"{self.document.sha256}"')
+        self.share.refresh_from_db()
+        self.assertEqual(self.share.download_count, 2)
+    
+    def test_owner_download(self):
+        """Test document downloads use the same streaming path and respect privacy"""
+        url = reverse('download_document', args=[self.document.pk])
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        
+        self.client.force_login(self.owner)
+        response = self.client.get(url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertEqual(b''.join(response.streaming_content), self.content[10:20])
+        
+        response = self.client.get(reverse('document_detail', args=[self.document.pk]))
+        self.assertContains(response, url)
+
+
+class StreamingExportTestCase(DocumentTestCase):
+    def export(self, documents):
+        response = self.client.post(reverse('export_documents'), {
+            'document_ids': [str(document.pk) for document in documents]
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        chunks = list(response.streaming_content)
+        return chunks, zipfile.ZipFile(io.BytesIO(b''.join(chunks)))
+    
+    def test_export_streams_valid_zip(self):
+        """Test the export is streamed in chunks and stores compressed formats as is"""
+        large = os.urandom(300 * 1024)
+        pdf = self.make_document('large.pdf', 'large.pdf', large)
+        image = self.make_document('photo.png', 'photo.png', b'PNG content' * 100)
+        private = self.make_document('secret.pdf', 'secret.pdf', b'secret', owner=self.other, is_private=True)
+        
+        chunks, archive = self.export([pdf, image, private])
+        self.assertGreater(len(chunks), 2)
+        self.assertTrue(all(len(chunk) <= 2 * exports.CHUNK_SIZE for chunk in chunks))
+        self.assertIsNone(archive.testzip())
+        self.assertEqual(archive.namelist(), ['large.pdf', 'photo.png'])
+        self.assertEqual(archive.read(archive.namelist()[0]), large)
+        
+        infos = archive.infolist()
+        self.assertEqual(infos[0].compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEqual(infos[1].compress_type, zipfile.ZIP_STORED)
+    
+    def test_colliding_names_are_made_unique(self):
+        """Test documents with the same basename don't overwrite each other"""
+        first = self.make_document('report.pdf', 'report.pdf', b'first')
+        second = self.make_document('report.pdf', 'report.pdf', b'second')
+        third = self.make_document('REPORT.pdf', 'REPORT.pdf', b'third')
+        
+        _, archive = self.export([first, second, third])
+        self.assertEqual(archive.namelist(), ['report.pdf', 'report (2).pdf', 'REPORT (3).pdf'])
+        self.assertEqual(
+            [archive.read(name) for name in archive.namelist()], [b'first', b'second', b'third']
+        )
+
+
+class BlobStoreTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = b'%PDF-1.4 identical content ' + os.urandom(16)
+    
+    def upload(self, user, name, content):
+        self.client.force_login(user)
+        self.client.post(reverse('upload_document'), {
+            'title': name, 'category': self.category.pk,
+            'file': SimpleUploadedFile(name, content),
+        })
+        return Document.objects.filter(owner=user).latest('pk')
+    
+    def test_identical_uploads_share_one_file(self):
+        """Test identical files are stored once and released with their last reference"""
+        first = self.upload(self.owner, 'contract.pdf', self.content)
+        second = self.upload(self.other, 'copy of contract.pdf', self.content)
+        
+        blob = Blob.objects.get(sha256=first.sha256)
+        self.assertEqual(blob.name, f'blobs/{first.sha256[:2]}/{first.sha256}.pdf')
+        self.assertEqual(first.file.name, blob.name)
+        self.assertEqual(second.file.name, blob.name)
+        self.assertEqual(second.versions.get().file.name, blob.name)
+        # Two documents and their first versions
+        self.assertEqual(blob.ref_count, 4)
+        self.assertEqual(second.get_filename(), 'copy of contract.pdf')
+        
+        path = first.file.path
+        first.delete()
+        self.assertEqual(Blob.objects.get(pk=blob.pk).ref_count, 2)
+        self.assertTrue(os.path.exists(path))
+        
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            second.delete()
+            self.assertFalse(Blob.objects.filter(pk=blob.pk).exists())
+            # Kept until the deletion commits, for rows a rollback would restore
+            self.assertTrue(os.path.exists(path))
+        self.assertTrue(callbacks)
+        self.assertFalse(os.path.exists(path))
+    
+    def test_new_versions_move_references(self):
+        """Test editing and importing store each distinct content once"""
+        document = self.upload(self.owner, 'plan.pdf', self.content)
+        self.client.post(reverse('edit_document', args=[document.pk]), {
+            'title': 'plan.pdf', 'category': self.category.pk,
+            'file': SimpleUploadedFile('plan v2.pdf', b'%PDF-1.4 second draft'),
+        })
+        document.refresh_from_db()
+        old_blob = Blob.objects.get(sha256=hashlib.sha256(self.content).hexdigest())
+        new_blob = Blob.objects.get(sha256=hashlib.sha256(b'%PDF-1.4 second draft').hexdigest())
+        # Version 1 keeps the old content, the document and version 2 share the new one
+        self.assertEqual(old_blob.ref_count, 1)
+        self.assertEqual(new_blob.ref_count, 2)
+        self.assertEqual(document.get_filename(), 'plan v2.pdf')
+        
+        self.client.post(reverse('import_documents'), {
+            'files': [SimpleUploadedFile('imported.pdf', self.content)],
+        })
+        old_blob.refresh_from_db()
+        self.assertEqual(old_blob.ref_count, 3)
+        self.assertEqual(Blob.objects.count(), 2)
+        stored = os.listdir(os.path.join(TEMP_MEDIA_ROOT, 'blobs', new_blob.sha256[:2]))
+        self.assertEqual(
+            [name for name in stored if name.startswith(new_blob.sha256)], [os.path.basename(new_blob.name)]
+        )
+    
+    def test_temporary_uploads_are_moved_into_place(self):
+        """Test uploads spooled to disk are moved into the blob store rather than copied"""
+        upload = TemporaryUploadedFile('large.pdf', 'application/pdf', len(self.content), None)
+        upload.write(self.content)
+        upload.seek(0)
+        inode = os.stat(upload.temporary_file_path()).st_ino
+        document = Document.objects.create(title='Large', owner=self.owner, file=upload)
+        self.assertEqual(os.stat(document.file.path).st_ino, inode)
+        self.assertFalse(os.path.exists(upload.temporary_file_path()))
+        upload.close()
+    
+    def test_rolled_back_deletes_keep_files(self):
+        """Test a release inside a transaction that rolls back leaves the file in place"""
+        document = self.upload(self.owner, 'contract.pdf', self.content)
+        path = document.file.path
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    document.delete()
+                    raise RuntimeError('rolled back')
+            except RuntimeError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(Blob.objects.get(name=document.file.name).ref_count, 2)
+    
+    def test_downloads_use_original_filename(self):
+        """Test downloads are named after the uploaded file, not its hash"""
+        document = self.upload(self.owner, 'Budget 2024.pdf', self.content)
+        response = self.client.get(reverse('download_document', args=[document.pk]))
+        self.assertIn('Budget 2024.pdf', response['Content-Disposition'])
+        b''.join(response.streaming_content)
+
+
+class UploadSessionTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = b'%PDF-1.4 ' + os.urandom(300)
+    
+    def start(self, filename='large.pdf', size=None, **extra):
+        response = self.client.post(reverse('create_upload_session'), dict(
+            filename=filename, size=len(self.content) if size is None else size, **extra
+        ))
+        return response
+    
+    def put(self, url, start, data, end=None):
+        end = start + len(data) - 1 if end is None else end
+        return self.client.put(
+            url, data, content_type='application/octet-stream',
+            headers={'Content-Range': f'bytes {start}-{end}/{len(self.content)}'}
+        )
+    
+    def test_chunks_in_any_order_and_resume(self):
+        """Test chunks are written at their offsets and a cut-short chunk can be resumed"""
+        response = self.start()
+        self.assertEqual(response.status_code, 201)
+        url = response.json()['url']
+        
+        self.assertEqual(self.put(url, 200, self.content[200:]).json()['received'], [[200, 309]])
+        # The body stops short of the declared range, as after a dropped connection
+        status = self.put(url, 0, self.content[:50], end=199).json()
+        self.assertEqual(status['received'], [[0, 50], [200, 309]])
+        self.assertEqual(status['offset'], 50)
+        self.assertFalse(status['complete'])
+        
+        status = self.put(url, 50, self.content[50:200]).json()
+        self.assertEqual(status['received'], [[0, 309]])
+        self.assertTrue(self.client.get(url).json()['complete'])
+        sessions = self.client.get(reverse('create_upload_session')).json()['sessions']
+        self.assertEqual([session['url'] for session in sessions], [url])
+        
+        session = UploadSession.objects.get()
+        with open(uploads.temp_path(session), 'rb') as file:
+            self.assertEqual(file.read(), self.content)
+    
+    def test_invalid_chunks_are_rejected(self):
+        """Test chunks outside the file or with the wrong total are refused"""
+        url = self.start().json()['url']
+        self.assertEqual(self.put(url, 300, b'x' * 20).status_code, 416)
+        response = self.client.put(url, b'x', content_type='application/octet-stream',
+                                   headers={'Content-Range': 'bytes 0-0/5'})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.put(url, b'x').status_code, 400)
+        with override_settings(UPLOAD_CHUNK_MAX_SIZE=10):
+            self.assertEqual(self.put(url, 0, self.content[:20]).status_code, 413)
+        
+        self.assertEqual(self.start(filename='script.exe').status_code, 400)
+        self.assertEqual(self.start(size=0).status_code, 400)
+        with override_settings(UPLOAD_SESSION_MAX_SIZE=len(self.content) - 1):
+            response = self.start()
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(UploadSession.objects.count(), 1)
+    
+    def test_complete_creates_document_without_copying(self):
+        """Test completing a session moves the assembled file into the blob store"""
+        url = self.start().json()['url']
+        session = UploadSession.objects.get()
+        complete_url = reverse('complete_upload_session', args=[session.pk])
+        
+        self.put(url, 0, self.content[:100])
+        response = self.client.post(complete_url, {'title': 'Large', 'category': self.category.pk})
+        self.assertEqual(response.status_code, 409)
+        
+        self.put(url, 100, self.content[100:])
+        temp_path = uploads.temp_path(session)
+        inode = os.stat(temp_path).st_ino
+        response = self.client.post(complete_url, {'title': 'Large', 'category': self.category.pk})
+        self.assertEqual(response.status_code, 201)
+        
+        document = Document.objects.get(pk=response.json()['id'])
+        self.assertEqual(document.owner, self.owner)
+        self.assertEqual(document.get_filename(), 'large.pdf')
+        self.assertEqual(document.sha256, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(document.versions.get().file.name, document.file.name)
+        with document.file.open('rb') as file:
+            self.assertEqual(file.read(), self.content)
+        # The assembled file itself was moved into the blob store
+        self.assertEqual(os.stat(document.file.path).st_ino, inode)
+        self.assertFalse(os.path.exists(temp_path))
+        self.assertFalse(UploadSession.objects.exists())
+    
+    def test_complete_creates_new_version(self):
+        """Test a session for an existing document adds a version"""
+        document = self.make_document('Report', 'report.pdf', b'first draft')
+        DocumentVersion.objects.create(document=document, file=document.file, version_number=1,
+                                       created_by=self.owner)
+        
+        # Only the owner can upload new versions
+        self.client.force_login(self.other)
+        self.assertEqual(self.start(document=document.pk).status_code, 403)
+        
+        self.client.force_login(self.owner)
+        url = self.start(filename='report v2.pdf', document=document.pk).json()['url']
+        self.put(url, 0, self.content)
+        session = UploadSession.objects.get()
+        response = self.client.post(reverse('complete_upload_session', args=[session.pk]),
+                                    {'version_comment': 'Uploaded in chunks'})
+        self.assertEqual(response.status_code, 201)
+        
+        document.refresh_from_db()
+        version = document.get_latest_version()
+        self.assertEqual(document.current_version, 2)
+        self.assertEqual(version.version_number, 2)
+        self.assertEqual(version.comment, 'Uploaded in chunks')
+        self.assertEqual(document.file.name, version.file.name)
+        self.assertEqual(document.get_filename(), 'report v2.pdf')
+        self.assertEqual(Blob.objects.get(name=version.file.name).ref_count, 2)
+    
+    def test_sessions_are_private_and_expire(self):
+        """Test other users can't see a session and expired sessions are cleaned up"""
+        url = self.start().json()['url']
+        session = UploadSession.objects.get()
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(url).status_code, 404)
+        self.assertEqual(self.put(url, 0, self.content).status_code, 404)
+        
+        fresh = uploads.create_session(self.owner, 'fresh.pdf', 10)
+        UploadSession.objects.filter(pk=session.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        call_command('cleanup_upload_sessions', stdout=io.StringIO())
+        self.assertEqual(list(UploadSession.objects.all()), [fresh])
+        self.assertFalse(os.path.exists(uploads.temp_path(session)))
+        self.assertTrue(os.path.exists(uploads.temp_path(fresh)))
+    
+    def test_expired_sessions_take_no_chunks(self):
+        """Test an expired session refuses chunks and completion until it is cleaned up"""
+        url = self.start().json()['url']
+        session = UploadSession.objects.get()
+        self.put(url, 0, self.content)
+        UploadSession.objects.filter(pk=session.pk).update(expires_at=timezone.now() - timedelta(minutes=1))
+        
+        response = self.put(url, 0, self.content[:10])
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.json()['error'], 'The upload session has expired.')
+        response = self.client.post(reverse('complete_upload_session', args=[session.pk]),
+                                    {'title': 'Large', 'category': self.category.pk})
+        self.assertEqual(response.status_code, 410)
+        self.assertFalse(Document.objects.exists())
+        self.assertEqual(self.client.get(reverse('create_upload_session')).json()['sessions'], [])
+        # The expiry was not extended
+        self.assertEqual(self.client.get(url).status_code, 410)
+    
+    def test_abort_deletes_session(self):
+        """Test DELETE discards the session and its partial file"""
+        url = self.start().json()['url']
+        session = UploadSession.objects.get()
+        self.put(url, 0, self.content[:10])
+        self.assertEqual(self.client.delete(url).status_code, 204)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(os.path.exists(uploads.temp_path(session)))
+
+
+@override_settings(VERSION_DELTA_STORAGE=True, VERSION_DELTA_BACKGROUND=False, TEXT_EXTRACTION_BACKGROUND=False)
+class DeltaStorageTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        # An Office 97-2003 header, then content that doesn't compress or repeat
+        self.content = b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1' + os.urandom(200 * 1024)
+        # A small edit in the middle of the file
+        self.edited = self.content[:90000] + b'new cell' + self.content[90000:]
+    
+    def upload(self, title='Forecast'):
+        self.client.post(reverse('upload_document'), {
+            'title': title, 'category': self.category.pk,
+            'file': SimpleUploadedFile('forecast.doc', self.content),
+        })
+        return Document.objects.get(title=title)
+    
+    def edit(self, document, content):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('edit_document', args=[document.pk]), {
+                'title': document.title, 'category': self.category.pk,
+                'file': SimpleUploadedFile('forecast.doc', content),
+            })
+    
+    def test_chunk_boundaries_follow_content(self):
+        """Test an insertion only changes the chunks around it"""
+        chunks = list(delta.iter_chunks(io.BytesIO(self.content)))
+        edited = list(delta.iter_chunks(io.BytesIO(self.edited)))
+        self.assertEqual(b''.join(chunks), self.content)
+        self.assertEqual(b''.join(edited), self.edited)
+        self.assertTrue(all(len(chunk) <= delta.MAX_CHUNK_SIZE for chunk in chunks))
+        self.assertLessEqual(len(set(edited) - set(chunks)), 2)
+    
+    def test_older_versions_are_packed(self):
+        """Test a new version packs the previous one and stores only new chunks"""
+        document = self.upload()
+        old_blob = Blob.objects.get(sha256=hashlib.sha256(self.content).hexdigest())
+        old_path = os.path.join(TEMP_MEDIA_ROOT, old_blob.name)
+        self.edit(document, self.edited)
+        
+        first = document.versions.get(version_number=1)
+        self.assertEqual(first.file.name, '')
+        self.assertGreater(first.chunks.count(), 1)
+        self.assertFalse(Blob.objects.filter(pk=old_blob.pk).exists())
+        self.assertFalse(os.path.exists(old_path))
+        # The latest version stays a plain file
+        self.assertTrue(document.versions.get(version_number=2).file)
+        
+        self.edit(document, self.content)
+        second = document.versions.get(version_number=2)
+        self.assertEqual(second.file.name, '')
+        # Version 2 shares all but the edited chunks with version 1
+        shared = set(first.chunks.values_list('name', flat=True)) & set(second.chunks.values_list('name', flat=True))
+        self.assertGreaterEqual(len(shared), second.chunks.count() - 2)
+        
+        report, = delta.storage_report([document])
+        self.assertEqual(report['versions'], 3)
+        self.assertEqual(report['logical_bytes'], 2 * len(self.content) + len(self.edited))
+        # Version 2 only costs its edited chunks
+        self.assertGreater(report['saved_bytes'], len(self.edited) - 2 * delta.MAX_CHUNK_SIZE)
+        
+        document.delete()
+        self.assertFalse(Blob.objects.exists())
+    
+    def test_packed_versions_download(self):
+        """Test packed versions are streamed back whole or by range"""
+        document = self.upload()
+        self.edit(document, self.edited)
+        url = reverse('download_version', args=[document.pk, 1])
+        
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertIn('forecast.doc', response['Content-Disposition'])
+        
+        response = self.client.get(url, headers={'Range': 'bytes=70000-140000'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[70000:140001])
+        
+        response = self.client.get(reverse('download_version', args=[document.pk, 2]))
+        self.assertEqual(b''.join(response.streaming_content), self.edited)
+        
+        Document.objects.filter(pk=document.pk).update(is_private=True)
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(url).status_code, 403)
+    
+    def test_packing_queries_do_not_grow_with_chunk_count(self):
+        """Test chunks are stored and referenced in bulk rather than one by one"""
+        def pack(title, size):
+            self.content = self.content[:8] + os.urandom(size)
+            document = self.upload(title)
+            with override_settings(VERSION_DELTA_STORAGE=False):
+                self.edit(document, self.content + b'new cell')
+            version = document.versions.get(version_number=1)
+            with CaptureQueriesContext(connection) as queries:
+                delta.pack_version(version.pk)
+            with delta.open_version(version) as file:
+                self.assertEqual(file.read(), self.content)
+            return version.chunks.count(), [query for query in queries if 'SAVEPOINT' not in query['sql']]
+        
+        few, few_queries = pack('Small', 200 * 1024)
+        many, many_queries = pack('Large', 1024 * 1024)
+        self.assertGreater(many, few + 40)
+        self.assertEqual(len(many_queries), len(few_queries))
+    
+    def test_pack_versions_command(self):
+        """Test the command packs existing history and reports savings"""
+        document = self.upload()
+        # Created while delta storage was off
+        with override_settings(VERSION_DELTA_STORAGE=False):
+            self.edit(document, self.edited)
+        self.assertTrue(document.versions.get(version_number=1).file)
+        
+        out = io.StringIO()
+        call_command('pack_versions', stdout=out)
+        self.assertEqual(document.versions.get(version_number=1).file.name, '')
+        self.assertIn(f'Document {document.pk}: 2 version(s)', out.getvalue())
+        
+        version = document.versions.get(version_number=1)
+        with delta.open_version(version) as file:
+            self.assertEqual(file.read(), self.content)
+        self.assertEqual(extraction.extract_version(version.pk), 'unsupported')
+    
+    def test_failed_versions_leave_no_chunks(self):
+        """Test a version that fails to pack leaves no chunk files and others still pack"""
+        def blob_files():
+            return {
+                os.path.join(root, name)
+                for root, dirs, names in os.walk(os.path.join(TEMP_MEDIA_ROOT, 'blobs')) for name in names
+            }
+        
+        broken = self.upload('Broken')
+        with override_settings(VERSION_DELTA_STORAGE=False):
+            self.edit(broken, self.edited)
+        broken.versions.filter(version_number=1).update(sha256='0' * 64)
+        before = blob_files()
+        with self.assertRaisesMessage(ValueError, 'does not match its recorded SHA-256'):
+            delta.pack_version(broken.versions.get(version_number=1).pk)
+        self.assertEqual(blob_files(), before)
+        
+        self.content = self.content[:8] + b'another forecast ' * 2000
+        document = self.upload()
+        with override_settings(VERSION_DELTA_STORAGE=False):
+            self.edit(document, self.edited)
+        out, err = io.StringIO(), io.StringIO()
+        call_command('pack_versions', stdout=out, stderr=err)
+        self.assertIn('does not match its recorded SHA-256', err.getvalue())
+        self.assertIn('1 version(s) could not be packed.', out.getvalue())
+        self.assertTrue(broken.versions.get(version_number=1).file)
+        self.assertEqual(document.versions.get(version_number=1).file.name, '')
+
+
+@override_settings(COLD_STORAGE_ROOT=None, COLD_STORAGE_GRACE_DAYS=30, COLD_STORAGE_THAW_BACKGROUND=False)
+class ColdStorageTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = b'%PDF-1.4 ' + b'quarterly ledger line ' * 5000 + os.urandom(16)
+    
+    def upload(self, title, content):
+        self.client.post(reverse('upload_document'), {
+            'title': title, 'category': self.category.pk,
+            'file': SimpleUploadedFile(f'{title}.pdf', content),
+        })
+        return Document.objects.get(title=title)
+    
+    def archive(self, document, days_ago):
+        Document.objects.filter(pk=document.pk).update(
+            is_archived=True, archived_at=timezone.now() - timedelta(days=days_ago)
+        )
+    
+    def move(self):
+        out = io.StringIO()
+        call_command('move_to_cold_storage', stdout=out)
+        return out.getvalue()
+    
+    def test_archived_files_move_to_cold_storage(self):
+        """Test files archived past the grace period are compressed and read back transparently"""
+        document = self.upload('ledger', self.content)
+        hot_path = document.file.path
+        self.archive(document, days_ago=40)
+        
+        output = self.move()
+        self.assertIn('Moved 1 file(s) to cold storage', output)
+        blob = Blob.objects.get(name=document.file.name)
+        self.assertEqual(blob.tier, 'cold')
+        self.assertLess(blob.cold_size_bytes, blob.size_bytes // 10)
+        self.assertFalse(os.path.exists(hot_path))
+        self.assertTrue(os.path.exists(os.path.join(tiering.cold_root(), tiering.cold_name(blob.name))))
+        
+        response = self.client.get(reverse('download_document', args=[document.pk]))
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        response = self.client.get(reverse('download_document', args=[document.pk]),
+                                   headers={'Range': 'bytes=50000-50099'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content), self.content[50000:50100])
+        
+        response = self.client.post(reverse('export_documents'), {'document_ids': [document.pk]})
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            self.assertEqual(archive.read('ledger.pdf'), self.content)
+    
+    def test_restore_brings_files_back(self):
+        """Test restoring a document decompresses its files into hot storage"""
+        document = self.upload('ledger', self.content)
+        self.archive(document, days_ago=40)
+        self.move()
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('restore_document', args=[document.pk]))
+        blob = Blob.objects.get(name=document.file.name)
+        self.assertEqual(blob.tier, 'hot')
+        with open(document.file.path, 'rb') as file:
+            self.assertEqual(file.read(), self.content)
+        self.assertFalse(os.path.exists(os.path.join(tiering.cold_root(), tiering.cold_name(blob.name))))
+    
+    @override_settings(JOB_QUEUE_ENABLED=True)
+    def test_restore_queues_the_move_back(self):
+        """Test restoring a document leaves decompression to a job and serves the cold copy meanwhile"""
+        document = self.upload('ledger', self.content)
+        self.archive(document, days_ago=40)
+        self.move()
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('restore_document', args=[document.pk]))
+        self.assertEqual(Blob.objects.get(name=document.file.name).tier, 'cold')
+        response = self.client.get(reverse('download_document', args=[document.pk]))
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        
+        job = Job.objects.get(name='thaw_document')
+        self.assertEqual(job.kwargs, {'document_id': document.pk})
+        self.assertEqual(jobs.run_job(jobs.lease('worker', 1)[0].pk, 'worker'), 'done')
+        self.assertEqual(Blob.objects.get(name=document.file.name).tier, 'hot')
+        self.assertTrue(os.path.exists(document.file.path))
+    
+    def test_compressed_formats_stay_hot(self):
+        """Test files that are already compressed aren't moved to cold storage"""
+        self.client.post(reverse('upload_document'), {
+            'title': 'scan', 'category': self.category.pk,
+            'file': SimpleUploadedFile('scan.png', make_image(size=(50, 50))),
+        })
+        document = Document.objects.get(title='scan')
+        self.archive(document, days_ago=40)
+        
+        self.assertIn('Moved 0 file(s)', self.move())
+        self.assertEqual(Blob.objects.get(name=document.file.name).tier, 'hot')
+        self.assertTrue(os.path.exists(document.file.path))
+    
+    def test_only_files_unused_by_active_documents_move(self):
+        """Test recent archives and content shared with active documents stay hot"""
+        old = self.upload('old', self.content)
+        self.upload('active copy', self.content)
+        recent = self.upload('recent', b'%PDF-1.4 recent')
+        self.archive(old, days_ago=40)
+        self.archive(recent, days_ago=5)
+        
+        self.assertIn('Moved 0 file(s)', self.move())
+        self.assertFalse(Blob.objects.filter(tier='cold').exists())
+        
+        Document.objects.get(title='active copy').delete()
+        self.assertIn('Moved 1 file(s)', self.move())
+        blob = Blob.objects.get(name=old.file.name)
+        self.assertEqual(blob.tier, 'cold')
+        
+        # Deleting the last reference deletes the cold copy too
+        old.delete()
+        self.assertFalse(Blob.objects.filter(pk=blob.pk).exists())
+        self.assertFalse(os.path.exists(os.path.join(tiering.cold_root(), tiering.cold_name(blob.name))))
+    
+    def test_reused_cold_files_move_back(self):
+        """Test cold content uploaded again by an active document is moved back to hot storage"""
+        old = self.upload('old', self.content)
+        self.archive(old, days_ago=40)
+        self.move()
+        
+        copy = self.upload('new copy', self.content)
+        self.assertEqual(copy.file.name, old.file.name)
+        self.assertIn('0 file(s) to cold storage and 1 back', self.move())
+        self.assertEqual(Blob.objects.get(name=old.file.name).tier, 'hot')
+        self.assertTrue(os.path.exists(copy.file.path))
+
+
+@override_settings(MEDIA_SERVING_BACKEND='python')
+class MediaServingTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.content = b'%PDF-1.4 media ' + os.urandom(32)
+        self.document = self.make_document('Statement', 'statement.pdf', self.content, is_private=True)
+        self.url = settings.MEDIA_URL + self.document.file.name
+    
+    def test_media_requires_access(self):
+        """Test media files are only served to users who may see the document"""
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 302)
+        
+        self.client.force_login(self.owner)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertIn('statement.pdf', response['Content-Disposition'])
+        
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        Document.objects.filter(pk=self.document.pk).update(is_private=False)
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        # Files no document uses, such as upload sessions, are never served
+        self.assertEqual(self.client.get(settings.MEDIA_URL + 'upload_sessions/x.part').status_code, 404)
+    
+    @override_settings(MEDIA_SERVING_BACKEND='x-accel-redirect', MEDIA_ACCEL_REDIRECT_PREFIX='/internal/')
+    def test_x_accel_redirect(self):
+        """Test nginx is told which file to send once access is checked"""
+        with self.assertNumQueries(3):
+            response = self.client.get(reverse('download_document', args=[self.document.pk]))
+        self.assertEqual(response['X-Accel-Redirect'], '/internal/' + self.document.file.name)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        self.assertIn('statement.pdf', response['Content-Disposition'])
+        
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+    
+    @override_settings(MEDIA_SERVING_BACKEND='x-sendfile')
+    def test_x_sendfile_counts_shared_downloads(self):
+        """Test X-Sendfile responses count downloads of shared links, but not resumed ones"""
+        share = DocumentShare.objects.create(document=self.document, shared_by=self.owner)
+        url = reverse('download_shared_document', args=[share.token])
+        response = self.client.get(url)
+        self.assertEqual(response['X-Sendfile'], self.document.file.path)
+        self.client.get(url, headers={'Range': 'bytes=10-'})
+        share.refresh_from_db()
+        self.assertEqual(share.download_count, 1)
+    
+    @override_settings(MEDIA_SERVING_BACKEND='x-accel-redirect')
+    def test_cold_files_are_streamed(self):
+        """Test files the web server can't read directly fall back to streaming"""
+        Document.objects.filter(pk=self.document.pk).update(
+            is_archived=True, archived_at=timezone.now() - timedelta(days=90)
+        )
+        with override_settings(COLD_STORAGE_ROOT=None):
+            tiering.migrate(grace_days=30)
+            response = self.client.get(self.url)
+            self.assertNotIn('X-Accel-Redirect', response)
+            self.assertEqual(b''.join(response.streaming_content), self.content)
+
+
+def make_image(size=(1200, 800), mode='RGB', format='PNG'):
+    output = io.BytesIO()
+    color = (200, 30, 30, 128) if mode == 'RGBA' else (200, 30, 30)
+    Image.new(mode, size, color).save(output, format)
+    return output.getvalue()
+
+
+@override_settings(THUMBNAIL_BACKGROUND=False, TEXT_EXTRACTION_BACKGROUND=False)
+class ThumbnailTestCase(DocumentTestCase):
+    def upload(self, name, content, is_private=False):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload_document'), {
+                'title': name, 'category': self.category.pk, 'is_private': is_private,
+                'file': SimpleUploadedFile(name, content),
+            })
+        return Document.objects.get(title=name)
+    
+    def test_renditions_are_rendered_after_upload(self):
+        """Test each size is rendered once per content, fitting its box"""
+        document = self.upload('logo.png', make_image(mode='RGBA'))
+        for size, pixels in thumbnails.SIZES.items():
+            self.assertTrue(thumbnails.thumbnail_exists(document.sha256, size))
+            with Image.open(default_storage.path(thumbnails.rendition_name(document.sha256, size))) as image:
+                self.assertEqual(image.format, 'JPEG')
+                self.assertEqual(max(image.size), pixels)
+        
+        pdf = self.upload('notes.pdf', b'%PDF-1.4 not an image')
+        self.assertFalse(thumbnails.thumbnail_exists(pdf.sha256, 'small'))
+        
+        response = self.client.get(reverse('dashboard'))
+        self.assertContains(response, reverse('document_thumbnail', args=[document.sha256, 'small']))
+        response = self.client.get(reverse('document_detail', args=[document.pk]))
+        self.assertContains(response, reverse('document_thumbnail', args=[document.sha256, 'medium']))
+    
+    def test_thumbnail_view(self):
+        """Test thumbnails are served with long-lived cache headers to users who may see them"""
+        document = self.upload('photo.jpg', make_image(format='JPEG'), is_private=True)
+        url = reverse('document_thumbnail', args=[document.sha256, 'small'])
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'image/jpeg')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertIn('max-age=31536000', response['Cache-Control'])
+        self.assertTrue(b''.join(response.streaming_content).startswith(b'\xff\xd8'))
+        
+        self.assertEqual(self.client.get(reverse('document_thumbnail', args=[document.sha256, 'huge'])).status_code, 404)
+        self.client.force_login(self.other)
+        self.assertEqual(self.client.get(url).status_code, 404)
+    
+    def test_process_pool_and_command(self):
+        """Test rendering runs in spawned worker processes and the command backfills"""
+        document = self.make_document('Scan', 'scan.png', make_image(size=(300, 200)))
+        self.assertFalse(thumbnails.thumbnail_exists(document.sha256, 'small'))
+        
+        targets = [(64, os.path.join(TEMP_MEDIA_ROOT, 'pool-test.jpg'))]
+        try:
+            written = thumbnails._get_executor().submit(imaging.render, document.file.path, targets).result()
+        finally:
+            thumbnails._executor.shutdown()
+            thumbnails._executor = None
+        self.assertEqual(written, [targets[0][1]])
+        
+        other = self.make_document('Other scan', 'other.png', make_image(size=(200, 300)))
+        out = io.StringIO()
+        call_command('generate_thumbnails', workers=1, batch_size=1, stdout=out)
+        self.assertIn('Rendered thumbnails for 2 image(s), 0 failed', out.getvalue())
+        # Never enlarged
+        with Image.open(default_storage.path(thumbnails.rendition_name(document.sha256, 'large'))) as image:
+            self.assertEqual(image.size, (300, 200))
+        self.assertEqual(Document.objects.filter(pk__in=[document.pk, other.pk], thumbnails_rendered=True).count(), 2)
+    
+    def test_listings_read_the_rendered_flag(self):
+        """Test pages showing thumbnails use the row's flag instead of asking storage"""
+        document = self.upload('logo.png', make_image())
+        self.assertTrue(document.thumbnails_rendered)
+        self.assertTrue(document.versions.get().thumbnails_rendered)
+        # Content whose renditions already exist is flagged without rendering again
+        copy = self.upload('copy.png', make_image())
+        self.assertTrue(copy.thumbnails_rendered)
+        
+        with mock.patch.object(thumbnails, 'thumbnail_exists') as exists:
+            response = self.client.get(reverse('dashboard'))
+        exists.assert_not_called()
+        self.assertContains(response, reverse('document_thumbnail', args=[document.sha256, 'small']))
+        
+        Document.objects.filter(pk=document.pk).update(thumbnails_rendered=False)
+        response = self.client.get(reverse('document_detail', args=[document.pk]))
+        self.assertNotContains(response, reverse('document_thumbnail', args=[document.sha256, 'medium']))
+
+
+JOB_CALLS = []
+
+@jobs.task('test_record')
+def record_job(value, fail_times=0):
+    JOB_CALLS.append(value)
+    if JOB_CALLS.count(value) <= fail_times:
+        raise RuntimeError(f'{value} failed')
+
+
+@jobs.task('test_sleep')
+def sleep_job(seconds):
+    time.sleep(seconds)
+    # Another worker polling meanwhile must find nothing to lease
+    JOB_CALLS.append([job.pk for job in jobs.lease('other-worker', 1)])
+
+
+class JobQueueTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        JOB_CALLS.clear()
+    
+    def test_enqueue_waits_for_commit(self):
+        """Test jobs are only created once the transaction commits"""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertIsNone(jobs.enqueue('test_record', value='a'))
+            self.assertFalse(Job.objects.exists())
+        job = Job.objects.get()
+        self.assertEqual((job.name, job.kwargs, job.status), ('test_record', {'value': 'a'}, 'queued'))
+        with self.assertRaises(ValueError):
+            jobs.enqueue('no_such_job')
+    
+    def test_lease_order_and_expiry(self):
+        """Test leases go to due jobs by priority and expired leases are taken over"""
+        low = jobs.enqueue('test_record', on_commit=False, value='low')
+        high = jobs.enqueue('test_record', on_commit=False, priority=5, value='high')
+        jobs.enqueue('test_record', on_commit=False, delay=60, value='later')
+        
+        self.assertEqual(jobs.lease('worker-1', 1), [high])
+        self.assertEqual(jobs.lease('worker-2', 5), [low])
+        self.assertEqual(jobs.lease('worker-3', 5), [])
+        
+        # worker-1 died holding its job
+        Job.objects.filter(pk=high.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        taken, = jobs.lease('worker-3', 5)
+        self.assertEqual((taken, taken.locked_by, taken.attempts), (high, 'worker-3', 2))
+        # The old worker can no longer record an outcome
+        jobs.run_job(high.pk, 'worker-1')
+        self.assertEqual(Job.objects.get(pk=high.pk).locked_by, 'worker-3')
+    
+    def test_abandoned_jobs_fail_after_their_last_attempt(self):
+        """Test a job whose worker dies on every attempt is failed instead of leased forever"""
+        job = jobs.enqueue('test_record', on_commit=False, max_attempts=2, value='crash')
+        for attempt in range(2):
+            self.assertEqual(jobs.lease(f'worker-{attempt}', 1), [job])
+            # The worker was killed running it
+            Job.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        
+        with self.assertLogs('documents.jobs', 'WARNING') as logs:
+            self.assertEqual(jobs.lease('worker-2', 1), [])
+        self.assertIn('1 job(s) failed', logs.output[0])
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts, job.locked_by), ('failed', 2, ''))
+        self.assertIn('stopped before it finished', job.last_error)
+    
+    def test_running_jobs_renew_their_lease(self):
+        """Test a worker's renewal keeps long jobs from being taken over"""
+        job = jobs.enqueue('test_record', on_commit=False, value='long')
+        jobs.lease('worker-1', 1, lease_seconds=1)
+        Job.objects.filter(pk=job.pk).update(locked_until=timezone.now() + timedelta(milliseconds=10))
+        self.assertEqual(jobs.renew('worker-1', [job.pk], lease_seconds=60), 1)
+        # Only the holder of the lease can renew it
+        self.assertEqual(jobs.renew('worker-2', [job.pk]), 0)
+        time.sleep(0.05)
+        self.assertEqual(jobs.lease('worker-2', 1), [])
+        self.assertGreater(Job.objects.get(pk=job.pk).locked_until, timezone.now() + timedelta(seconds=50))
+    
+    def test_retries_with_backoff(self):
+        """Test failing jobs are retried later and marked failed after max_attempts"""
+        job = jobs.enqueue('test_record', on_commit=False, max_attempts=2, value='flaky', fail_times=5)
+        jobs.lease('worker', 1)
+        with self.assertLogs('documents.jobs', 'WARNING') as logs:
+            self.assertEqual(jobs.run_job(job.pk, 'worker'), 'queued')
+        self.assertEqual(logs.output, [f'WARNING:documents.jobs:Job {job.pk} (test_record) failed, attempt 1 of 2'])
+        job.refresh_from_db()
+        self.assertIn('RuntimeError: flaky failed', job.last_error)
+        self.assertGreater(job.run_after, timezone.now() + timedelta(seconds=jobs.BACKOFF_BASE - 2))
+        self.assertEqual(jobs.lease('worker', 1), [])
+        
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        jobs.lease('worker', 1)
+        with self.assertLogs('documents.jobs', 'WARNING') as logs:
+            self.assertEqual(jobs.run_job(job.pk, 'worker'), 'failed')
+        self.assertEqual(logs.output, [f'WARNING:documents.jobs:Job {job.pk} (test_record) failed, attempt 2 of 2'])
+        self.assertEqual(jobs.backoff(1), jobs.BACKOFF_BASE)
+        self.assertEqual(jobs.backoff(30), jobs.BACKOFF_MAX)
+    
+    @override_settings(JOB_QUEUE_ENABLED=True, VERSION_DELTA_STORAGE=True)
+    def test_post_upload_work_is_queued(self):
+        """Test uploads queue extraction, thumbnails and packing as jobs"""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload_document'), {
+                'title': 'Chart', 'category': self.category.pk,
+                'file': SimpleUploadedFile('chart.png', make_image(size=(50, 50))),
+            })
+        document = Document.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('edit_document', args=[document.pk]), {
+                'title': 'Chart', 'category': self.category.pk,
+                'file': SimpleUploadedFile('chart.png', make_image(size=(60, 60))),
+            })
+        self.assertEqual(
+            sorted(Job.objects.values_list('name', 'priority')),
+            [('extract_text', 0), ('extract_text', 0), ('pack_versions', -10),
+             ('render_thumbnails', 10), ('render_thumbnails', 10)]
+        )
+        
+        for job in jobs.lease('worker', 10):
+            self.assertEqual(jobs.run_job(job.pk, 'worker'), 'done')
+        self.assertTrue(thumbnails.thumbnail_exists(document.versions.first().sha256, 'small'))
+        self.assertEqual(document.versions.get(version_number=1).file.name, '')
+
+
+class JobWorkerTestCase(TransactionTestCase):
+    def setUp(self):
+        JOB_CALLS.clear()
+    
+    def test_worker_runs_jobs_on_a_thread_pool(self):
+        """Test a burst worker runs every due job and exits"""
+        for i in range(6):
+            jobs.enqueue('test_record', on_commit=False, value=i)
+        jobs.enqueue('test_record', on_commit=False, value='broken', max_attempts=1, fail_times=1)
+        
+        # One thread, the in-memory test database locks whole tables on write
+        with self.assertLogs('documents.jobs', 'WARNING') as logs:
+            processed = jobs.Worker(concurrency=1, poll_interval=0.05).run(burst=True)
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('(test_record) failed, attempt 1 of 1', logs.output[0])
+        self.assertEqual(processed, 7)
+        self.assertEqual(sorted(JOB_CALLS, key=str), sorted([0, 1, 2, 3, 4, 5, 'broken'], key=str))
+        self.assertEqual(Job.objects.filter(status='done').count(), 6)
+        self.assertEqual(Job.objects.get(status='failed').kwargs['value'], 'broken')
+        
+        out = io.StringIO()
+        call_command('run_worker', burst=True, stdout=out)
+        self.assertIn('Processed 0 job(s)', out.getvalue())
+    
+    def test_worker_renews_leases_of_long_jobs(self):
+        """Test a job outliving its lease is not leased again while it runs"""
+        jobs.enqueue('test_sleep', on_commit=False, seconds=0.6)
+        worker = jobs.Worker(concurrency=1, poll_interval=0.05, lease_seconds=0.3)
+        self.assertEqual(worker.run(burst=True), 1)
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), ('done', 1))
+        self.assertEqual(JOB_CALLS, [[]])
+
+
+@override_settings(TEXT_EXTRACTION_BACKGROUND=False)
+class BulkImportTestCase(DocumentTestCase):
+    def files(self, count, prefix='report'):
+        return [SimpleUploadedFile(f'{prefix} {i}.pdf', f'%PDF-1.4 {prefix} {i}'.encode()) for i in range(count)]
+    
+    def test_import_view_reports_failed_files(self):
+        """Test the import page imports valid files and lists the ones that failed"""
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('import_documents'), {
+                'files': self.files(2) + [SimpleUploadedFile('notes.txt', b'plain text')],
+                'category': self.category.pk,
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'notes.txt')
+        self.assertContains(response, 'Unsupported file type')
+        
+        documents = Document.objects.order_by('title')
+        self.assertEqual([document.title for document in documents], ['report 0', 'report 1'])
+        document = documents[0]
+        self.assertEqual((document.category, document.original_filename), (self.category, 'report 0.pdf'))
+        version = document.versions.get()
+        self.assertEqual((version.file.name, version.sha256), (document.file.name, document.sha256))
+        self.assertEqual(version.text_status, 'done')
+        self.assertEqual(Blob.objects.get(name=document.file.name).ref_count, 2)
+        self.assertEqual(Notification.objects.filter(user=self.owner, notification_type='upload').count(), 2)
+        total = AnalyticsCounter.objects.get(dimension='total', key='')
+        self.assertEqual((total.document_count, total.total_bytes), (2, sum(d.size_bytes for d in documents)))
+        self.assertEqual(DailyActivity.objects.get().uploads, 2)
+        found, ranked = search.search_documents(Document.objects.all(), 'report')
+        self.assertEqual({d.pk for d in found}, {d.pk for d in documents})
+    
+    def test_queries_do_not_grow_with_file_count(self):
+        """Test a batch takes the same number of queries for 3 files as for 12"""
+        # The first import creates the analytics rows
+        importer.import_files(self.files(1, 'first'), self.owner, category=self.category)
+        with CaptureQueriesContext(connection) as few:
+            importer.import_files(self.files(3, 'few'), self.owner, category=self.category)
+        with CaptureQueriesContext(connection) as many:
+            results = importer.import_files(self.files(12, 'many'), self.owner, category=self.category)
+        self.assertEqual(len(few), len(many))
+        self.assertEqual({result['status'] for result in results}, {'imported'})
+        self.assertEqual(Document.objects.count(), 16)
+        
+        # Identical content in one batch is stored once
+        results = importer.import_files(self.files(2, 'few') + self.files(2, 'few'), self.owner)
+        blob = Blob.objects.get(sha256=Document.objects.get(pk=results[0]['document']).sha256)
+        self.assertEqual(blob.ref_count, 6)
+    
+    def test_failed_batch_leaves_nothing_behind(self):
+        """Test a batch whose insert fails creates no rows and keeps no files"""
+        with mock.patch.object(Notification.objects, 'bulk_create', side_effect=RuntimeError('disk full')):
+            with self.assertLogs('documents.importer', 'ERROR'):
+                results = importer.import_files(self.files(3, 'lost'), self.owner)
+        self.assertEqual([result['status'] for result in results], ['failed'] * 3)
+        self.assertEqual(results[0]['error'], 'disk full')
+        self.assertFalse(Document.objects.exists())
+        self.assertFalse(Blob.objects.exists())
+        for sha256 in {hashlib.sha256(f'%PDF-1.4 lost {i}'.encode()).hexdigest() for i in range(3)}:
+            self.assertFalse(default_storage.exists(f'blobs/{sha256[:2]}/{sha256}.pdf'))
+    
+    def test_import_directory_command(self):
+        """Test a directory tree is imported with a category per top-level folder"""
+        root = tempfile.mkdtemp()
+        for path, content in [
+            ('readme.pdf', b'%PDF-1.4 top'), ('Finance/budget.xlsx', b'PK\x03\x04 budget'),
+            ('Finance/2023/q1.pdf', b'%PDF-1.4 q1'), ('Legal/notes.txt', b'notes'),
+        ]:
+            os.makedirs(os.path.dirname(os.path.join(root, path)), exist_ok=True)
+            with open(os.path.join(root, path), 'wb') as file:
+                file.write(content)
+        report = os.path.join(tempfile.mkdtemp(), 'report.csv')
+        
+        out, err = io.StringIO(), io.StringIO()
+        call_command('import_directory', root, owner='owner', batch_size=2, stdout=out, stderr=err)
+        self.assertIn('Imported 3 file(s), skipped 0, 1 failed.', out.getvalue())
+        self.assertIn(os.path.join('Legal', 'notes.txt'), err.getvalue())
+        self.assertEqual(
+            sorted(Document.objects.values_list('original_filename', 'category__name')),
+            [('budget.xlsx', 'Finance'), ('q1.pdf', 'Finance'), ('readme.pdf', None)]
+        )
+        # Source files are copied, never moved
+        self.assertTrue(os.path.exists(os.path.join(root, 'Finance', 'budget.xlsx')))
+        
+        call_command('import_directory', root, owner='owner', skip_existing=True, report=report,
+                     stdout=out, stderr=io.StringIO())
+        self.assertIn('Imported 0 file(s), skipped 3, 1 failed.', out.getvalue())
+        self.assertEqual(Document.objects.count(), 3)
+        with open(report) as file:
+            self.assertEqual(len(file.read().splitlines()), 5)
+
+
+@override_settings(TEXT_EXTRACTION_BACKGROUND=False, VERSION_DELTA_STORAGE=True, VERSION_DELTA_BACKGROUND=False)
+class ArchiveTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        self.first = b'%PDF-1.4 ' + os.urandom(40000)
+        self.second = self.first[:20000] + b' amended ' + self.first[20000:]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload_document'), {
+                'title': 'Lease', 'description': 'Office lease', 'category': self.category.pk,
+                'file': SimpleUploadedFile('lease.pdf', self.first),
+            })
+        self.document = Document.objects.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('edit_document', args=[self.document.pk]), {
+                'title': 'Lease', 'description': 'Office lease', 'category': self.category.pk,
+                'file': SimpleUploadedFile('lease v2.pdf', self.second),
+            })
+        Comment.objects.create(document=self.document, user=self.other, text='Check clause 4')
+        Document.objects.filter(pk=self.document.pk).update(uploaded_at=timezone.now() - timedelta(days=400))
+        self.document.refresh_from_db()
+    
+    def export(self):
+        response = self.client.post(reverse('export_documents'), {
+            'document_ids': [self.document.pk], 'format': 'archive',
+        })
+        self.assertIn('documents_archive_', response['Content-Disposition'])
+        return b''.join(response.streaming_content)
+    
+    def test_archive_round_trips_metadata_and_history(self):
+        """Test an exported archive imports with its metadata, versions and comments"""
+        # Version 1 was packed into delta chunks, the archive still holds it whole
+        self.assertEqual(self.document.versions.get(version_number=1).file.name, '')
+        data = self.export()
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            names = archive.namelist()
+            self.assertEqual(names[0], archives.MANIFEST_NAME)
+            self.assertEqual(len([name for name in names if name.startswith('files/')]), 2)
+            lines = archive.read(archives.MANIFEST_NAME).decode().splitlines()
+        self.assertEqual(json.loads(lines[0])['format'], archives.FORMAT)
+        self.assertEqual(len(lines), 2)
+        
+        path = os.path.join(tempfile.mkdtemp(), 'archive.zip')
+        with open(path, 'wb') as file:
+            file.write(data)
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('import_archive', path, owner='other', keep_users=True, stdout=out)
+        self.assertIn('Imported 1 document(s), 0 failed.', out.getvalue())
+        
+        copy = Document.objects.exclude(pk=self.document.pk).get()
+        self.assertEqual(
+            (copy.title, copy.description, copy.category, copy.owner, copy.uploaded_at, copy.original_filename),
+            ('Lease', 'Office lease', self.category, self.owner, self.document.uploaded_at, 'lease v2.pdf')
+        )
+        self.assertEqual(
+            list(copy.versions.values_list('version_number', 'original_filename', 'created_by__username')),
+            [(2, 'lease v2.pdf', 'owner'), (1, 'lease.pdf', 'owner')]
+        )
+        self.assertEqual(list(copy.comments.values_list('user__username', 'text')), [('other', 'Check clause 4')])
+        # Contents already stored are shared, not written again
+        self.assertEqual(Blob.objects.get(sha256=copy.sha256).ref_count, 4)
+        self.assertEqual(AnalyticsCounter.objects.get(dimension='total', key='').document_count, 2)
+        
+        response = self.client.get(reverse('download_version', args=[copy.pk, 1]))
+        self.assertEqual(b''.join(response.streaming_content), self.first)
+    
+    def test_import_page_accepts_archives(self):
+        """Test the import page imports archives as the importing user and rejects bad contents"""
+        data = self.export()
+        with zipfile.ZipFile(io.BytesIO(data)) as archive:
+            manifest = archive.read(archives.MANIFEST_NAME).decode().splitlines()
+            files = {name: archive.read(name) for name in archive.namelist() if name.startswith('files/')}
+        good = json.loads(manifest[1])
+        tampered = json.loads(manifest[1])
+        tampered['title'] = 'Tampered'
+        tampered['file']['sha256'] = hashlib.sha256(b'someone else\'s file').hexdigest()
+        missing = json.loads(manifest[1])
+        missing['title'] = 'Missing'
+        missing['versions'][0]['file']['path'] = 'files/nowhere.pdf'
+        
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w') as archive:
+            archive.writestr(archives.MANIFEST_NAME, '\n'.join(
+                [manifest[0]] + [json.dumps(record) for record in (good, tampered, missing)] + ['{not json']
+            ))
+            for name, content in files.items():
+                archive.writestr(name, content)
+        
+        self.client.force_login(self.other)
+        response = self.client.post(reverse('import_documents'), {
+            'files': [SimpleUploadedFile('transfer.zip', output.getvalue())],
+        })
+        self.assertContains(response, 'Tampered')
+        self.assertContains(response, 'does not match its SHA-256')
+        self.assertContains(response, 'files/nowhere.pdf is missing from the archive')
+        self.assertContains(response, 'Invalid manifest line 5')
+        copy = Document.objects.get(owner=self.other)
+        self.assertEqual(copy.title, 'Lease')
+        self.assertEqual(set(copy.versions.values_list('created_by', flat=True)), {self.other.pk})
+        self.assertEqual(copy.comments.get().user, self.other)
+    
+    def test_unsupported_archives_fail_without_an_error_page(self):
+        """Test an archive from another format version is reported as a failed file"""
+        with zipfile.ZipFile(io.BytesIO(self.export())) as archive:
+            header, *lines = archive.read(archives.MANIFEST_NAME).decode().splitlines()
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, 'w') as archive:
+            header = dict(json.loads(header), version=archives.FORMAT_VERSION + 1)
+            archive.writestr(archives.MANIFEST_NAME, '\n'.join([json.dumps(header)] + lines))
+        
+        response = self.client.post(reverse('import_documents'), {
+            'files': [SimpleUploadedFile('future.zip', output.getvalue())],
+        })
+        self.assertContains(response, 'future.zip')
+        self.assertContains(response, f'Unsupported archive version {archives.FORMAT_VERSION + 1}')
+        self.assertEqual(Document.objects.count(), 1)
+    
+    def test_import_adds_to_the_activity_rollup(self):
+        """Test an import adds its documents' activity on their own days and keeps existing history"""
+        data = self.export()
+        # Activity of a document deleted since, which no rebuild could recover
+        DailyActivity.objects.create(day=date(2020, 1, 1), uploads=3)
+        upload_day = timezone.localdate(self.document.uploaded_at)
+        # setUp moved the upload back without signals, so that day has no row yet
+        self.assertFalse(DailyActivity.objects.filter(day=upload_day).exists())
+        
+        results = list(archives.import_archive(io.BytesIO(data), self.other))
+        self.assertEqual([result['status'] for result in results], ['imported'])
+        self.assertEqual(DailyActivity.objects.get(day=date(2020, 1, 1)).uploads, 3)
+        self.assertEqual(DailyActivity.objects.get(day=upload_day).uploads, 1)
+        self.assertEqual(AnalyticsCounter.objects.get(dimension='total', key='').document_count, 2)
+        self.assertEqual(
+            AnalyticsCounter.objects.get(dimension='owner', key=str(self.other.pk)).document_count, 1
+        )
+
+
+@override_settings(TEXT_EXTRACTION_BACKGROUND=False, THUMBNAIL_BACKGROUND=False)
+class MediaGarbageTestCase(DocumentTestCase):
+    def setUp(self):
+        super().setUp()
+        # A tree of its own, so other tests' files aren't swept
+        self.media_root = tempfile.mkdtemp()
+        self.cold_root = tempfile.mkdtemp()
+        overridden = self.settings(MEDIA_ROOT=self.media_root, COLD_STORAGE_ROOT=self.cold_root)
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+        
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('upload_document'), {
+                'title': 'Scan', 'category': self.category.pk,
+                'file': SimpleUploadedFile('scan.png', make_image(size=(40, 40))),
+            })
+        self.document = Document.objects.get()
+        self.session = uploads.create_session(self.owner, 'big.pdf', 10)
+        
+        self.kept = [
+            self.document.file.name,
+            thumbnails.rendition_name(self.document.sha256, 'small'),
+            os.path.relpath(uploads.temp_path(self.session), self.media_root),
+            'document_versions/legacy.pdf',
+        ]
+        self.orphans = [
+            'documents/deleted.pdf',
+            thumbnails.rendition_name('f' * 64, 'small'),
+            f'upload_sessions/{uuid.uuid4()}.part',
+            'blobs/aa/unknown.pdf',
+        ]
+        # A version stored before the blob store
+        DocumentVersion.objects.create(
+            document=self.document, file='document_versions/legacy.pdf', version_number=2, created_by=self.owner
+        )
+        for name in self.kept + self.orphans:
+            self.write(self.media_root, name)
+        self.write(self.cold_root, 'blobs/bb/gone.pdf.xz')
+        # Too recent to collect
+        self.write(self.media_root, 'blobs/cc/just-written.pdf', age=60)
+    
+    def write(self, root, name, age=2 * 24 * 60 * 60):
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            with open(path, 'wb') as file:
+                file.write(b'content')
+        modified = time.time() - age
+        os.utime(path, (modified, modified))
+    
+    def exists(self, root, name):
+        return os.path.exists(os.path.join(root, name))
+    
+    def test_dry_run_lists_orphans_only(self):
+        """Test a dry run reports unreferenced old files and removes nothing"""
+        out = io.StringIO()
+        call_command('collect_media_garbage', dry_run=True, batch_size=2, stdout=out)
+        listed = set(out.getvalue().splitlines()[:-1])
+        self.assertEqual(
+            listed,
+            {os.path.join(self.media_root, name) for name in self.orphans}
+            | {os.path.join(self.cold_root, 'blobs/bb/gone.pdf.xz')}
+        )
+        self.assertIn('Would remove 5 orphaned file(s)', out.getvalue())
+        for name in self.orphans:
+            self.assertTrue(self.exists(self.media_root, name))
+    
+    def test_orphans_are_deleted_or_quarantined(self):
+        """Test orphans are moved to quarantine or deleted and referenced files kept"""
+        quarantine = os.path.join(self.media_root, 'quarantine')
+        collected = list(media_gc.collect(quarantine=quarantine, batch_size=3))
+        self.assertEqual(len(collected), 5)
+        for name in self.orphans:
+            self.assertFalse(self.exists(self.media_root, name))
+            self.assertTrue(self.exists(os.path.join(quarantine, os.path.basename(self.media_root)), name))
+        for name in self.kept + ['blobs/cc/just-written.pdf']:
+            self.assertTrue(self.exists(self.media_root, name))
+        
+        # The quarantine is not swept, files past no grace period are
+        self.assertEqual(list(media_gc.collect(grace_hours=0, quarantine=quarantine)), [
+            (os.path.join(self.media_root, 'blobs/cc/just-written.pdf'), len(b'content'))
+        ])
+        self.assertFalse(self.exists(self.media_root, 'blobs/cc/just-written.pdf'))
+    
+    def test_deleting_a_document_deletes_its_legacy_files(self):
+        """Test files stored before the blob store are deleted with their last row"""
+        with self.captureOnCommitCallbacks(execute=True):
+            self.document.delete()
+        self.assertFalse(self.exists(self.media_root, 'document_versions/legacy.pdf'))
+        self.assertFalse(self.exists(self.media_root, self.kept[0]))
+
+
+class UploadInspectionTestCase(DocumentTestCase):
+    def upload(self, name, content):
+        return self.client.post(reverse('upload_document'), {
+            'title': name, 'category': self.category.pk, 'file': SimpleUploadedFile(name, content),
+        })
+    
+    @override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0)
+    def test_saving_an_upload_does_not_read_it_again(self):
+        """Test the hash and size measured while receiving are saved without a second read"""
+        content = b'%PDF-1.4 ' + os.urandom(200000)
+        with mock.patch.object(TemporaryUploadedFile, 'chunks', side_effect=AssertionError('read again')):
+            self.upload('measured.pdf', content)
+        document = Document.objects.get()
+        version = document.versions.get()
+        self.assertEqual(
+            (document.sha256, document.size_bytes, document.mime_type),
+            (hashlib.sha256(content).hexdigest(), len(content), 'application/pdf')
+        )
+        self.assertEqual((version.sha256, version.size_bytes), (document.sha256, document.size_bytes))
+        with default_storage.open(document.file.name) as file:
+            self.assertEqual(file.read(), content)
+    
+    def test_content_contradicting_extension_is_rejected(self):
+        """Test files whose content is a different known type, or no known type, are rejected"""
+        response = self.upload('invoice.pdf', make_image(size=(20, 20)))
+        self.assertContains(response, 'The file content is a PNG image, which does not match its .pdf extension.')
+        response = self.upload('setup.docx', b'MZ\x90\x00' + b'\x00' * 100)
+        self.assertContains(response, 'Windows executable')
+        self.assertFalse(Document.objects.exists())
+        
+        # HTML, scripts and other content without a known signature too
+        response = self.upload('notes.pdf', b'<html><script>alert(1)</script></html>')
+        self.assertContains(response, 'The file content is not a valid .pdf file.')
+        self.assertFalse(Document.objects.exists())
+        
+        self.upload('notes.pdf', b'%PDF-1.4 notes')
+        self.upload('photo.png', make_image(size=(20, 20)))
+        self.assertEqual(Document.objects.count(), 2)
+    
+    def test_content_is_checked_on_every_route(self):
+        """Test chunked uploads, imports and archives reject content contradicting its extension"""
+        image = make_image(size=(20, 20))
+        directory = tempfile.mkdtemp()
+        for name in ('fake.pdf', 'real.png'):
+            with open(os.path.join(directory, name), 'wb') as file:
+                file.write(image)
+        results = importer.import_files(
+            [os.path.join(directory, 'fake.pdf'), os.path.join(directory, 'real.png')], self.owner, self.category
+        )
+        self.assertEqual([result['status'] for result in results], ['failed', 'imported'])
+        self.assertIn('PNG image', results[0]['error'])
+        document = Document.objects.get()
+        # The MIME type follows the detected content
+        self.assertEqual((document.mime_type, document.versions.get().mime_type), ('image/png', 'image/png'))
+        
+        for extra in ({'title': 'Fake'}, {'document': document.pk}):
+            response = self.client.post(reverse('create_upload_session'), dict(extra, filename='fake.pdf', size=len(image)))
+            url = response.json()['url']
+            self.client.put(url, image, content_type='application/octet-stream',
+                            headers={'Content-Range': f'bytes 0-{len(image) - 1}/{len(image)}'})
+            session = UploadSession.objects.get()
+            response = self.client.post(reverse('complete_upload_session', args=[session.pk]),
+                                        {'title': 'Fake', 'category': self.category.pk})
+            self.assertContains(response, 'does not match its .pdf extension', status_code=400)
+            session.delete()
+        self.assertEqual(Document.objects.count(), 1)
+        self.assertEqual(DocumentVersion.objects.count(), 1)
+        
+        response = self.client.post(reverse('export_documents'), {'document_ids': [document.pk], 'format': 'archive'})
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as archive:
+            members = {name: archive.read(name) for name in archive.namelist()}
+        header, line = members[archives.MANIFEST_NAME].decode().splitlines()
+        record = json.loads(line)
+        for content in [record['file']] + [version['file'] for version in record['versions']]:
+            content['original_filename'] = 'fake.pdf'
+        members[archives.MANIFEST_NAME] = '\n'.join([header, json.dumps(record)])
+        data = io.BytesIO()
+        with zipfile.ZipFile(data, 'w') as archive:
+            for name, content in members.items():
+                archive.writestr(name, content)
+        data.seek(0)
+        results = list(archives.import_archive(data, self.owner))
+        self.assertEqual([result['status'] for result in results], ['failed'])
+        self.assertIn('does not match its .pdf extension', results[0]['error'])
+        self.assertEqual(Document.objects.count(), 1)
+    
+    def test_rejected_content_is_not_stored(self):
+        """Test the rest of a rejected file is dropped as soon as its type is known"""
+        handler = upload_handlers.InspectingTemporaryFileUploadHandler()
+        handler.new_file('file', 'budget.xlsx', 'application/octet-stream', 300000)
+        path = handler.file.temporary_file_path()
+        self.assertIsNone(handler.receive_data_chunk(b'%PDF-1.7 ' + b'x' * 65527, 0))
+        self.assertFalse(os.path.exists(path))
+        self.assertIsNone(handler.receive_data_chunk(b'x' * 65536, 65536))
+        file = handler.file_complete(131072)
+        self.assertIsInstance(file, upload_handlers.RejectedUpload)
+        self.assertEqual(file.read(), b'')
+        self.assertIn('PDF document', file.rejection)
+        with self.assertRaises(ValidationError):
+            validate_file_type(file)
@@ -0,0 +1,182 @@
+"""
+Thumbnail renditions of image documents and versions.
+
+Each PNG or JPEG file gets a JPEG rendition per size in SIZES, stored as
+thumbnails/<sha[:2]>/<sha256>-<size>.jpg. Renditions are keyed by content
+hash, so identical files share them and a rendition never changes, which is
+why the thumbnail view can send them with a year-long Cache-Control.
+
+Rendering is scheduled when a document or version is saved with a new image
+and runs after the transaction commits, on a process pool of
+THUMBNAIL_WORKERS processes so resizing never holds up a web worker or
+competes for the GIL. With THUMBNAIL_BACKGROUND off it runs inline instead.
+With JOB_QUEUE_ENABLED they are rendered by a render_thumbnails job in the
+worker instead. The generate_thumbnails management command renders images
+uploaded earlier.
+
+Once every rendition of a hash exists, mark_rendered() sets
+thumbnails_rendered on the documents and versions with that content, so
+pages listing them never ask storage whether a thumbnail is there.
+"""
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, connection, transaction
+
+from . import imaging, jobs, tiering
+from .models import Document, DocumentVersion
+
+logger = logging.getLogger(__name__)
+
+# Rendition name and the square it fits in, in pixels
+SIZES = {
+    'small': 160,
+    'medium': 480,
+    'large': 1024,
+}
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+# A year, renditions of a hash never change
+CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+_executor = None
+_executor_lock = threading.Lock()
+# Hashes being rendered by the pool
+_pending = set()
+
+
+def rendition_name(sha256, size):
+    return f'thumbnails/{sha256[:2]}/{sha256}-{size}.jpg'
+
+
+def has_thumbnail(obj):
+    return obj.extension in IMAGE_EXTENSIONS and bool(obj.sha256)
+
+
+def thumbnail_exists(sha256, size, storage=default_storage):
+    return storage.exists(rendition_name(sha256, size))
+
+
+def mark_rendered(sha256):
+    """Record on every document and version with this content that its thumbnails exist."""
+    for model in (Document, DocumentVersion):
+        model.objects.filter(sha256=sha256, thumbnails_rendered=False).update(thumbnails_rendered=True)
+
+
+def missing_targets(storage, sha256):
+    return [
+        (pixels, storage.path(rendition_name(sha256, size)))
+        for size, pixels in SIZES.items() if not thumbnail_exists(sha256, size, storage)
+    ]
+
+
+@contextmanager
+def _local_path(storage, name):
+    """Yield a local path for a stored file, copying it to a temp file only if needed."""
+    try:
+        path = storage.path(name)
+    except NotImplementedError:
+        path = None
+    if path and os.path.isfile(path):
+        yield path
+        return
+    # Cold or remote files are decompressed or downloaded first
+    fd, temp_path = tempfile.mkstemp(suffix=os.path.splitext(name)[1])
+    try:
+        with os.fdopen(fd, 'wb') as target, tiering.open_stored(storage, name) as source:
+            shutil.copyfileobj(source, target)
+        yield temp_path
+    finally:
+        os.remove(temp_path)
+
+
+def render(storage, name, sha256):
+    """
+    Render the missing renditions of the image stored as name, in this
+    process. Returns the number written.
+    """
+    targets = missing_targets(storage, sha256)
+    written = 0
+    if targets:
+        with _local_path(storage, name) as source_path:
+            written = len(imaging.render(source_path, targets))
+    mark_rendered(sha256)
+    return written
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(
+                max_workers=getattr(settings, 'THUMBNAIL_WORKERS', 2),
+                # Workers import only documents.imaging, never a forked copy of Django's state
+                mp_context=multiprocessing.get_context('spawn'),
+            )
+    return _executor
+
+
+def _finished(future, name, sha256, submitter):
+    with _executor_lock:
+        _pending.discard(sha256)
+    if future.exception() is not None:
+        logger.warning('Thumbnail rendering failed for %s: %s', name, future.exception())
+        return
+    if threading.get_ident() == submitter:
+        # Already done when submitted, so called inline
+        mark_rendered(sha256)
+        return
+    # On the pool's management thread, which has a connection of its own
+    close_old_connections()
+    try:
+        mark_rendered(sha256)
+    except Exception:
+        logger.exception('Could not record the thumbnails of %s', name)
+    finally:
+        connection.close()
+
+
+def _dispatch(storage, name, sha256):
+    try:
+        if getattr(settings, 'THUMBNAIL_BACKGROUND', True):
+            targets = missing_targets(storage, sha256)
+            if not targets:
+                mark_rendered(sha256)
+                return
+            with _executor_lock:
+                # The same content uploaded twice is rendered once
+                if sha256 in _pending:
+                    return
+                _pending.add(sha256)
+            # Hot files only, the worker reads the source path itself
+            future = _get_executor().submit(imaging.render, storage.path(name), targets)
+            submitter = threading.get_ident()
+            future.add_done_callback(lambda future: _finished(future, name, sha256, submitter))
+        else:
+            render(storage, name, sha256)
+    except Exception as e:
+        logger.warning('Thumbnail rendering failed for %s: %s', name, e)
+
+
+@jobs.task('render_thumbnails')
+def render_stored(file_name, sha256):
+    return render(default_storage, file_name, sha256)
+
+
+def schedule(obj):
+    """Render the thumbnails of a document's or version's image once the transaction commits."""
+    if not has_thumbnail(obj):
+        return
+    storage, name, sha256 = obj.file.storage, obj.file.name, obj.sha256
+    if jobs.is_enabled():
+        # Shown on the dashboard, so ahead of other work
+        jobs.enqueue('render_thumbnails', priority=10, file_name=name, sha256=sha256)
+    else:
+        transaction.on_commit(lambda: _dispatch(storage, name, sha256))
@@ -0,0 +1,231 @@
+"""
+Cold storage tier for archived documents.
+
+Once a document has been archived for COLD_STORAGE_GRACE_DAYS, the blobs
+holding its file, its versions' files and their delta chunks are compressed
+with lzma into the cold directory, COLD_STORAGE_ROOT, and removed from hot
+storage. A blob is only moved when every document referring to it is past
+the grace period, since content is shared between documents. Formats that
+are already compressed, such as images and Office files, stay hot.
+
+open_stored() opens a stored file from either tier, decompressing cold files
+as they are read, so downloads, exports and extraction work unchanged.
+Restoring a document schedules thaw_document(), which moves its blobs back to
+hot storage, as a job or on a background thread, so the request doesn't wait
+for the decompression; until then its files are read from the cold tier.
+The move_to_cold_storage management command runs migrate() in batches and
+reports the bytes reclaimed.
+"""
+import logging
+import lzma
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import close_old_connections, connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import filetypes, jobs
+from .models import Blob, Document, DocumentVersion, VersionChunk
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_GRACE_DAYS = 30
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def cold_root():
+    return getattr(settings, 'COLD_STORAGE_ROOT', None) or os.path.join(settings.MEDIA_ROOT, 'cold')
+
+
+def cold_storage():
+    return FileSystemStorage(location=cold_root())
+
+
+def cold_name(name):
+    return f'{name}.xz'
+
+
+def open_stored(storage, name):
+    """
+    Open the stored file called name for reading, from hot storage or, if it
+    was moved to the cold tier, decompressing it as it is read. Raises
+    FileNotFoundError if it is in neither.
+    """
+    try:
+        return storage.open(name, 'rb')
+    except FileNotFoundError:
+        blob = Blob.objects.filter(name=name, tier='cold').first()
+        if blob is None:
+            raise
+    file = File(lzma.open(cold_storage().path(cold_name(name)), 'rb'), name)
+    # The compressed file's size is not the content's
+    file.size = blob.size_bytes
+    return file
+
+
+def modified_time(storage, name):
+    """Return when the stored file called name was last modified, in either tier."""
+    try:
+        return storage.get_modified_time(name)
+    except FileNotFoundError:
+        blob = Blob.objects.filter(name=name, tier='cold').first()
+        if blob is None:
+            raise
+        # Blob contents never change
+        return blob.created_at
+
+
+def _names(documents):
+    """The blob names referred to by documents, their versions and chunks."""
+    return (
+        Q(name__in=documents.values('file'))
+        | Q(name__in=DocumentVersion.objects.filter(document__in=documents).values('file'))
+        | Q(name__in=VersionChunk.objects.filter(version__document__in=documents).values('name'))
+    )
+
+
+def _compressed():
+    """Blob names of formats that lzma can't make any smaller."""
+    return reduce(or_, (Q(name__iendswith=extension) for extension in filetypes.COMPRESSED_EXTENSIONS))
+
+
+def cold_candidates(cutoff):
+    """Hot, compressible blobs referred to only by documents archived before cutoff."""
+    frozen = Document.objects.filter(is_archived=True, archived_at__lt=cutoff)
+    active = Document.objects.exclude(pk__in=frozen.values('pk'))
+    blobs = Blob.objects.filter(tier='hot').filter(_names(frozen)).exclude(_names(active))
+    return blobs.exclude(_compressed())
+
+
+def warm_candidates(cutoff):
+    """Cold blobs that a document restored or uploaded since refers to again."""
+    active = Document.objects.exclude(is_archived=True, archived_at__lt=cutoff)
+    return Blob.objects.filter(tier='cold').filter(_names(active))
+
+
+def freeze_blob(blob, storage):
+    """
+    Compress blob into the cold tier and delete its hot file. Returns the
+    bytes reclaimed, or None if the hot file is missing.
+    """
+    cold = cold_storage()
+    path = cold.path(cold_name(blob.name))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        source = storage.open(blob.name, 'rb')
+    except FileNotFoundError:
+        return None
+    with source, lzma.open(path, 'wb') as target:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            target.write(chunk)
+
+    blob.tier = 'cold'
+    blob.cold_size_bytes = os.path.getsize(path)
+    Blob.objects.filter(pk=blob.pk).update(tier=blob.tier, cold_size_bytes=blob.cold_size_bytes)
+    # Readers find the cold copy from now on
+    storage.delete(blob.name)
+    return blob.size_bytes - blob.cold_size_bytes
+
+
+def thaw_blob(blob, storage):
+    """Decompress a cold blob back into hot storage and delete its cold copy."""
+    cold = cold_storage()
+    name = cold_name(blob.name)
+    if not storage.exists(blob.name):
+        with lzma.open(cold.path(name), 'rb') as source:
+            stored = storage.save(blob.name, File(source, blob.name))
+        if stored != blob.name:
+            storage.delete(stored)
+            raise OSError(f'Could not restore {blob.name} to its own name')
+    Blob.objects.filter(pk=blob.pk).update(tier='hot', cold_size_bytes=0)
+    blob.tier = 'hot'
+    cold.delete(name)
+
+
+def delete_cold_copy(blob):
+    cold_storage().delete(cold_name(blob.name))
+
+
+@jobs.task('thaw_document')
+def thaw_document(document_id):
+    """Move every cold blob of a document, its versions and their chunks back to hot storage."""
+    storage = Document._meta.get_field('file').storage
+    documents = Document.objects.filter(pk=document_id)
+    for blob in Blob.objects.filter(tier='cold').filter(_names(documents)):
+        thaw_blob(blob, storage)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cold-storage-thaw')
+    return _executor
+
+
+def _thaw_in_background(document_id):
+    close_old_connections()
+    try:
+        thaw_document(document_id)
+    except Exception:
+        logger.exception('Moving document %s back from cold storage failed', document_id)
+    finally:
+        connection.close()
+
+
+def _dispatch(document_id):
+    if getattr(settings, 'COLD_STORAGE_THAW_BACKGROUND', True):
+        _get_executor().submit(_thaw_in_background, document_id)
+    else:
+        thaw_document(document_id)
+
+
+def schedule_thaw(document):
+    """Move document's cold files back to hot storage once the transaction commits."""
+    document_id = document.pk
+    if jobs.is_enabled():
+        jobs.enqueue('thaw_document', document_id=document_id)
+    else:
+        transaction.on_commit(lambda: _dispatch(document_id))
+
+
+def migrate(grace_days=None, batch_size=100, storage=None):
+    """
+    Freeze the blobs of documents archived more than grace_days ago and thaw
+    cold blobs that active documents refer to again, batch_size blobs at a
+    time. Returns (frozen, thawed, bytes_reclaimed).
+    """
+    if grace_days is None:
+        grace_days = getattr(settings, 'COLD_STORAGE_GRACE_DAYS', DEFAULT_GRACE_DAYS)
+    storage = storage or Document._meta.get_field('file').storage
+    cutoff = timezone.now() - timedelta(days=grace_days)
+
+    frozen = thawed = reclaimed = 0
+    last_pk = 0
+    while True:
+        batch = list(cold_candidates(cutoff).filter(pk__gt=last_pk).order_by('pk')[:batch_size])
+        if not batch:
+            break
+        for blob in batch:
+            saved = freeze_blob(blob, storage)
+            if saved is not None:
+                frozen += 1
+                reclaimed += saved
+        last_pk = batch[-1].pk
+
+    for blob in warm_candidates(cutoff).iterator():
+        reclaimed -= blob.size_bytes - blob.cold_size_bytes
+        thaw_blob(blob, storage)
+        thawed += 1
+    return frozen, thawed, reclaimed
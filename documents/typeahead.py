@@ -0,0 +1,244 @@
+"""
+Title autocomplete served from an in-process prefix index.
+
+Each process keeps every document title in two sorted arrays, one keyed by the
+whole normalized title and one by the title from each later word onwards, so
+a lookup is a bisect plus a short scan. The arrays are kept per visibility,
+public documents and each owner's private ones, so a lookup only scans titles
+the user can see. The index is built lazily on the first lookup and updated
+incrementally by the Document save and delete signals once the transaction
+commits. Changes made by other processes are noticed through
+a generation counter in the cache: when it moves on without this process
+having applied the change, the index is rebuilt on the next lookup.
+
+That only works when the default cache is shared by every process. With
+the local-memory backend the settings ship with, each process has its own
+counter, so a process running several workers keeps suggesting titles
+changed or deleted in another worker until it restarts; `check --deploy`
+warns about it. Lookups and updates take the same lock, so a lookup never
+scans an index that is being changed.
+"""
+import bisect
+import heapq
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core import checks
+from django.core.cache import cache
+from django.db import transaction
+
+from .models import Document
+
+GENERATION_KEY = 'documents:typeahead:generation'
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 50
+
+_index = None
+_generation = None
+_lock = threading.Lock()
+
+
+def normalize(text):
+    return ' '.join(text.casefold().split())
+
+
+PUBLIC = 'public'
+
+
+def _bucket(owner_id, is_private, is_archived):
+    """
+    The group of documents visible together a document is indexed in:
+    public ones, or each owner's private ones. Archived documents, which the
+    dashboard doesn't list, aren't indexed.
+    """
+    if is_archived:
+        return None
+    return owner_id if is_private else PUBLIC
+
+
+class PrefixIndex:
+    def __init__(self):
+        # Bucket -> sorted (key, document id) pairs
+        self.titles = defaultdict(list)
+        self.words = defaultdict(list)
+        # Document id -> (title, owner id, is_private, is_archived)
+        self.documents = {}
+
+    @staticmethod
+    def _keys(title):
+        words = normalize(title).split()
+        return ' '.join(words), [' '.join(words[i:]) for i in range(1, len(words))]
+
+    def load(self, rows):
+        """Fill an empty index from (id, title, owner id, is_private, is_archived) rows."""
+        for document_id, title, *visibility in rows:
+            self.documents[document_id] = (title, *visibility)
+            bucket = _bucket(*visibility)
+            if bucket is None:
+                continue
+            title_key, word_keys = self._keys(title)
+            self.titles[bucket].append((title_key, document_id))
+            self.words[bucket].extend((key, document_id) for key in word_keys)
+        for entries in list(self.titles.values()) + list(self.words.values()):
+            entries.sort()
+
+    def add(self, document_id, title, owner_id, is_private, is_archived):
+        self.remove(document_id)
+        self.documents[document_id] = (title, owner_id, is_private, is_archived)
+        bucket = _bucket(owner_id, is_private, is_archived)
+        if bucket is None:
+            return
+        title_key, word_keys = self._keys(title)
+        bisect.insort(self.titles[bucket], (title_key, document_id))
+        for key in word_keys:
+            bisect.insort(self.words[bucket], (key, document_id))
+
+    def remove(self, document_id):
+        entry = self.documents.pop(document_id, None)
+        if entry is None:
+            return
+        bucket = _bucket(*entry[1:])
+        if bucket is None:
+            return
+        title_key, word_keys = self._keys(entry[0])
+        pairs = [(self.titles[bucket], title_key)] + [(self.words[bucket], key) for key in word_keys]
+        for entries, key in pairs:
+            position = bisect.bisect_left(entries, (key, document_id))
+            if position < len(entries) and entries[position] == (key, document_id):
+                del entries[position]
+
+    @staticmethod
+    def _matches(entries, prefix):
+        position = bisect.bisect_left(entries, (prefix,))
+        while position < len(entries) and entries[position][0].startswith(prefix):
+            yield entries[position]
+            position += 1
+
+    def search(self, prefix, user, limit=DEFAULT_LIMIT):
+        """
+        Return up to limit (id, title) pairs visible to user whose title, or a
+        word in it, starts with prefix. Title matches come first.
+
+        Only the public documents and user's own private ones are scanned,
+        so every match found is visible and the scan stops after limit
+        results however few documents user can see.
+        """
+        prefix = normalize(prefix)
+        results = []
+        seen = set()
+        if not prefix:
+            return results
+        buckets = (PUBLIC, user.pk)
+        for index in (self.titles, self.words):
+            matches = heapq.merge(*(self._matches(index.get(bucket, ()), prefix) for bucket in buckets))
+            for key, document_id in matches:
+                if len(results) >= limit:
+                    return results
+                if document_id not in seen:
+                    seen.add(document_id)
+                    results.append((document_id, self.documents[document_id][0]))
+        return results
+
+
+def build_index():
+    index = PrefixIndex()
+    index.load(Document.objects.values_list(
+        'pk', 'title', 'owner_id', 'is_private', 'is_archived'
+    ).iterator())
+    return index
+
+
+def get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start from the clock so a lost counter never revisits old generations
+        cache.add(GENERATION_KEY, time.time_ns(), timeout=None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def _current(generation):
+    """Return this process's index, (re)building it if it is missing or stale. Call with _lock held."""
+    global _index, _generation
+    if _index is None or generation != _generation:
+        # The generation is read first, so changes made during the build
+        # cause another rebuild rather than being lost
+        _index = build_index()
+        _generation = generation
+    return _index
+
+
+def get_index():
+    """Return this process's index, (re)building it if it is missing or stale."""
+    generation = get_generation()
+    with _lock:
+        return _current(generation)
+
+
+def _apply(update):
+    global _index, _generation
+    with _lock:
+        try:
+            generation = cache.incr(GENERATION_KEY)
+        except ValueError:
+            generation = None
+        if _index is None:
+            return
+        if generation is not None and generation - 1 == _generation:
+            # No other process changed anything since our last update
+            update(_index)
+            _generation = generation
+        else:
+            _index = None
+
+
+def document_saved(document):
+    values = (document.pk, document.title, document.owner_id, document.is_private, document.is_archived)
+    transaction.on_commit(lambda: _apply(lambda index: index.add(*values)))
+
+
+def document_deleted(document_id):
+    transaction.on_commit(lambda: _apply(lambda index: index.remove(document_id)))
+
+
+def _discard():
+    global _index
+    with _lock:
+        try:
+            cache.incr(GENERATION_KEY)
+        except ValueError:
+            pass
+        _index = None
+
+
+def invalidate():
+    """Make every process rebuild its index, for changes made without signals."""
+    transaction.on_commit(_discard)
+
+
+def suggest(prefix, user, limit=DEFAULT_LIMIT):
+    generation = get_generation()
+    with _lock:
+        # Under the lock, as _apply() changes the index in place
+        return _current(generation).search(prefix, user, max(1, min(limit, MAX_LIMIT)))
+
+
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+@checks.register(checks.Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    if settings.CACHES.get('default', {}).get('BACKEND') not in PROCESS_LOCAL_CACHES:
+        return []
+    return [checks.Warning(
+        'The default cache is not shared between processes, so title suggestions '
+        'in one worker miss changes made in the others.',
+        hint='Use a shared cache backend, such as the database, file-based, '
+             'Memcached or Redis one, when running several workers.',
+        id='documents.W001',
+    )]
@@ -0,0 +1,97 @@
+"""
+Upload handlers that inspect files as they arrive.
+
+Each chunk of an uploaded file is hashed and counted on its way to the
+handler's storage, in memory or a temporary file, and the first bytes are
+sniffed for the file's real type (see documents.filetypes). The finished
+upload carries sha256 and detected_type attributes, which describe_file()
+uses instead of reading the file again when it is saved.
+
+A file whose content contradicts its extension is rejected as soon as its
+first bytes are seen: the rest of it is dropped rather than stored, and the
+upload is replaced with an empty RejectedUpload whose rejection message
+validate_file_type() raises as a validation error. Files arriving any other
+way, such as chunked upload sessions and imports, are sniffed by
+validate_file_type() itself.
+"""
+import hashlib
+from io import BytesIO
+
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+from . import filetypes
+
+
+class RejectedUpload(InMemoryUploadedFile):
+    """Stands in for an upload whose content was rejected, holding none of it."""
+    def __init__(self, field_name, name, content_type, size, charset, rejection):
+        super().__init__(BytesIO(), field_name, name, content_type, size, charset)
+        self.rejection = rejection
+
+
+class InspectingUploadMixin:
+    def new_file(self, *args, **kwargs):
+        self.digest = hashlib.sha256()
+        self.head = b''
+        self.detected_type = None
+        self.rejection = None
+        # MemoryFileUploadHandler raises StopFutureHandlers from here
+        super().new_file(*args, **kwargs)
+
+    def handles_file(self):
+        """Whether this handler stores the current file, rather than passing it on."""
+        return True
+
+    def _inspect(self):
+        self.detected_type = filetypes.sniff(self.head)
+        self.rejection = filetypes.mismatch(self.file_name, self.detected_type)
+        if self.rejection:
+            self.discard()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.handles_file():
+            return super().receive_data_chunk(raw_data, start)
+        if self.rejection:
+            # The rest of a rejected file is dropped
+            return None
+        if len(self.head) < filetypes.HEAD_SIZE:
+            self.head += raw_data[:filetypes.HEAD_SIZE - len(self.head)]
+            if len(self.head) == filetypes.HEAD_SIZE:
+                self._inspect()
+                if self.rejection:
+                    return None
+        self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        if not self.handles_file():
+            return super().file_complete(file_size)
+        if not self.rejection and len(self.head) < filetypes.HEAD_SIZE:
+            # Shorter than the head, inspected now that it is complete
+            self._inspect()
+        if self.rejection:
+            return RejectedUpload(
+                self.field_name, self.file_name, self.content_type, file_size, self.charset, self.rejection
+            )
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.digest.hexdigest()
+            file.detected_type = self.detected_type
+        return file
+
+
+class InspectingMemoryFileUploadHandler(InspectingUploadMixin, MemoryFileUploadHandler):
+    """Keeps small files in memory, like MemoryFileUploadHandler."""
+    def handles_file(self):
+        return self.activated
+
+    def discard(self):
+        self.file = BytesIO()
+
+
+class InspectingTemporaryFileUploadHandler(InspectingUploadMixin, TemporaryFileUploadHandler):
+    """Streams larger files to a temporary file, like TemporaryFileUploadHandler."""
+    def discard(self):
+        # Closing deletes the temporary file
+        self.file.close()
@@ -0,0 +1,187 @@
+"""
+Chunked, resumable uploads.
+
+A client creates an UploadSession for a file of known size, PUTs chunks with
+a Content-Range header in any order (retrying or resuming from the ranges the
+session reports as received), and completes the session to turn the file
+into a Document or a new DocumentVersion. Chunks are streamed from the request
+into a temp file at their offsets, so neither the chunks nor the file are
+held in memory. On completion the temp file is handed to the blob store as
+an uploaded file with a temporary_file_path(), and Blob.objects.store() gives
+it to storage as it is, so FileSystemStorage moves it into place instead of
+copying it.
+
+Files are limited to UPLOAD_SESSION_MAX_SIZE bytes, checked against the
+declared size when the session is created. Sessions expire
+UPLOAD_SESSION_EXPIRY seconds after their last chunk and take no more
+chunks once expired. cleanup_expired() deletes them with their temp files;
+it runs from the cleanup_upload_sessions management command.
+"""
+import mimetypes
+import os
+import re
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.db import transaction
+from django.utils import timezone
+
+from .models import UploadSession
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+DEFAULT_MAX_SIZE = 4 * 1024 * 1024 * 1024
+DEFAULT_EXPIRY = 24 * 60 * 60
+
+_CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class ChunkError(Exception):
+    """A chunk that can't be accepted, with the HTTP status to answer with."""
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class AssembledUpload(UploadedFile):
+    """A completed session's temp file, which storage moves rather than copies."""
+    def __init__(self, path, name, size):
+        super().__init__(open(path, 'rb'), name, mimetypes.guess_type(name)[0], size)
+        self.path = path
+
+    def temporary_file_path(self):
+        return self.path
+
+    def close(self):
+        try:
+            return self.file.close()
+        except FileNotFoundError:
+            # Moved into storage already
+            pass
+
+
+def upload_dir():
+    return getattr(settings, 'UPLOAD_SESSION_DIR', None) or os.path.join(settings.MEDIA_ROOT, 'upload_sessions')
+
+
+def temp_path(session):
+    return os.path.join(upload_dir(), f'{session.pk}.part')
+
+
+def max_chunk_size():
+    return getattr(settings, 'UPLOAD_CHUNK_MAX_SIZE', DEFAULT_MAX_CHUNK_SIZE)
+
+
+def max_upload_size():
+    return getattr(settings, 'UPLOAD_SESSION_MAX_SIZE', DEFAULT_MAX_SIZE)
+
+
+def _expiry():
+    return timezone.now() + timedelta(seconds=getattr(settings, 'UPLOAD_SESSION_EXPIRY', DEFAULT_EXPIRY))
+
+
+def add_range(ranges, start, end):
+    """Return ranges, a sorted list of [start, end) pairs, with [start, end) merged in."""
+    merged = []
+    for current in sorted(ranges + [[start, end]]):
+        if merged and current[0] <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], current[1])
+        else:
+            merged.append(list(current))
+    return merged
+
+
+def create_session(owner, filename, size, document=None):
+    session = UploadSession.objects.create(
+        owner=owner, document=document, filename=os.path.basename(filename),
+        size=size, expires_at=_expiry(),
+    )
+    os.makedirs(upload_dir(), exist_ok=True)
+    with open(temp_path(session), 'wb'):
+        pass
+    return session
+
+
+def parse_content_range(header, session):
+    """Return the (start, end) of a chunk, end exclusive, or raise ChunkError."""
+    match = _CONTENT_RANGE.match(header or '')
+    if not match:
+        raise ChunkError('A Content-Range header of the form "bytes start-end/size" is required.')
+    start, last, total = (int(value) for value in match.groups())
+    if total != session.size:
+        raise ChunkError(f'The upload size is {session.size} bytes, not {total}.')
+    if last < start or last >= total:
+        raise ChunkError('The chunk range is outside the file.', status=416)
+    if last - start + 1 > max_chunk_size():
+        raise ChunkError(f'Chunks are limited to {max_chunk_size()} bytes.', status=413)
+    return start, last + 1
+
+
+def write_chunk(session, stream, start, end):
+    """
+    Stream the chunk body from stream into the temp file at start and record
+    the bytes written. A body cut short by a dropped connection records only
+    what arrived, so the client can resume from there. Returns the session,
+    or raises ChunkError if it was cleaned up meanwhile.
+    """
+    written = 0
+    try:
+        file = open(temp_path(session), 'r+b')
+    except FileNotFoundError:
+        raise ChunkError('The upload session has expired.', status=410)
+    with file:
+        file.seek(start)
+        while start + written < end:
+            data = stream.read(min(CHUNK_SIZE, end - start - written))
+            if not data:
+                break
+            file.write(data)
+            written += len(data)
+
+    with transaction.atomic():
+        # Chunks may arrive in parallel, merge with the latest ranges
+        session = UploadSession.objects.select_for_update().filter(pk=session.pk).first()
+        if session is None:
+            raise ChunkError('The upload session has expired.', status=410)
+        if written:
+            session.received = add_range(session.received, start, start + written)
+        session.expires_at = _expiry()
+        session.save(update_fields=['received', 'expires_at'])
+    return session
+
+
+def assembled_file(session):
+    return AssembledUpload(temp_path(session), session.filename, session.size)
+
+
+def delete_session(session):
+    try:
+        os.remove(temp_path(session))
+    except FileNotFoundError:
+        pass
+    session.delete()
+
+
+def cleanup_expired(now=None):
+    """Delete expired sessions and their temp files. Returns how many were removed."""
+    expired = UploadSession.objects.filter(expires_at__lt=now or timezone.now())
+    count = 0
+    for session in expired.iterator():
+        delete_session(session)
+        count += 1
+    return count
+
+
+def session_status(session):
+    first = session.received[0] if session.received else None
+    return {
+        'id': str(session.pk),
+        'filename': session.filename,
+        'size': session.size,
+        # Where a sequential client should continue
+        'offset': first[1] if first and first[0] == 0 else 0,
+        'received': session.received,
+        'complete': session.is_complete,
+        'expires_at': session.expires_at.isoformat(),
+    }
@@ -3,8 +3,16 @@ from . import views
 
 urlpatterns = [
     path('', views.dashboard, name='dashboard'),
+    path('suggest/', views.suggest_documents, name='suggest_documents'),
     path('upload/', views.upload_document, name='upload_document'),
+    path('uploads/', views.create_upload_session, name='create_upload_session'),
+    path('uploads/<uuid:pk>/', views.upload_session, name='upload_session'),
+    path('uploads/<uuid:pk>/complete/', views.complete_upload_session, name='complete_upload_session'),
     path('document/<int:pk>/', views.document_detail, name='document_detail'),
+    path('document/<int:pk>/download/', views.download_document, name='download_document'),
+    path('document/<int:pk>/versions/<int:version_number>/download/', views.download_version,
+         name='download_version'),
+    path('thumbnails/<str:sha256>/<str:size>/', views.document_thumbnail, name='document_thumbnail'),
     path('document/<int:pk>/delete/', views.delete_document, name='delete_document'),
     path('document/<int:pk>/edit/', views.edit_document, name='edit_document'),
     path('categories/', views.category_list, name='category_list'),
@@ -1,21 +1,25 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.contrib.auth.decorators import login_required
-from django.db.models import Q, Count, Sum, F
-from django.http import HttpResponseForbidden, JsonResponse, HttpResponse
+from django.db.models import Q, Count, Sum, F, Prefetch
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 from django.contrib import messages
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
 from django.utils import timezone
-from django.db.models.functions import TruncDay
 from django.urls import reverse
 from datetime import timedelta, datetime
 import os
 import json
-import zipfile
-import io
 from .models import (
     Document, Category, DocumentVersion, UserProfile, 
-    DocumentShare, Comment, Notification
+    DocumentShare, Comment, Notification, UploadSession,
+    FILE_METADATA_FIELDS, validate_file_type
 )
 from .forms import DocumentForm, UserRegistrationForm
+from . import analytics, archives, delta, downloads, exports, facets, importer, search, thumbnails, tiering, typeahead, uploads
+from .pagination import paginate_documents
 
 def register(request):
     if request.method == 'POST':
@@ -38,135 +42,93 @@ def dashboard(request):
     # Filter out archived documents from the main dashboard
     documents = Document.objects.filter(
         Q(owner=request.user) | Q(is_private=False)
-    ).filter(is_archived=False)
+    ).filter(is_archived=False).select_related('category', 'owner')
     
+    ordering = 'uploaded_at'
     if query:
-        documents = documents.filter(
-            Q(title__icontains=query) |
-            Q(description__icontains=query)
-        )
+        documents, ranked = search.search_documents(documents, query)
+        if ranked:
+            ordering = 'search_rank'
+    
+    # Category, file type, owner, visibility and year facets
+    documents, selected_facets = facets.apply_facets(documents, request.GET)
+    facet_list = facets.facet_counts(documents, request.GET) if query or selected_facets else None
     
-    if category:
-        documents = documents.filter(category__name=category)
+    page = paginate_documents(request, documents, ordering)
+    search.attach_snippets(page.object_list, query)
     
     # Get all categories
     categories = Category.objects.all()
     
-    # Get only categories that have active documents
-    active_categories_count = Category.objects.filter(
-        document__is_archived=False
-    ).distinct().count()
-    
-    # Analytics data - Document statistics (excluding archived documents)
-    total_documents = Document.objects.filter(is_archived=False).count()
-    user_documents = Document.objects.filter(owner=request.user, is_archived=False).count()
-    
-    # Category distribution for pie chart (excluding archived documents)
-    category_stats = Document.objects.filter(is_archived=False).values('category__name').annotate(
-        count=Count('id')
-    ).order_by('-count')
-    
-    # Format category data for JSON
-    category_data = []
-    for cat in category_stats:
-        category_data.append({
-            'label': cat['category__name'] or 'Uncategorized',
-            'count': cat['count']
-        })
-    
-    # Recent activity - last 7 days of uploads (excluding archived documents)
-    last_week = timezone.now() - timedelta(days=7)
-    daily_uploads = Document.objects.filter(
-        uploaded_at__gte=last_week,
-        is_archived=False
-    ).annotate(
-        day=TruncDay('uploaded_at')
-    ).values('day').annotate(
-        count=Count('id')
-    ).order_by('day')
-    
-    # Format for the chart
-    activity_labels = []
-    activity_data = []
-    
-    # Create a complete date range for the last 7 days
-    current_date = last_week
-    end_date = timezone.now()
-    
-    while current_date.date() <= end_date.date():
-        day_str = current_date.strftime('%Y-%m-%d')
-        activity_labels.append(current_date.strftime('%d %b'))
-        
-        # Find if there are uploads for this day
-        day_data = next((item for item in daily_uploads if item['day'].strftime('%Y-%m-%d') == day_str), None)
-        activity_data.append(day_data['count'] if day_data else 0)
-        
-        current_date += timedelta(days=1)
-    
-    # File type distribution (excluding archived documents)
-    file_types = {}
-    for doc in Document.objects.filter(is_archived=False):
-        ext = os.path.splitext(doc.file.name)[1].lower()
-        if ext:
-            file_types[ext] = file_types.get(ext, 0) + 1
-    
-    # Storage usage calculation (excluding archived documents)
+    # Activity chart window in days
+    try:
+        window = int(request.GET.get('window', 7))
+    except ValueError:
+        window = 7
+    if window not in analytics.ACTIVITY_WINDOWS:
+        window = 7
+    # Window links keep the search, category and facets
+    params = request.GET.copy()
+    params.pop('cursor', None)
+    activity_windows = []
+    for days in analytics.ACTIVITY_WINDOWS:
+        params['window'] = days
+        activity_windows.append((days, params.urlencode()))
+    
+    # Analytics data - read from the materialized counters through the cache
+    stats = analytics.dashboard_stats(request.user, window)
     storage_usage = {
-        'user': 0,
-        'total': 0,
-        'by_category': {}
+        'user': stats['storage_user'],
+        'total': stats['storage_total'],
+        'by_category': stats['storage_by_category'],
     }
     
-    for doc in Document.objects.filter(is_archived=False):
-        try:
-            size = doc.file.size
-            storage_usage['total'] += size
-            if doc.owner == request.user:
-                storage_usage['user'] += size
-                
-            # Also track by category
-            cat_name = doc.category.name if doc.category else 'Uncategorized'
-            if cat_name not in storage_usage['by_category']:
-                storage_usage['by_category'][cat_name] = 0
-            storage_usage['by_category'][cat_name] += size
-        except:
-            # File might not exist
-            pass
-    
-    # Convert bytes to MB
-    for key in ['user', 'total']:
-        storage_usage[key] = round(storage_usage[key] / (1024 * 1024), 2)
-    
-    for category in storage_usage['by_category']:
-        storage_usage['by_category'][category] = round(storage_usage['by_category'][category] / (1024 * 1024), 2)
-    
-    # Get recent uploads - last 5 non-archived docs
-    recent_uploads = Document.objects.filter(is_archived=False).order_by('-uploaded_at')[:5]
-    
     return render(request, 'documents/dashboard.html', {
-        'documents': documents,
+        'documents': page.object_list,
+        'page': page,
         'categories': categories,
         'query': query,
         'selected_category': category,
+        'facets': facet_list,
+        'selected_facets': selected_facets,
+        'activity_window': window,
+        'activity_windows': activity_windows,
         # Analytics data
         'analytics': {
-            'total_documents': total_documents,
-            'user_documents': user_documents,
-            'active_categories_count': active_categories_count,  # Add this
-            'category_stats': category_data,
-            'category_stats_json': json.dumps(category_data),
-            'file_types': file_types,
-            'file_types_json': json.dumps(file_types),
+            'total_documents': stats['total_documents'],
+            'user_documents': stats['user_documents'],
+            'active_categories_count': stats['active_categories_count'],
+            'category_stats': stats['category_stats'],
+            'category_stats_json': json.dumps(stats['category_stats']),
+            'file_types': stats['file_types'],
+            'file_types_json': json.dumps(stats['file_types']),
             'storage_usage': storage_usage,
             'storage_usage_json': json.dumps(storage_usage['by_category']),
-            'activity_labels': activity_labels,
-            'activity_data': activity_data,
-            'activity_labels_json': json.dumps(activity_labels),
-            'activity_data_json': json.dumps(activity_data),
-            'recent_uploads': recent_uploads
+            'activity_labels': stats['activity_labels'],
+            'activity_data': stats['activity_data'],
+            'activity_labels_json': json.dumps(stats['activity_labels']),
+            'activity_data_json': json.dumps(stats['activity_data']),
+            'recent_uploads': stats['recent_uploads']
         }
     })
 
+@login_required
+def suggest_documents(request):
+    if not has_permission(request.user, 'view'):
+        return HttpResponseForbidden("You don't have permission to view documents.")
+    try:
+        limit = int(request.GET.get('limit', typeahead.DEFAULT_LIMIT))
+    except ValueError:
+        limit = typeahead.DEFAULT_LIMIT
+    
+    suggestions = typeahead.suggest(request.GET.get('q', ''), request.user, limit)
+    return JsonResponse({
+        'results': [
+            {'id': pk, 'title': title, 'url': reverse('document_detail', args=[pk])}
+            for pk, title in suggestions
+        ]
+    })
+
 @login_required
 def upload_document(request):
     if request.method == 'POST':
@@ -195,13 +157,203 @@ def upload_document(request):
     }
     return render(request, 'documents/document_upload.html', context)
 
+# Chunked upload API, see documents.uploads
+def _session_status(session):
+    return dict(uploads.session_status(session), url=reverse('upload_session', args=[session.pk]))
+
+def _session_response(session, status=200):
+    return JsonResponse(_session_status(session), status=status)
+
+def _expired_response(session):
+    # Its temp file may be cleaned up at any moment, the client must start over
+    return JsonResponse(dict(_session_status(session), error='The upload session has expired.'), status=410)
+
+@login_required
+def create_upload_session(request):
+    if request.method != 'POST':
+        # The user's unfinished uploads, so a client can resume after a restart
+        sessions = UploadSession.objects.filter(
+            owner=request.user, expires_at__gte=timezone.now()
+        ).order_by('-created_at')
+        return JsonResponse({'sessions': [
+            _session_status(session) for session in sessions
+        ]})
+    if not has_permission(request.user, 'create'):
+        return HttpResponseForbidden("You don't have permission to upload documents.")
+
+    filename = os.path.basename(request.POST.get('filename', ''))
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        size = 0
+    if not filename or size < 1:
+        return JsonResponse({'error': 'A filename and a positive size are required.'}, status=400)
+    if size > uploads.max_upload_size():
+        return JsonResponse({'error': f'Uploads are limited to {uploads.max_upload_size()} bytes.'}, status=413)
+    try:
+        validate_file_type(File(None, filename))
+    except ValidationError as e:
+        return JsonResponse({'error': e.messages[0]}, status=400)
+
+    document = None
+    if request.POST.get('document'):
+        document = get_object_or_404(Document, pk=request.POST['document'])
+        if document.owner != request.user:
+            return HttpResponseForbidden()
+
+    session = uploads.create_session(request.user, filename, size, document)
+    return _session_response(session, status=201)
+
+@login_required
+def upload_session(request, pk):
+    session = get_object_or_404(UploadSession, pk=pk, owner=request.user)
+
+    if request.method == 'DELETE':
+        uploads.delete_session(session)
+        return HttpResponse(status=204)
+
+    if session.is_expired:
+        return _expired_response(session)
+
+    if request.method == 'PUT':
+        try:
+            start, end = uploads.parse_content_range(request.headers.get('Content-Range'), session)
+            session = uploads.write_chunk(session, request, start, end)
+        except uploads.ChunkError as e:
+            return JsonResponse({'error': str(e)}, status=e.status)
+        return _session_response(session)
+
+    return _session_response(session)
+
+@login_required
+def complete_upload_session(request, pk):
+    session = get_object_or_404(UploadSession, pk=pk, owner=request.user)
+    if session.is_expired:
+        return _expired_response(session)
+    if request.method != 'POST':
+        return _session_response(session)
+    if not session.is_complete:
+        return JsonResponse(dict(uploads.session_status(session), error='The upload is incomplete.'), status=409)
+
+    upload = uploads.assembled_file(session)
+    try:
+        # The document, its version and the session's deletion commit together
+        with transaction.atomic():
+            if session.document:
+                # Versions are created without a form, so their content is checked here
+                try:
+                    validate_file_type(upload)
+                except ValidationError as e:
+                    return JsonResponse({'error': e.messages[0]}, status=400)
+                document = session.document
+                # Increment version
+                document.current_version += 1
+                version = DocumentVersion.objects.create(
+                    document=document,
+                    file=upload,
+                    version_number=document.current_version,
+                    created_by=request.user,
+                    comment=request.POST.get('version_comment', '')
+                )
+                # The document shows the latest file, which is already stored
+                document.file.name = version.file.name
+                for field in FILE_METADATA_FIELDS + ('original_filename',):
+                    setattr(document, field, getattr(version, field))
+                document.save()
+            else:
+                form = DocumentForm(request.POST, {'file': upload})
+                if not form.is_valid():
+                    return JsonResponse({'errors': form.errors}, status=400)
+                document = form.save(commit=False)
+                document.owner = request.user
+                document.save()
+                DocumentVersion.objects.create(
+                    document=document,
+                    file=document.file,
+                    version_number=1,
+                    created_by=request.user,
+                    comment="Initial version"
+                )
+            uploads.delete_session(session)
+    finally:
+        upload.close()
+
+    return JsonResponse({
+        'id': document.pk,
+        'version': document.current_version,
+        'url': reverse('document_detail', args=[document.pk]),
+    }, status=201)
+
 @login_required
 def document_detail(request, pk):
-    document = get_object_or_404(Document, pk=pk)
+    document = get_object_or_404(
+        Document.objects.select_related('category', 'owner').prefetch_related(
+            Prefetch('comments', queryset=Comment.objects.select_related('user'))
+        ),
+        pk=pk
+    )
     if document.is_private and document.owner != request.user:
         return HttpResponseForbidden()
     return render(request, 'documents/document_detail.html', {'document': document})
 
+@login_required
+def download_document(request, pk):
+    document = get_object_or_404(Document, pk=pk)
+    if document.is_private and document.owner_id != request.user.pk:
+        return HttpResponseForbidden()
+    return downloads.serve_file(
+        request, document.file, filename=document.get_filename(),
+        content_type=document.mime_type or None, as_attachment=False, sha256=document.sha256
+    )
+
+@login_required
+def serve_media(request, path):
+    # Files under MEDIA_URL, for users who may see a document or version using them
+    visible = Document.objects.filter(Q(owner=request.user) | Q(is_private=False))
+    obj = visible.filter(file=path).first() or DocumentVersion.objects.filter(
+        file=path, document__in=visible
+    ).first()
+    if obj is None:
+        raise Http404('File not found')
+    return downloads.serve_file(
+        request, obj.file, filename=obj.get_filename(), content_type=obj.mime_type or None,
+        as_attachment=False, sha256=obj.sha256
+    )
+
+@login_required
+def document_thumbnail(request, sha256, size):
+    if size not in thumbnails.SIZES:
+        raise Http404('Unknown thumbnail size')
+    # Renditions are keyed by content, shown to users who may see a file with it
+    visible = Document.objects.filter(Q(owner=request.user) | Q(is_private=False))
+    if not (visible.filter(sha256=sha256).exists() or DocumentVersion.objects.filter(
+        sha256=sha256, document__in=visible
+    ).exists()):
+        raise Http404('File not found')
+    response = downloads.serve_stored(
+        request, default_storage, thumbnails.rendition_name(sha256, size),
+        content_type='image/jpeg', as_attachment=False
+    )
+    response['Cache-Control'] = f'private, max-age={thumbnails.CACHE_MAX_AGE}, immutable'
+    return response
+
+@login_required
+def download_version(request, pk, version_number):
+    version = get_object_or_404(
+        DocumentVersion.objects.select_related('document'), document_id=pk, version_number=version_number
+    )
+    if version.document.is_private and version.document.owner != request.user:
+        return HttpResponseForbidden()
+    # Older versions may be kept as delta chunks rather than a file
+    try:
+        file = delta.open_version(version)
+    except FileNotFoundError:
+        raise Http404('File not found')
+    return downloads.serve_open_file(
+        request, file, version.created_at, version.get_filename(),
+        content_type=version.mime_type or None, sha256=version.sha256
+    )
+
 def has_permission(user, action, obj=None):
     """
     Check if user has permission to perform action.
@@ -331,6 +483,8 @@ def delete_category(request, pk):
         documents = Document.objects.filter(category=category)
         uncategorized = Category.objects.get_or_create(name="Uncategorized")[0]
         documents.update(category=uncategorized)
+        # Queryset updates skip signals, so move the analytics counters too
+        analytics.move_category(category.pk, uncategorized.pk)
         
         category.delete()
         messages.success(request, 'Category deleted successfully!')
@@ -363,27 +517,33 @@ def archived_documents(request):
     # Get archived documents that the user can access
     documents = Document.objects.filter(
         Q(owner=request.user) | Q(is_private=False)
-    ).filter(is_archived=True)
+    ).filter(is_archived=True).select_related('category', 'owner')
     
     query = request.GET.get('q', '')
     category = request.GET.get('category', '')
     
+    ordering = 'uploaded_at'
     if query:
-        documents = documents.filter(
-            Q(title__icontains=query) |
-            Q(description__icontains=query)
-        )
+        documents, ranked = search.search_documents(documents, query)
+        if ranked:
+            ordering = 'search_rank'
     
-    if category:
-        documents = documents.filter(category__name=category)
+    # Category, file type, owner, visibility and year facets
+    documents, selected_facets = facets.apply_facets(documents, request.GET)
+    facet_list = facets.facet_counts(documents, request.GET) if query or selected_facets else None
     
+    page = paginate_documents(request, documents, ordering)
+    search.attach_snippets(page.object_list, query)
     categories = Category.objects.all()
     
     return render(request, 'documents/archived_documents.html', {
-        'documents': documents,
+        'documents': page.object_list,
+        'page': page,
         'categories': categories,
         'query': query,
-        'selected_category': category
+        'selected_category': category,
+        'facets': facet_list,
+        'selected_facets': selected_facets,
     })
 
 @login_required
@@ -398,6 +558,8 @@ def restore_document(request, pk):
         document.is_archived = False
         document.archived_at = None
         document.save()
+        # Its files are read from cold storage until they are moved back
+        tiering.schedule_thaw(document)
         messages.success(request, 'Document restored successfully!')
         return redirect('archived_documents')
     
@@ -504,7 +666,7 @@ def shared_document(request, token):
     share.save()
     
     # Get comments
-    comments = Comment.objects.filter(document=document)
+    comments = Comment.objects.filter(document=document).select_related('user')
     
     return render(request, 'documents/shared_document.html', {
         'document': document,
@@ -522,13 +684,14 @@ def download_shared_document(request, token):
     
     document = share.document
     
-    # Track download count
-    share.download_count += 1
-    share.save()
+    def count_download():
+        # Track download count
+        DocumentShare.objects.filter(pk=share.pk).update(download_count=F('download_count') + 1)
     
-    response = HttpResponse(document.file, content_type='application/octet-stream')
-    response['Content-Disposition'] = f'attachment; filename="{document.file.name.split("/")[-1]}"'
-    return response
+    return downloads.serve_file(
+        request, document.file, filename=document.get_filename(),
+        sha256=document.sha256, on_download=count_download
+    )
 
 # Comment views
 @login_required
@@ -598,7 +761,7 @@ def delete_comment(request, document_pk, comment_pk):
 # Notification views
 @login_required
 def notifications(request):
-    notifications = Notification.objects.filter(user=request.user)
+    notifications = Notification.objects.filter(user=request.user).select_related('document')
     unread_count = notifications.filter(is_read=False).count()
     
     return render(request, 'documents/notifications.html', {
@@ -636,36 +799,33 @@ def export_documents(request):
             messages.error(request, 'No documents selected for export.')
             return redirect('dashboard')
         
-        # Create in-memory ZIP file
-        buffer = io.BytesIO()
-        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            for doc_id in document_ids:
-                try:
-                    document = Document.objects.get(pk=doc_id)
-                    
-                    # Check permissions
-                    if document.owner != request.user and document.is_private:
-                        continue
-                    
-                    # Add file to zip
-                    file_name = document.file.name.split('/')[-1]
-                    zipf.writestr(file_name, document.file.read())
-                except Document.DoesNotExist:
-                    continue
+        # Documents the user may export, in the order they were selected
+        ids = [int(pk) for pk in dict.fromkeys(document_ids) if pk.isdigit()]
+        documents = Document.objects.filter(pk__in=ids).filter(
+            Q(owner=request.user) | Q(is_private=False)
+        ).in_bulk()
         
-        # Prepare response
-        buffer.seek(0)
-        response = HttpResponse(buffer, content_type='application/zip')
-        response['Content-Disposition'] = f'attachment; filename="exported_documents_{timezone.now().strftime("%Y%m%d")}.zip"'
+        # Stream the ZIP as it is written instead of building it in memory
+        if request.POST.get('format') == 'archive':
+            # Keeps metadata, versions and comments, for import_documents on another instance
+            content = archives.stream_archive(Document.objects.filter(pk__in=list(documents)))
+            filename = f'documents_archive_{timezone.now().strftime("%Y%m%d")}.zip'
+        else:
+            content = exports.stream_zip([documents[pk] for pk in ids if pk in documents])
+            filename = f'exported_documents_{timezone.now().strftime("%Y%m%d")}.zip'
+        response = StreamingHttpResponse(content, content_type='application/zip')
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
         return response
     
     # Get documents user can access
     documents = Document.objects.filter(
         Q(owner=request.user) | Q(is_private=False)
-    ).filter(is_archived=False)
+    ).filter(is_archived=False).select_related('category', 'owner')
+    page = paginate_documents(request, documents)
     
     return render(request, 'documents/export_documents.html', {
-        'documents': documents
+        'documents': page.object_list,
+        'page': page,
     })
 
 @login_required
@@ -684,47 +844,33 @@ def import_documents(request):
         except Category.DoesNotExist:
             category = None
         
-        success_count = 0
-        error_count = 0
-        
-        for file in files:
+        # Archives written by an export bring their own metadata
+        archive_files = [
+            file for file in files if file.name.lower().endswith('.zip') and archives.is_archive(file)
+        ]
+        results = importer.import_files(
+            [file for file in files if file not in archive_files],
+            request.user, category=category, is_private=is_private
+        )
+        for file in archive_files:
             try:
-                # Create document
-                document = Document.objects.create(
-                    title=os.path.splitext(file.name)[0],  # Use filename as title
-                    description='Imported document',
-                    file=file,
-                    category=category,
-                    owner=request.user,
-                    is_private=is_private
-                )
-                
-                # Create initial version
-                DocumentVersion.objects.create(
-                    document=document,
-                    file=file,
-                    version_number=1,
-                    created_by=request.user,
-                    comment="Initial version (imported)"
-                )
-                
-                # Create notification
-                Notification.objects.create(
-                    user=request.user,
-                    document=document,
-                    notification_type='upload',
-                    message=f"You uploaded a new document: '{document.title}'"
-                )
-                
-                success_count += 1
-                
-            except Exception as e:
-                error_count += 1
+                for result in archives.import_archive(file, request.user):
+                    results.append(result)
+            except archives.ArchiveError as e:
+                # A manifest whose header is missing or from another version
+                results.append({'name': file.name, 'status': 'failed', 'document': None, 'error': str(e)})
+        success_count = sum(result['status'] == 'imported' for result in results)
+        error_count = len(results) - success_count
         
         if success_count > 0:
             messages.success(request, f'Successfully imported {success_count} document(s).')
         if error_count > 0:
             messages.error(request, f'Failed to import {error_count} file(s). Please check the file types.')
+            # Show which files failed and why
+            return render(request, 'documents/import_documents.html', {
+                'categories': Category.objects.all(),
+                'results': results,
+            })
         
         return redirect('dashboard')
     